@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""AES-GCM data key AEAD backed by pyca/cryptography.
+
+Produces and accepts exactly what Tink's AES-GCM primitive does for a raw
+key: a 12 byte random IV, the ciphertext and a 16 byte tag. The work is done
+by OpenSSL with the GIL released, so threads encrypting different segments
+or files run in parallel, which Tink's primitive doesn't allow.
+"""
+
+import os
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from tink import aead
+from tink.core import TinkError
+from tink.proto import aes_gcm_pb2
+
+
+_IV_SIZE = 12
+_TAG_SIZE = 16
+
+
+class AesGcm(aead.Aead):
+  """Tink compatible AES-GCM AEAD for one data key."""
+
+  def __init__(self, key_data):
+    """Init class for AesGcm.
+
+    Args:
+      key_data: Tink KeyData of an AES-GCM key
+
+    Returns:
+      None
+    """
+    key = aes_gcm_pb2.AesGcmKey.FromString(key_data.value)
+    self._aesgcm = AESGCM(key.key_value)
+
+  def encrypt(self, plaintext, associated_data):
+    iv = os.urandom(_IV_SIZE)
+    return iv + self._aesgcm.encrypt(iv, bytes(plaintext), associated_data)
+
+  def decrypt(self, ciphertext, associated_data):
+    if len(ciphertext) < _IV_SIZE + _TAG_SIZE:
+      raise TinkError('ciphertext too short')
+    try:
+      return self._aesgcm.decrypt(bytes(ciphertext[:_IV_SIZE]),
+                                  bytes(ciphertext[_IV_SIZE:]),
+                                  associated_data)
+    except InvalidTag:
+      raise TinkError('decryption failed')
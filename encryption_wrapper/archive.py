@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Many small files packed into one encrypted object.
+
+An archive is an ordinary segmented ciphertext whose plaintext is:
+
+  members            the contents of every member, back to back
+  index              JSON list of {"name", "offset", "size"}, one per member
+  trailer            20 bytes: index offset and index size, 8 bytes each, big
+                     endian, then b'CSEA'
+
+Packing any number of files costs one data key, so one KMS call, and one
+upload. The index is encrypted with the members and the trailer always ends
+the plaintext, so a reader finds the index from the object's size alone and
+reads any member with ranged GETs of only the segments holding it.
+"""
+
+import json
+import shutil
+import struct
+
+from encryption_wrapper import blobio
+from encryption_wrapper import errors
+
+
+MAGIC = b'CSEA'
+# custom metadata marking archives, alongside client-side-encrypted
+ARCHIVE_METADATA = 'client-side-encryption-archive'
+_TRAILER = struct.Struct('>QQ4s')
+_COPY_SIZE = 1024 * 1024
+
+
+class ArchiveWriter(object):
+  """Pack files into a new archive object as they are added."""
+
+  def __init__(self, blob, client=None, **kwargs):
+    """Init class for ArchiveWriter.
+
+    Args:
+      blob: wrapped Blob to write the archive to
+      client: wrapped Client class
+      **kwargs: content_type, predefined_acl, the if_generation_* and
+        if_metageneration_* preconditions and timeout of the upload
+
+    Returns:
+      None
+    """
+    metadata = dict(blob.metadata or {})
+    metadata[ARCHIVE_METADATA] = 'true'
+    blob.metadata = metadata
+    self.writer = blobio.EncryptedWriter(blob, client, **kwargs)
+    self.members = []
+    self.names = set()
+    self.offset = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      # leave the object as it was rather than create a partial archive
+      self.writer.abort()
+
+  def add(self, name, filename):
+    """Append a file to the archive.
+
+    Args:
+      name: name of the member, unique within the archive
+      filename: path to the file
+
+    Raises:
+      LocalFileError: if the file can't be opened; the name stays free
+    """
+    try:
+      member = open(filename, 'rb')
+    except OSError as os_error:
+      raise errors.LocalFileError(str(os_error)) from os_error
+    with member:
+      start = self._start(name)
+      shutil.copyfileobj(member, self, _COPY_SIZE)
+    self._end(name, start)
+
+  def add_bytes(self, name, data):
+    """Append a member with the given contents.
+
+    Args:
+      name: name of the member, unique within the archive
+      data: bytes-like object with the member's contents
+    """
+    start = self._start(name)
+    self.write(data)
+    self._end(name, start)
+
+  def write(self, data):
+    """Append data to the current member."""
+    self.writer.write(data)
+    self.offset += len(data)
+
+  def close(self):
+    """Write the index and trailer and create the object."""
+    index = json.dumps(self.members, separators=(',', ':')).encode('utf-8')
+    index_offset = self.offset
+    self.write(index)
+    self.write(_TRAILER.pack(index_offset, len(index), MAGIC))
+    self.writer.close()
+
+  def _start(self, name):
+    if name in self.names:
+      raise errors.ArchiveError('archive already has a member named ' + name)
+    self.names.add(name)
+    return self.offset
+
+  def _end(self, name, start):
+    self.members.append({
+        'name': name,
+        'offset': start,
+        'size': self.offset - start
+    })
+
+
+class ArchiveReader(object):
+  """List and extract the members of an archive object."""
+
+  def __init__(self, blob, client=None, readahead=1):
+    """Init class for ArchiveReader.
+
+    Reads the trailer and the index, usually from the last segment alone.
+
+    Args:
+      blob: wrapped Blob of the archive
+      client: wrapped Client class
+      readahead: segments to fetch per ranged GET; members are usually
+        small, so by default only the segments holding them are fetched
+
+    Returns:
+      None
+    """
+    self.reader = blobio.EncryptedReader(blob, client, readahead)
+    if self.reader.size < _TRAILER.size:
+      raise errors.ArchiveError('gs://{}/{} is not an archive'.format(
+          blob.bucket.name, blob.name))
+    index_offset, index_size, magic = _TRAILER.unpack(
+        self._read(self.reader.size - _TRAILER.size, _TRAILER.size))
+    if magic != MAGIC:
+      raise errors.ArchiveError('gs://{}/{} is not an archive'.format(
+          blob.bucket.name, blob.name))
+    self.members = json.loads(self._read(index_offset, index_size))
+    self.by_name = {member['name']: member for member in self.members}
+
+  def names(self):
+    """Return the names of the members, in the order they were added."""
+    return [member['name'] for member in self.members]
+
+  def read(self, name):
+    """Return the contents of a member.
+
+    Args:
+      name: name of the member
+
+    Returns:
+      data: the member's contents
+    """
+    member = self._member(name)
+    return self._read(member['offset'], member['size'])
+
+  def extract(self, name, filename):
+    """Write the contents of a member to a file.
+
+    Args:
+      name: name of the member
+      filename: path to write the contents to
+    """
+    member = self._member(name)
+    self.reader.seek(member['offset'])
+    remaining = member['size']
+    with open(filename, 'wb') as destination:
+      while remaining:
+        data = self.reader.read(min(remaining, _COPY_SIZE))
+        if not data:
+          raise errors.IntegrityError(
+              'archive member {} is truncated'.format(name))
+        destination.write(data)
+        remaining -= len(data)
+
+  def _member(self, name):
+    if name not in self.by_name:
+      raise errors.ArchiveError('archive has no member named ' + name)
+    return self.by_name[name]
+
+  def _read(self, offset, size):
+    """Read exactly size bytes of plaintext from an offset."""
+    self.reader.seek(offset)
+    data = bytearray()
+    while len(data) < size:
+      chunk = self.reader.read(size - len(data))
+      if not chunk:
+        raise errors.IntegrityError('archive is truncated')
+      data += chunk
+    return bytes(data)
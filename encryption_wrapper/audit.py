@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Audit a bucket for objects that are not client-side encrypted.
+
+Objects without the client-side-encrypted metadata are reported straight
+from the listing. For the others, one ranged read of the start of the object
+checks that the ciphertext header parses and agrees with the object's size,
+and measures the byte entropy of the ciphertext that follows it, which is
+close to 8 bits per byte for anything actually encrypted. No KMS calls are
+made and no object is downloaded whole.
+
+Usage:
+  python3 -m encryption_wrapper.audit --bucket BUCKET [--prefix PREFIX] \\
+      [--workers N] [--sample_rate RATE]
+"""
+
+import argparse
+import concurrent.futures
+import sys
+import zlib
+
+from encryption_wrapper import errors
+from encryption_wrapper import streaming
+
+from google.api_core import exceptions
+from google.cloud import storage
+import numpy as np
+import requests
+from tink.core import TinkError
+
+
+# ciphertext bytes after the header whose entropy is measured
+_SAMPLE_SIZE = 4096
+_WORKERS = 64
+# shorter samples are too small to tell ciphertext from plaintext by entropy
+_MIN_SAMPLE_SIZE = 256
+# random samples of at least _MIN_SAMPLE_SIZE bytes stay well above this,
+# while text, hex and base64 are at 6 bits per byte or less
+_ENTROPY_THRESHOLD = 6.4
+# outcomes that are reported object by object
+PROBLEMS = ('unencrypted', 'malformed', 'low_entropy', 'failed')
+
+
+def byte_entropy(data):
+  """Shannon entropy of a byte string.
+
+  Args:
+    data: bytes-like object
+
+  Returns:
+    entropy: bits per byte, from 0 to 8
+  """
+  if not data:
+    return 0.0
+  counts = np.bincount(np.frombuffer(data, dtype=np.uint8), minlength=256)
+  probabilities = counts[counts > 0] / len(data)
+  return float(-np.sum(probabilities * np.log2(probabilities)))
+
+
+def looks_encrypted(data):
+  """Decide whether a sample has the entropy of ciphertext.
+
+  Samples too short for their entropy to mean anything always pass.
+
+  Args:
+    data: bytes-like object
+
+  Returns:
+    encrypted: True if the sample's entropy is high enough
+  """
+  if len(data) < _MIN_SAMPLE_SIZE:
+    return True
+  return byte_entropy(data) >= _ENTROPY_THRESHOLD
+
+
+class BucketAudit(object):
+  """Check that every object in a bucket is client-side encrypted."""
+
+  def __init__(self,
+               bucket_name,
+               workers=_WORKERS,
+               sample_rate=1.0,
+               client=None):
+    """Init class for BucketAudit.
+
+    Args:
+      bucket_name: name of the bucket to audit
+      workers: number of objects checked concurrently
+      sample_rate: fraction of the objects marked as encrypted whose
+        ciphertext is read; the others are only checked for the metadata
+      client: google-cloud-storage Client to use, defaults to a new one
+
+    Returns:
+      None
+    """
+    self.bucket_name = bucket_name
+    self.workers = workers
+    self.sample_rate = sample_rate
+    self.client = client or storage.Client()
+
+  def run(self, prefix=None, report=None):
+    """Audit every object under a prefix.
+
+    Args:
+      prefix: only audit objects whose names start with this
+      report: function called with the outcome, the gs:// URL and the error,
+        or None, of every object in PROBLEMS
+
+    Returns:
+      counts: dict with the number of objects per outcome
+    """
+    counts = {'encrypted': 0, 'marked': 0, 'legacy': 0}
+    counts.update((problem, 0) for problem in PROBLEMS)
+    blobs = self.client.list_blobs(
+        self.bucket_name, prefix=prefix, page_size=streaming.LIST_PAGE_SIZE)
+    with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+      for page in blobs.pages:
+        page_blobs = list(page)
+        for blob, (outcome, read_error) in zip(
+            page_blobs, executor.map(self._audit_one, page_blobs)):
+          counts[outcome] += 1
+          if outcome in PROBLEMS and report is not None:
+            report(outcome, 'gs://{}/{}'.format(self.bucket_name, blob.name),
+                   read_error)
+    return counts
+
+  def _audit_one(self, blob):
+    """Classify one object.
+
+    Args:
+      blob: Blob from the bucket listing, with its metadata
+
+    Returns:
+      (outcome, error): key of the counts dict this object falls under, and
+        the error if the object couldn't be read or parsed
+    """
+    metadata = blob.metadata or {}
+    if metadata.get('client-side-encrypted') != 'true':
+      return 'unencrypted', None
+    if not self._sampled(blob.name):
+      return 'marked', None
+    try:
+      header, prefix = streaming.read_header(blob)
+    except errors.IntegrityError as header_error:
+      return 'malformed', header_error
+    except (exceptions.GoogleAPICallError, requests.exceptions.RequestException,
+            TinkError) as read_error:
+      # one object that can't be read doesn't stop the audit
+      return 'failed', read_error
+    if header is None:
+      # a single envelope: 4 byte wrapped key length, wrapped key, ciphertext
+      if len(prefix) < 4 or prefix[0] != 0:
+        return 'malformed', None
+      body = int.from_bytes(prefix[:4], 'big') + 4
+      return ('legacy' if looks_encrypted(prefix[body:body + _SAMPLE_SIZE])
+              else 'low_entropy'), None
+    try:
+      header.plaintext_size(blob.size)
+    except TinkError as size_error:
+      return 'malformed', size_error
+    if not looks_encrypted(prefix[header.size:header.size + _SAMPLE_SIZE]):
+      return 'low_entropy', None
+    return 'encrypted', None
+
+  def _sampled(self, name):
+    """Pick objects to read deterministically, so reruns check the same."""
+    return zlib.crc32(name.encode('utf-8')) < self.sample_rate * 2 ** 32
+
+
+def _print_problem(outcome, url, read_error):
+  if read_error is None:
+    print('{}: {}'.format(outcome, url))
+  else:
+    print('{}: {}: {}'.format(outcome, url, read_error))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Report objects in a bucket that are not client-side '
+      'encrypted.')
+  parser.add_argument('--bucket', required=True)
+  parser.add_argument('--prefix', default=None)
+  parser.add_argument('--workers', type=int, default=_WORKERS)
+  parser.add_argument('--sample_rate', type=float, default=1.0)
+  args = parser.parse_args()
+
+  audit = BucketAudit(args.bucket, args.workers, args.sample_rate)
+  counts = audit.run(args.prefix, _print_problem)
+  for outcome, count in sorted(counts.items()):
+    print('{}: {}'.format(outcome, count))
+  if any(counts[problem] for problem in PROBLEMS):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
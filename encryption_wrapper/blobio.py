@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""File objects that read and write client-side encrypted objects.
+
+The reader fetches only the ciphertext segments holding the bytes asked for,
+with ranged GETs, so seeking is cheap whatever the size of the object. The
+writer encrypts segment by segment as data is written and streams the
+ciphertext to GCS, so neither ever holds the whole object.
+"""
+
+import io
+
+from encryption_wrapper import encryption
+from encryption_wrapper import errors
+from encryption_wrapper import resumable
+from encryption_wrapper import streaming
+
+from google.cloud import storage
+from tink.core import TinkError
+
+
+# segments fetched per ranged GET when reading sequentially
+_READAHEAD_SEGMENTS = 4
+
+
+class EncryptedReader(io.RawIOBase):
+  """Seekable reader of an encrypted object's plaintext."""
+
+  def __init__(self, blob, client=None, readahead=_READAHEAD_SEGMENTS):
+    """Init class for EncryptedReader.
+
+    Args:
+      blob: wrapped Blob to read
+      client: wrapped Client class
+      readahead: segments to fetch per request
+
+    Returns:
+      None
+    """
+    super().__init__()
+    self.blob = blob
+    self.client = client
+    self.readahead = max(1, readahead)
+    self.position = 0
+    # plaintext of the segments fetched last, by index
+    self.segments = {}
+    self.legacy = None
+    # pin the reads to one generation whose size and metadata we know
+    if blob.generation is None or blob.size is None:
+      blob.reload(client=client)
+    header, prefix = streaming.read_header(blob, client)
+    try:
+      if header is None:
+        # legacy files are a single envelope and must be decrypted whole
+        if len(prefix) < blob.size:
+          prefix = self._fetch(0, blob.size - 1)
+        self.legacy = blob.e.env_aead.decrypt(prefix, b'')
+        self.size = len(self.legacy)
+        return
+      self.cipher = blob.e.cipher_for(
+          blob.e.resolve_header(header, lambda: blob.metadata))
+      self.size = header.plaintext_size(blob.size)
+    except TinkError as decryption_failure:
+      raise encryption.decryption_error(
+          decryption_failure) from decryption_failure
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_SET:
+      position = offset
+    elif whence == io.SEEK_CUR:
+      position = self.position + offset
+    elif whence == io.SEEK_END:
+      position = self.size + offset
+    else:
+      raise ValueError('invalid whence ({})'.format(whence))
+    if position < 0:
+      raise ValueError('negative seek position {}'.format(position))
+    self.position = position
+    return position
+
+  def tell(self):
+    return self.position
+
+  def readinto(self, buffer):
+    """Copy plaintext from the current position into a buffer.
+
+    Args:
+      buffer: writable bytes-like object
+
+    Returns:
+      count: number of bytes copied, 0 at the end of the object
+    """
+    if self.position >= self.size:
+      return 0
+    if self.legacy is not None:
+      segment, skip = self.legacy, self.position
+    else:
+      index, skip = divmod(self.position, self.cipher.header.segment_size)
+      segment = self._segment(index)
+    data = segment[skip:skip + len(buffer)]
+    buffer[:len(data)] = data
+    self.position += len(data)
+    return len(data)
+
+  def _segment(self, index):
+    """Return a segment's plaintext, fetching it and the next few if needed.
+
+    Args:
+      index: zero based segment number
+
+    Returns:
+      plaintext: the segment's plaintext
+    """
+    if index not in self.segments:
+      header = self.cipher.header
+      count = header.segment_count(self.size)
+      stop = min(index + self.readahead, count)
+      start = header.segment_offset(index)
+      ciphertext = self._fetch(
+          start, min(header.segment_offset(stop), self.blob.size) - 1)
+      segment_size = header.ciphertext_segment_size
+      try:
+        self.segments = {
+            i: self.cipher.decrypt_segment(
+                i, ciphertext[(i - index) * segment_size:
+                              (i - index + 1) * segment_size], i == count - 1)
+            for i in range(index, stop)
+        }
+      except TinkError as decryption_failure:
+        # the data key is already unwrapped, so this is never KMS's fault
+        raise errors.IntegrityError(
+            str(decryption_failure)) from decryption_failure
+    return self.segments[index]
+
+  def _fetch(self, start, end):
+    """Download an inclusive byte range of the ciphertext."""
+    ciphertext = io.BytesIO()
+    storage.Blob.download_to_file(self.blob, ciphertext, self.client, start,
+                                  end, raw_download=True)
+    return ciphertext.getvalue()
+
+
+class EncryptedWriter(io.RawIOBase):
+  """Writer that encrypts and uploads an object as it is written."""
+
+  def __init__(self,
+               blob,
+               client=None,
+               content_type=None,
+               predefined_acl=None,
+               if_generation_match=None,
+               if_generation_not_match=None,
+               if_metageneration_match=None,
+               if_metageneration_not_match=None,
+               timeout=60):
+    """Init class for EncryptedWriter.
+
+    Args:
+      blob: wrapped Blob to write
+      client: wrapped Client class
+      content_type: same as real content_type
+      predefined_acl: same as real predefined_acl
+      if_generation_match: same as real if_generation_match
+      if_generation_not_match: same as real if_generation_not_match
+      if_metageneration_match: same as real if_metageneration_match
+      if_metageneration_not_match: same as real if_metageneration_not_match
+      timeout: same as real timeout
+
+    Returns:
+      None
+    """
+    super().__init__()
+    self.blob = blob
+    self.client = blob._require_client(client)  # pylint: disable=protected-access
+    self.cipher = blob.e.new_cipher()
+    self.index = 0
+    self.buffer = bytearray()
+    metadata = dict(blob.metadata or {})
+    metadata['client-side-encrypted'] = 'true'
+    metadata.update(encryption.key_metadata(self.cipher.header))
+    self.upload = resumable.StreamingUpload(
+        blob, self.client, metadata, content_type, predefined_acl,
+        if_generation_match, if_generation_not_match, if_metageneration_match,
+        if_metageneration_not_match, timeout)
+    self.checksummed = streaming.Crc32cWriter(self.upload)
+    self.checksummed.write(self.cipher.header.to_bytes())
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    """Encrypt and send every segment completed by data.
+
+    A full segment is held back until more data arrives, since the last
+    segment is encrypted differently and isn't known until close.
+
+    Args:
+      data: bytes-like object with the next plaintext
+
+    Returns:
+      count: number of bytes accepted, always all of them
+    """
+    self.buffer += data
+    segment_size = self.cipher.header.segment_size
+    count = max(0, len(self.buffer) - 1) // segment_size
+    segments = ((self.index + i,
+                 bytes(self.buffer[i * segment_size:(i + 1) * segment_size]),
+                 False) for i in range(count))
+    for encrypted in self.cipher.encrypt_segments(segments,
+                                                  self.blob.e.workers):
+      self.checksummed.write(encrypted)
+    del self.buffer[:count * segment_size]
+    self.index += count
+    return len(data)
+
+  def abort(self):
+    """Close without finalizing, so the object is not created or replaced."""
+    if self.closed:
+      return
+    try:
+      if hasattr(self, 'upload'):
+        self.upload.cancel()
+    finally:
+      super().close()
+
+  def close(self):
+    """Encrypt the last segment and finalize the object."""
+    if self.closed:
+      return
+    if not hasattr(self, 'checksummed'):
+      # the upload never started
+      super().close()
+      return
+    plaintext_size = self.index * self.cipher.header.segment_size + len(
+        self.buffer)
+    try:
+      self.checksummed.write(
+          self.cipher.encrypt_segment(self.index, bytes(self.buffer), True))
+      resource = self.upload.finish()
+      if resource.get('crc32c') != streaming.crc32c_base64(
+          self.checksummed.crc32c):
+        self.blob.bucket.delete_blob(
+            self.blob.name,
+            client=self.client,
+            generation=resource.get('generation'))
+        raise errors.IntegrityError(
+            'CRC32C of gs://{}/{} does not match'.format(
+                self.blob.bucket.name, self.blob.name),
+            retryable=True)
+      self.blob._set_properties(resource)  # pylint: disable=protected-access
+      if self.blob.index is not None:
+        self.blob.index.record(self.blob, plaintext_size)
+    finally:
+      super().close()
+
+
+class EncryptedBufferedWriter(io.BufferedWriter):
+  """Buffered EncryptedWriter that only creates the object on a clean exit.
+
+  Leaving a with block because of an exception aborts the upload instead of
+  publishing whatever had been written so far.
+  """
+
+  def abort(self):
+    """Drop the buffered data and the upload; the object is not changed."""
+    self.raw.abort()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      self.abort()
+    else:
+      self.close()
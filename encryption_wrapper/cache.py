@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local cache of decrypted objects.
+
+Entries are keyed by bucket, object name and generation. A generation is
+never reused for different data, so an entry is valid for as long as it
+exists and checking freshness only needs the object's current generation,
+which costs a metadata request and no download or KMS call.
+
+The cache holds plaintext, so its directory is only accessible to the
+current user and every entry is created readable by the owner only.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+
+class DecryptedCache(object):
+  """Size-capped, least recently used cache of decrypted objects."""
+
+  def __init__(self, location, max_bytes):
+    """Init class for DecryptedCache.
+
+    Args:
+      location: directory to keep the cached plaintexts in
+      max_bytes: total size the cache is trimmed to after every insert
+
+    Returns:
+      None
+    """
+    self.location = location
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    os.makedirs(location, mode=0o700, exist_ok=True)
+    os.chmod(location, 0o700)
+
+  def get(self, bucket_name, name, generation, filename):
+    """Copy a cached plaintext to filename if there is one.
+
+    Args:
+      bucket_name: the object's bucket
+      name: the object's name
+      generation: the object's generation
+      filename: path to copy the plaintext to
+
+    Returns:
+      hit: True if the plaintext was cached and copied
+    """
+    path = self._path(bucket_name, name, generation)
+    try:
+      shutil.copyfile(path, filename)
+    except FileNotFoundError:
+      return False
+    # the mtime records the last use, for eviction
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      pass
+    return True
+
+  def put(self, bucket_name, name, generation, filename):
+    """Add a plaintext to the cache, evicting the least recently used.
+
+    Args:
+      bucket_name: the object's bucket
+      name: the object's name
+      generation: the object's generation
+      filename: path to the plaintext
+    """
+    if os.path.getsize(filename) > self.max_bytes:
+      return
+    descriptor, partial_path = tempfile.mkstemp(dir=self.location,
+                                                suffix='.partial')
+    try:
+      with os.fdopen(descriptor, 'wb') as entry, open(filename, 'rb') as source:
+        shutil.copyfileobj(source, entry)
+      os.replace(partial_path, self._path(bucket_name, name, generation))
+    except BaseException:
+      os.unlink(partial_path)
+      raise
+    self._evict()
+
+  def _evict(self):
+    """Remove the least recently used entries until under max_bytes."""
+    with self.lock:
+      entries = []
+      for entry in os.scandir(self.location):
+        if entry.name.endswith('.partial'):
+          continue
+        try:
+          entry_stat = entry.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+      total = sum(size for _, size, _ in entries)
+      for _, size, path in sorted(entries):
+        if total <= self.max_bytes:
+          break
+        try:
+          os.unlink(path)
+        except FileNotFoundError:
+          pass
+        total -= size
+
+  def _path(self, bucket_name, name, generation):
+    """Path of the entry for one generation of an object."""
+    key = '{}\n{}\n{}'.format(bucket_name, name, generation)
+    return os.path.join(self.location,
+                        hashlib.sha256(key.encode('utf-8')).hexdigest())
@@ -17,10 +17,12 @@
 import subprocess
 import sys
 
+from encryption_wrapper import profiling
+
 
 def error_and_exit(message):
   """Helper function to print errors and exit with sig 1."""
-  print('encryption_wrapper wrapper ERROR: {}'.format(message))
+  print('encryption_wrapper wrapper ERROR: {}'.format(message), file=sys.stderr)
   sys.exit(1)
 
 
@@ -35,22 +37,49 @@ def run_command(cmd, description):
     results: output from the executed command
   """
 
+  with profiling.child(description):
+    try:
+      p = subprocess.Popen(cmd,
+                           shell=True,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+      while True:
+        # print command output as it happens
+        line = p.stdout.readline()
+        if not line:
+          break
+        else:
+          print(str(line.strip(), 'utf-8'))
+    except subprocess.SubprocessError as command_exception:
+      error_and_exit('{} failed: {}'.format(description,
+                                            str(command_exception)))
+
+    # now communicate with the subprocess to the returncode property is set
+    p.communicate()
+  return p.returncode
+
+
+def capture_command(cmd, description):
+  """Helper function to execute commands and capture their output.
+
+  Args:
+    cmd: the command to execute
+    description: description of the command, for logging purposes
+
+  Returns:
+    returncode: exit status of the executed command
+    output: stdout of the executed command
+  """
+
   try:
-    p = subprocess.Popen(cmd,
+    with profiling.child(description):
+      p = subprocess.run(cmd,
                          shell=True,
                          stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-    while True:
-      # print command output as it happens
-      line = p.stdout.readline()
-      if not line:
-        break
-      else:
-        print(str(line.strip(), 'utf-8'))
+                         stderr=subprocess.PIPE,
+                         check=False)
   except subprocess.SubprocessError as command_exception:
     error_and_exit('{} failed: {}'.format(description,
                                           str(command_exception)))
 
-  # now communicate with the subprocess to the returncode property is set
-  p.communicate()
-  return p.returncode
+  return p.returncode, str(p.stdout, 'utf-8')
@@ -17,37 +17,265 @@
 For use with the google-cloud-storage Python module.
 """
 
+import base64
+import collections
+import contextlib
+import logging
 import os
+import random
 import shutil
 import stat
+import tempfile
+import threading
+import time
 
-from encryption_wrapper.common import error_and_exit
+from encryption_wrapper import aesgcm
+from encryption_wrapper import errors
+from encryption_wrapper import kms
+from encryption_wrapper import profiling
+from encryption_wrapper import streaming
 
 import tink
 from tink import aead
+from tink import core
 from tink.core import TinkError
-from tink.integration import gcpkms
+from tink.proto import tink_pb2
 
 
 _TMP_LOCATION = os.getenv('GSUTIL_TMP_LOCATION',
                           os.path.expanduser('~') + '/.gsutil-wrapper/')
+# equivalent keys in other regions, used alongside the configured key
+_REPLICA_KEYS = os.getenv('GSUTIL_KMS_REPLICA_KEYS', '').split()
+# wrapped data keys to keep ready for new files; 0 wraps each one on demand
+_KEY_POOL_SIZE = int(os.getenv('GSUTIL_KEY_POOL_SIZE', '0'))
+# pooled keys older than this many seconds are discarded unused
+_KEY_POOL_MAX_AGE = 3600
+# longest wait, in seconds, before the pool retries after a failed refill
+_KEY_POOL_MAX_BACKOFF = 60
+# implementation of the data key AES-GCM: 'tink', or 'cryptography' to
+# encrypt on many threads at once
+_AEAD_BACKEND = os.getenv('GSUTIL_AEAD_BACKEND', 'tink')
+_AEAD_BACKENDS = ('tink', 'cryptography')
+# threads encrypting the segments of one file; more than one only helps with
+# the cryptography backend
+_ENCRYPT_WORKERS = int(os.getenv('GSUTIL_ENCRYPT_WORKERS', '1'))
+# custom metadata holding a copy of the wrapped data key, so the key can be
+# rotated without rewriting the object
+KEY_URI_METADATA = 'client-side-encryption-key'
+WRAPPED_KEY_METADATA = 'client-side-encryption-wrapped-key'
+
+
+def key_metadata(header):
+  """Custom metadata recording which KMS key wrapped an object's data key.
+
+  Args:
+    header: Header of the object's ciphertext
+
+  Returns:
+    metadata: dict of custom metadata to set on the object
+  """
+  return {
+      KEY_URI_METADATA: header.key_uri,
+      WRAPPED_KEY_METADATA: base64.b64encode(header.wrapped_key).decode('ascii')
+  }
+
+
+def kms_error(kms_failure):
+  """Describe a failed KMS call as a KmsError.
+
+  Args:
+    kms_failure: TinkError raised by the KMS AEAD
+
+  Returns:
+    KmsError: retryable if KMS failed transiently or its circuit is open
+  """
+  return errors.KmsError(
+      str(kms_failure),
+      retryable=isinstance(kms_failure, kms.CircuitOpenError) or
+      kms.is_retryable(kms_failure))
+
+
+def decryption_error(decryption_failure):
+  """Describe a failed decryption as an IntegrityError or KmsError.
+
+  Legacy ciphertext is decrypted in one call that also unwraps its data key,
+  so a transient KMS failure can surface here too.
+
+  Args:
+    decryption_failure: TinkError raised while decrypting
+
+  Returns:
+    EncryptionWrapperError: KmsError if KMS failed transiently, otherwise
+      IntegrityError
+  """
+  # Tink reports tampered ciphertext as an INTERNAL error, which would
+  # otherwise pass for a transient KMS failure
+  if 'authentication failed' not in str(decryption_failure).lower():
+    retryable_kms_error = kms_error(decryption_failure)
+    if retryable_kms_error.retryable:
+      return retryable_kms_error
+  return errors.IntegrityError(str(decryption_failure))
+
+
+def rotated_header(header, metadata):
+  """Replace a header's wrapped data key with the copy in the metadata.
+
+  Args:
+    header: Header read from the ciphertext
+    metadata: the object's custom metadata, or None
+
+  Returns:
+    Header: header with the data key wrapped by the current key
+  """
+  if not metadata or WRAPPED_KEY_METADATA not in metadata:
+    return header
+  return streaming.Header(header.segment_size, metadata[KEY_URI_METADATA],
+                          base64.b64decode(metadata[WRAPPED_KEY_METADATA]))
+
+
+class DataKeyPool(object):
+  """Data keys generated and wrapped by KMS ahead of time.
+
+  A background thread refills the pool to high whenever it drops below low,
+  so taking a key normally costs no KMS round trip. Every key is handed out
+  once. If the pool is empty, a key is generated and wrapped on the spot.
+  """
+
+  def __init__(self, router, template, high, low=None):
+    """Init class for DataKeyPool.
+
+    Args:
+      router: kms.KeyRouter to wrap the keys with
+      template: Tink key template of the data keys
+      high: number of keys the pool is filled up to
+      low: refill when fewer keys than this are left, defaults to half of high
+
+    Returns:
+      None
+    """
+    self.router = router
+    self.template = template
+    self.high = high
+    self.low = max(1, high // 2) if low is None else low
+    # (created, key_data, key_uri, wrapped_key), oldest first
+    self._keys = collections.deque()
+    self._wanted = threading.Condition()
+    self._producer = threading.Thread(target=self._fill, daemon=True)
+    self._producer.start()
+
+  def take(self):
+    """Take a data key out of the pool.
+
+    Returns:
+      (key_data, key_uri, wrapped_key): the key, the KMS key that wrapped it
+        and the wrapped key
+    """
+    key = None
+    with self._wanted:
+      while self._keys and key is None:
+        created, key_data, key_uri, wrapped_key = self._keys.popleft()
+        if time.monotonic() - created < _KEY_POOL_MAX_AGE:
+          key = (key_data, key_uri, wrapped_key)
+      if len(self._keys) < self.low:
+        self._wanted.notify()
+    return key or self._generate()[1:]
+
+  def size(self):
+    """Return the number of keys ready in the pool."""
+    with self._wanted:
+      return len(self._keys)
+
+  def _fill(self):
+    """Refill the pool from low to high, forever."""
+    attempt = 0
+    while True:
+      with self._wanted:
+        self._wanted.wait_for(lambda: len(self._keys) < self.low)
+      try:
+        while self.size() < self.high:
+          key = self._generate()
+          with self._wanted:
+            self._keys.append(key)
+        attempt = 0
+      except Exception as fill_error:  # pylint: disable=broad-except
+        # the thread must survive anything; callers wrap keys themselves
+        # until the pool can be refilled again
+        logging.getLogger(__name__).warning(
+            'refilling the data key pool failed: %s', fill_error)
+        time.sleep(random.uniform(0, min(_KEY_POOL_MAX_BACKOFF, 2**attempt)))
+        attempt += 1
+
+  def _generate(self):
+    """Generate a data key and wrap it."""
+    key_data = core.Registry.new_key_data(self.template)
+    key_uri, wrapped_key = self.router.wrap(key_data.value)
+    return time.monotonic(), key_data, key_uri, wrapped_key
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_key_pool(router, template, high):
+  """Return the shared DataKeyPool for a router and template.
+
+  The pool is started on first use.
+
+  Args:
+    router: kms.KeyRouter to wrap the keys with
+    template: Tink key template of the data keys
+    high: number of keys the pool is filled up to
+
+  Returns:
+    DataKeyPool: pool shared by every caller with the same router, template
+      and size
+  """
+  # the pool holds on to the router, so its id isn't reused while cached
+  pool_key = (id(router), template.SerializeToString(), high)
+  with _POOLS_LOCK:
+    pool = _POOLS.get(pool_key)
+    if pool is None:
+      pool = DataKeyPool(router, template, high)
+      _POOLS[pool_key] = pool
+    return pool
 
 
 class EncryptWithTink(object):
   """Perform local encryption and decryption with Tink."""
 
-  def __init__(self, key_uri, creds, tmp_location=_TMP_LOCATION):
+  def __init__(self, key_uri, creds, tmp_location=_TMP_LOCATION,
+               backend=None, workers=None):
     """Init class for EncryptWithTink.
 
+    Data keys are wrapped by whichever of the keys currently answers
+    fastest, and unwrapped by the key that wrapped them. Either backend
+    reads and writes the same ciphertexts; the cryptography backend releases
+    the GIL while it encrypts, so a thread pool uses every core.
+
     Args:
-      key_uri: string with the resource identifier for the KMS symmetric key
+      key_uri: string with the resource identifier for the KMS symmetric key,
+        or a list of equivalent keys in different regions, preferred first.
+        Keys listed in GSUTIL_KMS_REPLICA_KEYS are added to these.
       creds: path to the creds.json file with the service account key for KMS
       tmp_location: temporary directory for encryption and decryption
+      backend: 'tink' or 'cryptography', the implementation of the data keys'
+        AES-GCM; defaults to GSUTIL_AEAD_BACKEND
+      workers: threads encrypting the segments of each file, defaults to
+        GSUTIL_ENCRYPT_WORKERS
 
     Returns:
       None
     """
 
+    self.backend = backend or _AEAD_BACKEND
+    self.workers = workers or _ENCRYPT_WORKERS
+    if self.backend not in _AEAD_BACKENDS:
+      raise errors.ConfigurationError(
+          'unknown AEAD backend {}, expected one of {}'.format(
+              self.backend, ', '.join(_AEAD_BACKENDS)))
+    key_uris = [key_uri] if isinstance(key_uri, str) else list(key_uri)
+    self.key_uris = list(dict.fromkeys(key_uris + _REPLICA_KEYS))
+    self.key_uri = self.key_uris[0]
     self.tmp_location = tmp_location
     # Make the tmp dir if it doesn't exist
     if not os.path.isdir(self.tmp_location):
@@ -58,18 +286,106 @@ class EncryptWithTink(object):
         # This is ok because the directory already exists
         pass
       except OSError as os_error:
-        error_and_exit(str(os_error))
+        raise errors.LocalFileError(str(os_error)) from os_error
 
-    # Initialize Tink
+    # Initialize Tink. The KMS AEADs are shared with every other instance
+    # using the same keys so concurrent calls are coalesced and rate limited
+    # together, and their latencies are measured together
     try:
       aead.register()
       self.key_template = aead.aead_key_templates.AES128_EAX
       self.keyset_handle = tink.new_keyset_handle(self.key_template)
-      gcp_client = gcpkms.GcpKmsClient(key_uri, creds)
-      gcp_aead = gcp_client.get_aead(key_uri)
-      self.env_aead = aead.KmsEnvelopeAead(self.key_template, gcp_aead)
+      # data keys for the segmented format are AES-GCM
+      self.data_key_template = aead.aead_key_templates.AES256_GCM
+      self.router = kms.get_router(self.key_uris, creds)
+      self.remote_aead = self.router.aead_for(self.key_uri)
+      self.key_pool = None
+      if _KEY_POOL_SIZE > 0:
+        self.key_pool = get_key_pool(self.router, self.data_key_template,
+                                     _KEY_POOL_SIZE)
+      # only used to decrypt files written before the segmented format
+      self.env_aead = aead.KmsEnvelopeAead(self.key_template,
+                                           self.remote_aead)
     except TinkError as tink_init_error:
-      error_and_exit('tink initialization failed: ' + str(tink_init_error))
+      raise errors.ConfigurationError('tink initialization failed: ' +
+                                      str(tink_init_error)) from tink_init_error
+
+  @profiling.timed('kms: new data key')
+  def new_cipher(self, segment_size=streaming.SEGMENT_SIZE):
+    """Generate a data key, wrap it with KMS and return its cipher.
+
+    Args:
+      segment_size: plaintext bytes per segment
+
+    Returns:
+      SegmentCipher: cipher for a new segmented ciphertext
+
+    Raises:
+      KmsError: if the data key couldn't be wrapped
+    """
+    try:
+      if self.key_pool is not None:
+        key_data, key_uri, wrapped_key = self.key_pool.take()
+      else:
+        key_data = core.Registry.new_key_data(self.data_key_template)
+        key_uri, wrapped_key = self.router.wrap(key_data.value)
+    except TinkError as kms_failure:
+      raise kms_error(kms_failure) from kms_failure
+    header = streaming.Header(segment_size, key_uri, wrapped_key)
+    return streaming.SegmentCipher(header, self.data_aead(key_data))
+
+  @profiling.timed('kms: unwrap data key')
+  def cipher_for(self, header):
+    """Unwrap the data key of an existing ciphertext with KMS.
+
+    Args:
+      header: Header read from the ciphertext
+
+    Returns:
+      SegmentCipher: cipher for the ciphertext's segments
+
+    Raises:
+      KmsError: if the data key couldn't be unwrapped
+    """
+    try:
+      data_key = self.router.aead_for(header.key_uri).decrypt(
+          header.wrapped_key, b'')
+    except TinkError as kms_failure:
+      raise kms_error(kms_failure) from kms_failure
+    key_data = tink_pb2.KeyData(
+        type_url=self.data_key_template.type_url,
+        value=data_key,
+        key_material_type=tink_pb2.KeyData.SYMMETRIC)
+    return streaming.SegmentCipher(header, self.data_aead(key_data))
+
+  def data_aead(self, key_data):
+    """Return the AEAD for a data key, from the configured backend.
+
+    Args:
+      key_data: Tink KeyData of an AES-GCM data key
+
+    Returns:
+      Aead: AEAD encrypting and decrypting with the key
+    """
+    if self.backend == 'cryptography':
+      return aesgcm.AesGcm(key_data)
+    return core.Registry.primitive(key_data, aead.Aead)
+
+  def resolve_header(self, header, get_metadata=None):
+    """Find the copy of a ciphertext's data key that one of our keys wraps.
+
+    Args:
+      header: Header read from the ciphertext
+      get_metadata: function returning the object's custom metadata. Only
+        called when the data key was wrapped by a key we don't use, which
+        happens after the key has been rotated.
+
+    Returns:
+      Header: header whose wrapped key to unwrap
+    """
+    if header.key_uri not in self.key_uris and get_metadata is not None:
+      header = rotated_header(header, get_metadata())
+    return header
 
   def encrypt(self, filepath):
     """encrypt a file locally.
@@ -82,58 +398,141 @@ class EncryptWithTink(object):
     """
     # TODO(b/170396289): handle wildcards and recursive copies
 
-    # file type validation; can't handle directories or FIFOs
-    if os.path.isdir(filepath):
-      error_and_exit('cannot encrypt a directory')
-    elif stat.S_ISFIFO(os.stat(filepath).st_mode):
-      error_and_exit('cannot encrypt a FIFO')
-
-    # tmp location and name for the encrypted file
+    # tmp location and name for the encrypted file. The file keeps its name,
+    # which gsutil uses to name the object, in a directory of its own so
+    # concurrent operations on files with the same name don't collide
     filename = os.path.basename(filepath)
-    encrypted_filepath = self.tmp_location + '/' + filename
+    encrypted_filepath = os.path.join(
+        tempfile.mkdtemp(dir=self.tmp_location), filename)
+    self.encrypt_file(filepath, encrypted_filepath)
+    return encrypted_filepath
+
+  @contextlib.contextmanager
+  def scratch_path(self, filename):
+    """Reserve a path for one operation's scratch file.
+
+    The path is in a new directory of its own under tmp_location, readable
+    only by the current user, which is removed with everything in it when
+    the context exits. Nothing else is removed, so any number of operations
+    can use the same tmp_location at once.
+
+    Args:
+      filename: name for the scratch file
+
+    Yields:
+      path: path to use for the scratch file
+    """
+    directory = tempfile.mkdtemp(dir=self.tmp_location)
     try:
-      shutil.copyfile(filepath, encrypted_filepath)
-    except OSError as copy_error:
-      error_and_exit(str(copy_error))
+      yield os.path.join(directory, filename)
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+
+  @profiling.timed('encrypt file')
+  def encrypt_file(self, filepath, encrypted_filepath):
+    """encrypt a file to a given path, computing the ciphertext's CRC32C.
+
+    The file is streamed through the cipher segment by segment so memory use
+    doesn't grow with its size, and the checksum is computed on the same pass.
+
+    Args:
+      filepath: path to the file to be encrypted
+      encrypted_filepath: path to write the ciphertext to
+
+    Returns:
+      crc32c: CRC32C of the ciphertext, as an integer
+
+    Raises:
+      LocalFileError: if the file can't be read or the ciphertext written
+      KmsError: if the data key couldn't be wrapped
+    """
+
+    # file type validation; can't handle directories or FIFOs
+    if os.path.isdir(filepath):
+      raise errors.LocalFileError('cannot encrypt a directory')
+    elif os.path.exists(filepath) and stat.S_ISFIFO(os.stat(filepath).st_mode):
+      raise errors.LocalFileError('cannot encrypt a FIFO')
 
-    # read the file, encrypt it, write it to the tmp location
     try:
-      with open(filepath, 'rb') as f:
-        plaintext = f.read()
-      ciphertext = self.env_aead.encrypt(plaintext, b'')
-      with open(encrypted_filepath, 'wb') as f:
-        f.write(ciphertext)
+      with open(filepath, 'rb') as plaintext, \
+          open(encrypted_filepath, 'wb') as ciphertext:
+        # only wrap a data key with KMS once the files are known to open
+        cipher = self.new_cipher()
+        checksummed = streaming.Crc32cWriter(ciphertext)
+        cipher.encrypt_stream(plaintext, checksummed, workers=self.workers)
+    except OSError as write_error:
+      raise errors.LocalFileError(str(write_error)) from write_error
     except TinkError as encryption_error:
-      error_and_exit(str(encryption_error))
+      raise errors.EncryptionWrapperError(
+          str(encryption_error)) from encryption_error
 
-    return encrypted_filepath
+    return checksummed.crc32c
 
-  def decrypt(self, filepath):
+  def decrypt(self, filepath, get_metadata=None):
     """decrypt a file locally.
 
     Args:
       filepath: path to the file to be decrypted
+      get_metadata: function returning the object's custom metadata. Only
+        called when the file's data key was wrapped by a different KMS key,
+        which happens after the key has been rotated.
 
     Returns:
       decrypted_filepath: path to the locally decrypted file
+
+    Raises:
+      LocalFileError: if the file can't be read or the plaintext written
     """
 
-    # filename and paths to tmp directory
-    filename = os.path.basename(filepath)
-    decrypted_filepath = self.tmp_location + '/' + filename
+    # decrypt the ciphertext to a scratch file, then overwrite the encrypted
+    # file with the decrypted file, finally remove the scratch file
+    with self.scratch_path(os.path.basename(filepath)) as decrypted_filepath:
+      try:
+        with open(filepath, 'rb') as ciphertext, \
+            open(decrypted_filepath, 'wb') as cleartext:
+          self.decrypt_from(
+              lambda writer: shutil.copyfileobj(ciphertext, writer), cleartext,
+              get_metadata)
+        shutil.copyfile(decrypted_filepath, filepath)
+      except OSError as os_error:
+        raise errors.LocalFileError(str(os_error)) from os_error
+
+    return decrypted_filepath
+
+  @profiling.timed('download and decrypt')
+  def decrypt_from(self, download, destination, get_metadata=None):
+    """decrypt ciphertext as it is produced, computing its CRC32C.
 
-    # read the ciphertext, decrypt it, write it to the tmp location, then
-    # overwrite the encrypted file with the decrypted file, finally remove
-    # the encrypted file from the tmp location
+    Args:
+      download: function that writes the ciphertext to the file object it is
+        given, e.g. a GCS download
+      destination: binary file object the plaintext is written to
+      get_metadata: function returning the object's custom metadata. Only
+        called when the data key was wrapped by a different KMS key, which
+        happens after the key has been rotated.
+
+    Returns:
+      crc32c: CRC32C of the ciphertext, as an integer
+
+    Raises:
+      IntegrityError: if the ciphertext is malformed, truncated or fails
+        authentication
+      KmsError: if the data key couldn't be unwrapped
+    """
+
+    def cipher_for(header):
+      return self.cipher_for(self.resolve_header(header, get_metadata))
+
+    def legacy_decrypt(ciphertext):
+      # legacy files are a single envelope and must be decrypted whole
+      return self.env_aead.decrypt(ciphertext, b'')
+
+    writer = streaming.DecryptingWriter(destination, cipher_for,
+                                        legacy_decrypt)
     try:
-      with open(filepath, 'rb') as f:
-        ciphertext = f.read()
-      cleartext = self.env_aead.decrypt(ciphertext, b'')
-      with open(decrypted_filepath, 'wb') as f:
-        f.write(cleartext)
-      shutil.copyfile(decrypted_filepath, filepath)
-      os.unlink(decrypted_filepath)
-    except TinkError as decryption_error:
-      error_and_exit(str(decryption_error))
+      download(writer)
+      writer.close()
+    except TinkError as decryption_failure:
+      raise decryption_error(decryption_failure) from decryption_failure
 
-    return decrypted_filepath
+    return writer.crc32c
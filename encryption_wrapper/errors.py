@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Exceptions raised by the encryption wrappers.
+
+Everything the library raises for a failed operation is an
+EncryptionWrapperError, so a worker pool can catch that, skip or retry the
+item and carry on with its clients and KMS connections intact. Each error
+says whether trying the same operation again may succeed. Only the gsutil
+command line wrapper turns errors into exit codes.
+"""
+
+
+class EncryptionWrapperError(Exception):
+  """Base class of every error raised by encryption_wrapper."""
+
+  # whether trying the same operation again may succeed
+  retryable = False
+
+  def __init__(self, message, retryable=None):
+    """Init class for EncryptionWrapperError.
+
+    Args:
+      message: description of what went wrong
+      retryable: override the class's retryable
+
+    Returns:
+      None
+    """
+    super().__init__(message)
+    if retryable is not None:
+      self.retryable = retryable
+
+
+class ConfigurationError(EncryptionWrapperError):
+  """The wrapper was set up with an invalid option or couldn't start."""
+
+
+class KmsError(EncryptionWrapperError):
+  """Cloud KMS failed to wrap or unwrap a data key.
+
+  Retryable when KMS reported a transient failure, such as quota, a
+  deadline or an open circuit breaker; not when the key is missing or
+  access is denied.
+  """
+
+
+class IntegrityError(EncryptionWrapperError):
+  """Ciphertext failed authentication, was truncated or is malformed.
+
+  Retrying doesn't help when the stored object is bad. Checksum mismatches
+  between what was sent and what GCS received are retryable.
+  """
+
+
+class LocalFileError(EncryptionWrapperError):
+  """A local file couldn't be read, written or encrypted."""
+
+
+class ArchiveError(EncryptionWrapperError):
+  """An archive member is missing or its name is already taken."""
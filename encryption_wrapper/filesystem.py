@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""fsspec filesystem for client-side encrypted GCS objects.
+
+Importing this module registers the gcs-cse:// protocol, so pandas, Dask,
+pyarrow and anything else that opens files through fsspec can read and
+write encrypted objects directly:
+
+  import pandas as pd
+  from encryption_wrapper import filesystem  # registers gcs-cse://
+
+  df = pd.read_parquet('gcs-cse://my-bucket/data.parquet',
+                       storage_options={'key_uri': KEY_URI,
+                                        'creds': 'creds.json'})
+
+Sizes are plaintext sizes, worked out from each object's ciphertext header
+with a small ranged read and no KMS call. Reads fetch and decrypt only the
+segments holding the bytes asked for, so reading a Parquet footer or a few
+columns doesn't download the whole object. Writes are encrypted segment by
+segment and streamed to GCS as they happen.
+"""
+
+import concurrent.futures
+import io
+
+from encryption_wrapper import blobio
+from encryption_wrapper import errors
+from encryption_wrapper import streaming
+from encryption_wrapper.storage import Client
+
+import fsspec
+from fsspec.spec import AbstractBufferedFile, AbstractFileSystem
+from google.api_core import exceptions
+from tink.core import TinkError
+
+
+# header reads in flight at once while listing
+_LIST_WORKERS = 32
+
+
+def plaintext_size(blob, client):
+  """Work out an encrypted object's plaintext size from its header.
+
+  Args:
+    blob: Blob with its size, e.g. from a listing
+    client: Client to read the header with
+
+  Returns:
+    size: plaintext bytes, or None for objects in the legacy format, whose
+      size is only known once they are decrypted
+  """
+  if not blob.size:
+    return None
+  try:
+    header, _ = streaming.read_header(blob, client)
+    return header.plaintext_size(blob.size) if header is not None else None
+  except (errors.IntegrityError, TinkError):
+    # listings go on past malformed objects; reading them fails instead
+    return None
+
+
+class EncryptedGCSFileSystem(AbstractFileSystem):
+  """Client-side encrypted GCS objects as an fsspec filesystem.
+
+  Paths are bucket/object, with or without the gcs-cse:// prefix. As in
+  gcsfs, directories are the prefixes of object names up to a slash.
+  """
+
+  protocol = ('gcs-cse',)
+  root_marker = ''
+
+  def __init__(self, key_uri=None, creds=None, client=None, **kwargs):
+    """Init class for EncryptedGCSFileSystem.
+
+    Args:
+      key_uri: string with the resource identifier for the KMS symmetric key,
+        or a list of equivalent keys in different regions
+      creds: path to the creds.json file with the service account key for KMS
+      client: wrapped Client to use instead of creating one from key_uri and
+        creds
+      **kwargs: passed to AbstractFileSystem
+
+    Returns:
+      None
+    """
+    super().__init__(**kwargs)
+    self.client = client or Client(key_uri, creds)
+
+  def split_path(self, path):
+    """Split a path into its bucket and object name."""
+    bucket, _, name = self._strip_protocol(path).partition('/')
+    return bucket, name
+
+  def ls(self, path, detail=True, **kwargs):
+    path = self._strip_protocol(path).rstrip('/')
+    if path not in self.dircache:
+      self.dircache[path] = self._list(path)
+    entries = self.dircache[path]
+    if detail:
+      return entries
+    return [entry['name'] for entry in entries]
+
+  def info(self, path, **kwargs):
+    path = self._strip_protocol(path).rstrip('/')
+    bucket, name = self.split_path(path)
+    if name:
+      blob = self.client.bucket(bucket).blob(name)
+      try:
+        blob.reload(client=self.client)
+        return self._file_entry(blob, True)
+      except exceptions.NotFound:
+        pass
+      prefix = name + '/'
+      if list(self.client.list_blobs(bucket, prefix=prefix, max_results=1)):
+        return {'name': path, 'type': 'directory', 'size': 0}
+    elif bucket and self.client.lookup_bucket(bucket) is not None:
+      return {'name': path, 'type': 'directory', 'size': 0}
+    raise FileNotFoundError(path)
+
+  def rm_file(self, path):
+    bucket, name = self.split_path(path)
+    try:
+      self.client.bucket(bucket).delete_blob(name, client=self.client)
+    except exceptions.NotFound:
+      raise FileNotFoundError(path)
+    self.invalidate_cache(self._parent(path))
+
+  def _rm(self, path):
+    self.rm_file(path)
+
+  def cp_file(self, path1, path2, **kwargs):
+    # the ciphertext is self-contained, so GCS copies it with its metadata
+    bucket1, name1 = self.split_path(path1)
+    bucket2, name2 = self.split_path(path2)
+    source = self.client.bucket(bucket1)
+    source.copy_blob(source.blob(name1), self.client.bucket(bucket2), name2,
+                     client=self.client)
+    self.invalidate_cache(self._parent(path2))
+
+  def invalidate_cache(self, path=None):
+    if path is None:
+      self.dircache.clear()
+    else:
+      self.dircache.pop(self._strip_protocol(path).rstrip('/'), None)
+
+  def _open(self,
+            path,
+            mode='rb',
+            block_size=None,
+            autocommit=True,
+            cache_options=None,
+            **kwargs):
+    if mode not in ('rb', 'wb'):
+      raise NotImplementedError('mode must be rb or wb, not ' + repr(mode))
+    if mode == 'wb':
+      self.invalidate_cache(self._parent(path))
+    return EncryptedFile(self, path, mode, block_size, autocommit,
+                         cache_options=cache_options, **kwargs)
+
+  def _list(self, path):
+    """List a directory, or the buckets at the root."""
+    if not path:
+      return [{'name': bucket.name, 'type': 'directory', 'size': 0}
+              for bucket in self.client.list_buckets()]
+    bucket, name = self.split_path(path)
+    prefix = name + '/' if name else None
+    iterator = self.client.list_blobs(bucket, prefix=prefix, delimiter='/')
+    blobs = [blob for blob in iterator if blob.name != prefix]
+    with concurrent.futures.ThreadPoolExecutor(_LIST_WORKERS) as executor:
+      entries = list(executor.map(self._file_entry, blobs))
+    entries.extend({
+        'name': bucket + '/' + directory.rstrip('/'),
+        'type': 'directory',
+        'size': 0
+    } for directory in sorted(iterator.prefixes))
+    if not entries and name and not self.exists(path):
+      raise FileNotFoundError(path)
+    return entries
+
+  def _file_entry(self, blob, need_size=False):
+    """Describe an object, with its plaintext size.
+
+    Args:
+      blob: Blob with its properties loaded
+      need_size: decrypt a legacy object to find its size, rather than
+        report None
+
+    Returns:
+      entry: fsspec info dict
+    """
+    entry = {
+        'name': blob.bucket.name + '/' + blob.name,
+        'type': 'file',
+        'size': blob.size,
+        'ciphertext_size': blob.size,
+        'generation': blob.generation,
+        'updated': blob.updated,
+        'encrypted': (blob.metadata or {}).get('client-side-encrypted') ==
+                     'true'
+    }
+    if entry['encrypted']:
+      entry['size'] = plaintext_size(blob, self.client)
+      if entry['size'] is None and need_size:
+        entry['size'] = blobio.EncryptedReader(self._blob(entry),
+                                               self.client).size
+    return entry
+
+  def _blob(self, entry):
+    """Wrapped Blob pinned to the generation an entry describes."""
+    bucket, name = self.split_path(entry['name'])
+    blob = self.client.bucket(bucket).blob(name,
+                                           generation=entry['generation'])
+    blob._properties['size'] = str(entry['ciphertext_size'])  # pylint: disable=protected-access
+    return blob
+
+
+class EncryptedFile(AbstractBufferedFile):
+  """File object for one encrypted object, opened through fsspec."""
+
+  # one segment, so a small read fetches one segment
+  DEFAULT_BLOCK_SIZE = streaming.SEGMENT_SIZE
+
+  def __init__(self, fs, path, mode='rb', block_size='default',
+               autocommit=True, **kwargs):
+    """Init class for EncryptedFile.
+
+    Args:
+      fs: EncryptedGCSFileSystem the file belongs to
+      path: bucket/object path
+      mode: 'rb' or 'wb'
+      block_size: bytes read from GCS at a time, or buffered before writing
+      autocommit: must be True; objects are created when the file is closed
+      **kwargs: cache_type and cache_options for reading; content_type,
+        predefined_acl, the if_generation_* and if_metageneration_*
+        preconditions and timeout for writing
+
+    Returns:
+      None
+    """
+    self.reader = None
+    self.writer = None
+    self.upload_options = {
+        key: kwargs.pop(key)
+        for key in list(kwargs)
+        if key == 'content_type' or key == 'predefined_acl' or
+        key == 'timeout' or key.startswith('if_')
+    }
+    super().__init__(fs, path, mode, block_size, autocommit, **kwargs)
+
+  def _fetch_range(self, start, end):
+    """Decrypt the plaintext from start up to end."""
+    if self.reader is None:
+      self.reader = blobio.EncryptedReader(self.fs._blob(self.details),  # pylint: disable=protected-access
+                                           self.fs.client)
+    end = min(end, self.reader.size)
+    if start >= end:
+      return b''
+    if self.reader.legacy is None:
+      # fetch every segment of the range in one ranged GET
+      segment_size = self.reader.cipher.header.segment_size
+      self.reader.readahead = (end - 1) // segment_size - \
+          start // segment_size + 1
+    self.reader.seek(start)
+    data = bytearray()
+    while len(data) < end - start:
+      chunk = self.reader.read(end - start - len(data))
+      if not chunk:
+        break
+      data += chunk
+    return bytes(data)
+
+  def _initiate_upload(self):
+    self.writer = blobio.EncryptedWriter(
+        self.fs.client.bucket(self.fs.split_path(self.path)[0]).blob(
+            self.fs.split_path(self.path)[1]), self.fs.client,
+        **self.upload_options)
+
+  def _upload_chunk(self, final=False):
+    self.writer.write(self.buffer.getvalue())
+    if final:
+      self.writer.close()
+    return True
+
+  def discard(self):
+    """Give up on a write; the object is not created or replaced."""
+    if self.writer is not None:
+      self.writer.abort()
+    self.buffer = io.BytesIO()
+    self.closed = True
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None and self.mode == 'wb':
+      self.discard()
+    else:
+      self.close()
+
+
+fsspec.register_implementation('gcs-cse', EncryptedGCSFileSystem, clobber=True)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local SQLite index of client-side encrypted objects.
+
+One row per object records its generation, the KMS key wrapping its data
+key, the encryption format, its plaintext and ciphertext sizes and its
+fingerprint, the CRC32C of the ciphertext that GCS reports. The fingerprint
+is the same for every copy of one ciphertext and doesn't change when the key
+is rotated, so it tells whether two objects, or an object and the row that
+was recorded for it, hold the same data.
+
+Wrapped Clients given an index keep it up to date on every encrypted upload,
+and key rotation updates it on every rewrap, so which objects are encrypted,
+with which key, and whether a generation is still current are answered
+locally instead of with a request per object. Changes made by anything else,
+deletions included, are picked up by rebuilding from a bucket listing.
+
+Usage:
+  python3 -m encryption_wrapper.index --index PATH --bucket BUCKET \\
+      [--prefix PREFIX] [--workers N] [--key_uri KEY_URI] [--rebuild]
+"""
+
+import argparse
+import concurrent.futures
+import sqlite3
+import sys
+import threading
+
+from encryption_wrapper import encryption
+from encryption_wrapper import errors
+from encryption_wrapper import streaming
+
+from google.api_core import exceptions
+from google.cloud import storage
+from tink.core import TinkError
+
+
+# values of the algorithm column
+SEGMENTED = 'AES256_GCM_SEGMENTED'
+LEGACY = 'KMS_ENVELOPE_AES128_EAX'
+_WORKERS = 64
+# seconds to wait for another process writing to the same index
+_LOCK_TIMEOUT = 30
+_COLUMNS = ('bucket', 'name', 'generation', 'key_uri', 'algorithm',
+            'plaintext_size', 'ciphertext_size', 'fingerprint', 'updated')
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+  bucket TEXT NOT NULL,
+  name TEXT NOT NULL,
+  generation INTEGER,
+  key_uri TEXT,
+  algorithm TEXT NOT NULL,
+  plaintext_size INTEGER,
+  ciphertext_size INTEGER,
+  fingerprint TEXT,
+  updated TEXT,
+  PRIMARY KEY (bucket, name)
+);
+CREATE INDEX IF NOT EXISTS objects_by_key ON objects (key_uri);
+"""
+
+
+class ObjectIndex(object):
+  """SQLite index of encrypted objects, safe to share between threads."""
+
+  def __init__(self, path):
+    """Init class for ObjectIndex.
+
+    Args:
+      path: SQLite database file, created if it doesn't exist
+
+    Returns:
+      None
+    """
+    self.path = path
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(path, timeout=_LOCK_TIMEOUT,
+                                      check_same_thread=False)
+    self.connection.row_factory = sqlite3.Row
+    with self.lock, self.connection:
+      self.connection.executescript(_SCHEMA)
+
+  def close(self):
+    """Close the database."""
+    with self.lock:
+      self.connection.close()
+
+  def record(self, blob, plaintext_size=None):
+    """Record an object after an encrypted upload.
+
+    Args:
+      blob: Blob with the properties GCS returned for the upload
+      plaintext_size: bytes of plaintext that were uploaded
+
+    Returns:
+      None
+    """
+    metadata = blob.metadata or {}
+    key_uri = metadata.get(encryption.KEY_URI_METADATA)
+    # objects uploaded by this version always carry their key in the
+    # metadata; the rest are only known from their ciphertext
+    self._put([
+        _row(blob, key_uri, SEGMENTED if key_uri else LEGACY, plaintext_size)
+    ])
+
+  def record_rewrap(self, bucket_name, name, generation, key_uri):
+    """Record that an object's data key is now wrapped by another key.
+
+    Args:
+      bucket_name: the object's bucket
+      name: the object's name
+      generation: generation whose metadata was patched
+      key_uri: resource identifier of the KMS key now wrapping the data key
+
+    Returns:
+      None
+    """
+    with self.lock, self.connection:
+      self.connection.execute(
+          'UPDATE objects SET key_uri = ? '
+          'WHERE bucket = ? AND name = ? AND generation = ?',
+          (key_uri, bucket_name, name, _generation(generation)))
+
+  def remove(self, bucket_name, name):
+    """Forget an object, e.g. after deleting it."""
+    with self.lock, self.connection:
+      self.connection.execute(
+          'DELETE FROM objects WHERE bucket = ? AND name = ?',
+          (bucket_name, name))
+
+  def get(self, bucket_name, name):
+    """Look up one object.
+
+    Args:
+      bucket_name: the object's bucket
+      name: the object's name
+
+    Returns:
+      entry: dict with a key per column, or None if the object isn't indexed
+    """
+    with self.lock:
+      row = self.connection.execute(
+          'SELECT * FROM objects WHERE bucket = ? AND name = ?',
+          (bucket_name, name)).fetchone()
+    return dict(row) if row is not None else None
+
+  def is_current(self, bucket_name, name, generation):
+    """Tell whether a generation of an object is the one last recorded.
+
+    Args:
+      bucket_name: the object's bucket
+      name: the object's name
+      generation: generation to check, e.g. of a cached copy
+
+    Returns:
+      current: True if the index records this generation for the object
+    """
+    entry = self.get(bucket_name, name)
+    return entry is not None and entry['generation'] == _generation(generation)
+
+  def query(self, bucket_name, prefix=None, key_uri=None, algorithm=None):
+    """List indexed objects, in name order.
+
+    Args:
+      bucket_name: bucket to list
+      prefix: only objects whose names start with this
+      key_uri: only objects whose data key is wrapped by this KMS key
+      algorithm: only objects in this format, SEGMENTED or LEGACY
+
+    Returns:
+      entries: list with a dict per object, with a key per column
+    """
+    conditions = ['bucket = ?']
+    parameters = [bucket_name]
+    if prefix:
+      conditions.append('substr(name, 1, ?) = ?')
+      parameters.extend([len(prefix), prefix])
+    if key_uri is not None:
+      conditions.append('key_uri = ?')
+      parameters.append(key_uri)
+    if algorithm is not None:
+      conditions.append('algorithm = ?')
+      parameters.append(algorithm)
+    with self.lock:
+      rows = self.connection.execute(
+          'SELECT * FROM objects WHERE {} ORDER BY name'.format(
+              ' AND '.join(conditions)), parameters).fetchall()
+    return [dict(row) for row in rows]
+
+  def rebuild(self, client, bucket_name, prefix=None, workers=_WORKERS,
+              report=None):
+    """Replace the entries under a prefix with those from a bucket listing.
+
+    Every object marked as encrypted costs one ranged read of its header,
+    and no KMS calls, to find its plaintext size and current key.
+
+    Args:
+      client: google-cloud-storage Client, wrapped or not, to list with
+      bucket_name: bucket to index
+      prefix: only index objects whose names start with this
+      workers: number of headers read concurrently
+      report: function called with the gs:// URL and the error of every
+        object whose header couldn't be read; such objects aren't indexed
+
+    Returns:
+      count: number of encrypted objects indexed
+    """
+    with self.lock, self.connection:
+      if prefix:
+        self.connection.execute(
+            'DELETE FROM objects WHERE bucket = ? AND substr(name, 1, ?) = ?',
+            (bucket_name, len(prefix), prefix))
+      else:
+        self.connection.execute('DELETE FROM objects WHERE bucket = ?',
+                                (bucket_name,))
+    count = 0
+    blobs = client.list_blobs(bucket_name, prefix=prefix,
+                              page_size=streaming.LIST_PAGE_SIZE)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+      for page in blobs.pages:
+        encrypted = [
+            blob for blob in page
+            if (blob.metadata or {}).get('client-side-encrypted') == 'true'
+        ]
+        rows = []
+        for blob, (row, read_error) in zip(
+            encrypted,
+            executor.map(lambda blob: _listed_row(blob, client), encrypted)):
+          if row is not None:
+            rows.append(row)
+          elif read_error is not None and report is not None:
+            report('gs://{}/{}'.format(bucket_name, blob.name), read_error)
+        self._put(rows)
+        count += len(rows)
+    return count
+
+  def _put(self, rows):
+    """Insert or replace rows, in one transaction."""
+    with self.lock, self.connection:
+      self.connection.executemany(
+          'INSERT OR REPLACE INTO objects ({}) VALUES ({})'.format(
+              ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))), rows)
+
+
+def _generation(generation):
+  """Generations come back from the JSON API as strings."""
+  return int(generation) if generation is not None else None
+
+
+def _row(blob, key_uri, algorithm, plaintext_size):
+  """Values of the columns for an object, in _COLUMNS order."""
+  return (blob.bucket.name, blob.name, _generation(blob.generation), key_uri,
+          algorithm, plaintext_size, blob.size, blob.crc32c,
+          blob.updated.isoformat() if blob.updated is not None else None)
+
+
+def _listed_row(blob, client):
+  """Read an object's header and describe it for the index.
+
+  Args:
+    blob: Blob from the bucket listing, with its metadata
+    client: Client to read the header with
+
+  Returns:
+    (row, error): values of the columns, or None and the error if the header
+      couldn't be read
+  """
+  metadata = blob.metadata or {}
+  try:
+    header, _ = streaming.read_header(blob, client)
+    if header is None:
+      # the size of a single envelope is only known once it is decrypted
+      return _row(blob, metadata.get(encryption.KEY_URI_METADATA), LEGACY,
+                  None), None
+    header = encryption.rotated_header(header, metadata)
+    return _row(blob, header.key_uri, SEGMENTED,
+                header.plaintext_size(blob.size)), None
+  except (errors.IntegrityError, TinkError,
+          exceptions.GoogleAPICallError) as read_error:
+    return None, read_error
+
+
+def _print_failure(url, read_error):
+  print('failed to index {}: {}'.format(url, read_error), file=sys.stderr)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Query or rebuild the local index of client-side encrypted '
+      'objects.')
+  parser.add_argument('--index', required=True)
+  parser.add_argument('--bucket', required=True)
+  parser.add_argument('--prefix', default=None)
+  parser.add_argument('--workers', type=int, default=_WORKERS)
+  parser.add_argument('--key_uri', default=None)
+  parser.add_argument('--rebuild', action='store_true')
+  args = parser.parse_args()
+
+  index = ObjectIndex(args.index)
+  if args.rebuild:
+    count = index.rebuild(storage.Client(), args.bucket, args.prefix,
+                          args.workers, _print_failure)
+    print('indexed: {}'.format(count))
+  else:
+    for entry in index.query(args.bucket, args.prefix, args.key_uri):
+      print('gs://{}/{}\t{}\t{}\t{}'.format(entry['bucket'], entry['name'],
+                                            entry['generation'],
+                                            entry['key_uri'],
+                                            entry['plaintext_size']))
+  index.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cloud KMS access shared by every EncryptWithTink in the process.
+
+All callers using the same key share one KMS client. Identical unwrap requests
+that are in flight at the same time are coalesced into a single KMS call, the
+request rate is bounded by a token bucket and transient failures are retried
+with jittered exponential backoff. Every call has a deadline, a duplicate
+request is sent when a call takes longer than most recent ones did, and a
+circuit breaker fails calls fast while KMS keeps failing.
+
+A KeyRouter spreads data key wrapping over equivalent keys in several
+regions, sending each wrap to the key with the lowest measured latency.
+Unwrapping always goes to the key named in the ciphertext, since only that
+key can unwrap it.
+"""
+
+import collections
+import concurrent.futures
+import os
+import random
+import threading
+import time
+
+from tink import aead
+from tink.core import TinkError
+from tink.integration import gcpkms
+
+
+# Cloud KMS allows 60,000 cryptographic requests per minute per project by
+# default. Stay below that and let users tune the limits to their own quota.
+_KMS_RATE = float(os.getenv('GSUTIL_KMS_RATE', '900'))
+_KMS_BURST = int(os.getenv('GSUTIL_KMS_BURST', '100'))
+_KMS_MAX_IN_FLIGHT = int(os.getenv('GSUTIL_KMS_MAX_IN_FLIGHT', '32'))
+_KMS_RETRIES = int(os.getenv('GSUTIL_KMS_RETRIES', '5'))
+# seconds a single KMS request may take before it is abandoned and retried
+_KMS_DEADLINE = float(os.getenv('GSUTIL_KMS_DEADLINE', '10'))
+# percentile of recent latencies after which a duplicate request is sent; 0
+# turns hedging off
+_KMS_HEDGE_PERCENTILE = float(os.getenv('GSUTIL_KMS_HEDGE_PERCENTILE', '95'))
+# consecutive transient failures that open the circuit breaker, and seconds
+# it stays open before letting a request through to probe KMS again
+_KMS_BREAKER_FAILURES = int(os.getenv('GSUTIL_KMS_BREAKER_FAILURES', '5'))
+_KMS_BREAKER_SECONDS = float(os.getenv('GSUTIL_KMS_BREAKER_SECONDS', '30'))
+# recent latencies kept to pick the hedging delay, and how many are needed
+# before hedging starts
+_LATENCY_SAMPLES = 200
+_MIN_LATENCY_SAMPLES = 20
+_BACKOFF_BASE = 0.1
+_BACKOFF_CAP = 10.0
+# weight of the newest sample in a key's moving average latency
+_LATENCY_WEIGHT = 0.2
+# fraction of wraps sent to a random healthy key to keep its latency current
+_EXPLORE_RATE = 0.05
+# seconds a key that failed is skipped for wrapping
+_UNHEALTHY_SECONDS = 30.0
+
+# substrings of KMS errors that are worth retrying
+_RETRYABLE_ERRORS = ('unavailable', 'resource_exhausted', 'resource exhausted',
+                     'deadline_exceeded', 'deadline exceeded', 'aborted',
+                     'internal', 'quota', '429', '503')
+
+
+class TokenBucket(object):
+  """Thread-safe token bucket used to bound the rate of KMS requests."""
+
+  def __init__(self, rate, burst):
+    """Init class for TokenBucket.
+
+    Args:
+      rate: tokens added to the bucket per second
+      burst: maximum number of tokens the bucket can hold
+
+    Returns:
+      None
+    """
+    self.rate = rate
+    self.burst = burst
+    self._tokens = float(burst)
+    self._last = time.monotonic()
+    self._lock = threading.Lock()
+
+  def acquire(self):
+    """Take one token from the bucket, blocking until one is available."""
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        wait = (1 - self._tokens) / self.rate
+      time.sleep(wait)
+
+
+class CircuitOpenError(TinkError):
+  """Raised without calling KMS while the circuit breaker is open."""
+
+
+class CircuitBreaker(object):
+  """Fail fast after repeated transient KMS failures.
+
+  After failures consecutive transient failures the circuit opens and calls
+  fail immediately for reset_seconds. Then a single call is let through; if
+  it succeeds the circuit closes, otherwise it opens again.
+  """
+
+  def __init__(self,
+               failures=_KMS_BREAKER_FAILURES,
+               reset_seconds=_KMS_BREAKER_SECONDS):
+    """Init class for CircuitBreaker.
+
+    Args:
+      failures: consecutive transient failures that open the circuit
+      reset_seconds: seconds the circuit stays open before a probe call
+
+    Returns:
+      None
+    """
+    self.failures = failures
+    self.reset_seconds = reset_seconds
+    self._lock = threading.Lock()
+    self._consecutive = 0
+    self._open_until = None
+    self._probing = False
+
+  def check(self):
+    """Raise CircuitOpenError unless a call may go ahead."""
+    with self._lock:
+      if self._open_until is None:
+        return
+      if time.monotonic() < self._open_until or self._probing:
+        raise CircuitOpenError(
+            'KMS circuit breaker is open after {} consecutive failures'.format(
+                self._consecutive))
+      # half open: let this one call probe KMS
+      self._probing = True
+
+  def success(self):
+    """Record a successful call, closing the circuit."""
+    with self._lock:
+      self._consecutive = 0
+      self._open_until = None
+      self._probing = False
+
+  def failure(self):
+    """Record a transient failure, opening the circuit if there are enough."""
+    with self._lock:
+      self._consecutive += 1
+      if self._probing or self._consecutive >= self.failures:
+        self._open_until = time.monotonic() + self.reset_seconds
+      self._probing = False
+
+
+class _InFlight(object):
+  """A KMS call other threads can wait on instead of issuing their own."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+class _Attempt(object):
+  """The requests of one hedged call, and whether its caller still waits."""
+
+  def __init__(self):
+    # set once the first request is sent, or has ended without being sent
+    self.sent = threading.Event()
+    self.abandoned = False
+
+
+class KmsAead(aead.Aead):
+  """Tink AEAD that rate limits, retries and coalesces calls to a remote AEAD.
+
+  This is a drop in replacement for the AEAD returned by
+  gcpkms.GcpKmsClient.get_aead, so it can be handed to KmsEnvelopeAead.
+  """
+
+  def __init__(self,
+               remote,
+               bucket,
+               max_in_flight=_KMS_MAX_IN_FLIGHT,
+               retries=_KMS_RETRIES,
+               deadline=_KMS_DEADLINE,
+               hedge_percentile=_KMS_HEDGE_PERCENTILE,
+               breaker=None):
+    """Init class for KmsAead.
+
+    Args:
+      remote: the Tink AEAD that talks to Cloud KMS
+      bucket: TokenBucket shared by everything calling the same project
+      max_in_flight: maximum number of concurrent KMS requests
+      retries: number of times a retryable KMS failure is retried
+      deadline: seconds a request may take before it counts as failed
+      hedge_percentile: percentile of recent latencies after which a
+        duplicate request is sent, or 0 to never send one
+      breaker: CircuitBreaker for this key, defaults to a new one
+
+    Returns:
+      None
+    """
+    self.remote = remote
+    self.bucket = bucket
+    self.retries = retries
+    self.deadline = deadline
+    self.hedge_percentile = hedge_percentile
+    self.breaker = breaker or CircuitBreaker()
+    self._slots = threading.BoundedSemaphore(max_in_flight)
+    # requests run here so callers can stop waiting at the deadline; the
+    # slots above still bound how many reach KMS at once
+    self._executor = concurrent.futures.ThreadPoolExecutor(2 * max_in_flight)
+    self._latencies = collections.deque(maxlen=_LATENCY_SAMPLES)
+    self._lock = threading.Lock()
+    self._in_flight = {}
+
+  def encrypt(self, plaintext, associated_data):
+    """Wrap a data key with KMS.
+
+    Every data key is freshly generated, so wrap requests are never identical
+    and are not coalesced.
+
+    Args:
+      plaintext: bytes to encrypt
+      associated_data: associated data bound to the ciphertext
+
+    Returns:
+      ciphertext: the encrypted bytes
+    """
+    return self._call(self.remote.encrypt, plaintext, associated_data)
+
+  def decrypt(self, ciphertext, associated_data):
+    """Unwrap a data key with KMS, sharing identical in-flight requests.
+
+    Args:
+      ciphertext: bytes to decrypt
+      associated_data: associated data bound to the ciphertext
+
+    Returns:
+      plaintext: the decrypted bytes
+    """
+    key = (bytes(ciphertext), bytes(associated_data))
+    with self._lock:
+      call = self._in_flight.get(key)
+      leader = call is None
+      if leader:
+        call = _InFlight()
+        self._in_flight[key] = call
+
+    if not leader:
+      # another thread is already asking KMS for this exact unwrap
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = self._call(self.remote.decrypt, ciphertext,
+                               associated_data)
+      return call.result
+    except Exception as decryption_error:  # pylint: disable=broad-except
+      # waiting threads re-raise whatever the leader got
+      call.error = decryption_error
+      raise
+    finally:
+      with self._lock:
+        del self._in_flight[key]
+      call.done.set()
+
+  def _call(self, method, data, associated_data):
+    """Call the remote AEAD with rate limiting and jittered retries.
+
+    Args:
+      method: bound encrypt or decrypt method of the remote AEAD
+      data: bytes to pass to the method
+      associated_data: associated data to pass to the method
+
+    Returns:
+      result: bytes returned by the method
+    """
+    attempt = 0
+    while True:
+      self.breaker.check()
+      retryable = False
+      try:
+        result = self._hedged(method, data, associated_data)
+      except TinkError as kms_error:
+        retryable = is_retryable(kms_error)
+        if attempt >= self.retries or not retryable:
+          raise
+      finally:
+        # settle the breaker whatever happened, so a half-open circuit's
+        # probe is always released; KMS answering at all, even with an
+        # error that isn't transient, means it is reachable
+        if retryable:
+          self.breaker.failure()
+        else:
+          self.breaker.success()
+      if not retryable:
+        return result
+      # full jitter backoff, see
+      # https://cloud.google.com/storage/docs/retry-strategy
+      time.sleep(random.uniform(
+          0, min(_BACKOFF_CAP, _BACKOFF_BASE * 2 ** attempt)))
+      attempt += 1
+
+  def _hedged(self, method, data, associated_data):
+    """Make one request, duplicating it if it is slower than usual.
+
+    Whichever request succeeds first wins. The deadline and the hedge delay
+    count from when the first request is sent, after the rate limit and the
+    in-flight cap let it through. Requests still running at the deadline
+    are abandoned; their threads finish in the background, and requests not
+    sent by then are dropped.
+
+    Args:
+      method: bound encrypt or decrypt method of the remote AEAD
+      data: bytes to pass to the method
+      associated_data: associated data to pass to the method
+
+    Returns:
+      result: bytes returned by the method
+    """
+    attempt = _Attempt()
+    requests = {self._submit(attempt, method, data, associated_data)}
+    try:
+      # waiting for a token or a slot is local throttling, not KMS being
+      # slow, so the deadline and the hedge clock start once a request is sent
+      attempt.sent.wait()
+      start = time.monotonic()
+      deadline = start + self.deadline
+      hedge_delay = self._hedge_delay()
+      hedged = hedge_delay is None
+      while True:
+        now = time.monotonic()
+        if now >= deadline:
+          raise TinkError('KMS deadline exceeded after {:.1f}s'.format(
+              self.deadline))
+        wait_until = deadline if hedged else min(deadline,
+                                                 start + hedge_delay)
+        done, requests = concurrent.futures.wait(
+            requests, timeout=wait_until - now,
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for request in done:
+          if request.exception() is None:
+            return request.result()
+          if not requests and (hedged or
+                               time.monotonic() < start + hedge_delay):
+            raise request.exception()
+        if not hedged and time.monotonic() >= start + hedge_delay:
+          # tail latency: ask again and take whichever answers first
+          requests.add(self._submit(attempt, method, data, associated_data))
+          hedged = True
+    finally:
+      # requests still queued behind the throttle are no longer wanted
+      attempt.abandoned = True
+
+  def _submit(self, attempt, method, data, associated_data):
+    """Run a request of an attempt on the executor."""
+    request = self._executor.submit(self._request, attempt, method, data,
+                                    associated_data)
+    request.add_done_callback(lambda _: attempt.sent.set())
+    return request
+
+  def _request(self, attempt, method, data, associated_data):
+    """Send one request to KMS, recording its latency.
+
+    The request waits for a token and a slot first, and is dropped without
+    reaching KMS if its caller gave up in the meantime.
+    """
+    if attempt.abandoned:
+      raise TinkError('KMS request abandoned before it was sent')
+    self.bucket.acquire()
+    with self._slots:
+      if attempt.abandoned:
+        raise TinkError('KMS request abandoned before it was sent')
+      attempt.sent.set()
+      start = time.monotonic()
+      result = method(data, associated_data)
+      with self._lock:
+        self._latencies.append(time.monotonic() - start)
+      return result
+
+  def _hedge_delay(self):
+    """Seconds to wait before hedging, or None while there's too little data."""
+    if not self.hedge_percentile:
+      return None
+    with self._lock:
+      latencies = sorted(self._latencies)
+    if len(latencies) < _MIN_LATENCY_SAMPLES:
+      return None
+    index = int(len(latencies) * self.hedge_percentile / 100)
+    return latencies[min(index, len(latencies) - 1)]
+
+
+def is_retryable(kms_error):
+  """Decide whether a KMS failure is transient.
+
+  Args:
+    kms_error: exception raised by the Tink KMS AEAD
+
+  Returns:
+    retryable: True if the request may succeed when retried
+  """
+  message = str(kms_error).lower()
+  return any(error in message for error in _RETRYABLE_ERRORS)
+
+
+# one bucket for the whole process since the quota is per project
+_BUCKET = TokenBucket(_KMS_RATE, _KMS_BURST)
+_AEADS = {}
+_AEADS_LOCK = threading.Lock()
+
+
+def get_aead(key_uri, creds):
+  """Return the shared KmsAead for a key, creating it on first use.
+
+  Args:
+    key_uri: string with the resource identifier for the KMS symmetric key
+    creds: path to the creds.json file with the service account key for KMS
+
+  Returns:
+    KmsAead: AEAD shared by every caller using this key and creds
+  """
+  with _AEADS_LOCK:
+    kms_aead = _AEADS.get((key_uri, creds))
+    if kms_aead is None:
+      gcp_client = gcpkms.GcpKmsClient(key_uri, creds)
+      kms_aead = KmsAead(gcp_client.get_aead(key_uri), _BUCKET)
+      _AEADS[(key_uri, creds)] = kms_aead
+    return kms_aead
+
+
+class KeyRouter(object):
+  """Route KMS calls across equivalent keys in different regions."""
+
+  def __init__(self, key_uris, creds):
+    """Init class for KeyRouter.
+
+    Args:
+      key_uris: resource identifiers of the equivalent KMS keys, the
+        preferred one first
+      creds: path to the creds.json file with the service account key for KMS
+
+    Returns:
+      None
+    """
+    self.key_uris = list(key_uris)
+    self.creds = creds
+    self._aeads = {key_uri: get_aead(key_uri, creds)
+                   for key_uri in self.key_uris}
+    self._lock = threading.Lock()
+    # moving average latency in seconds, None until first measured
+    self._latency = dict.fromkeys(self.key_uris)
+    self._unhealthy_until = dict.fromkeys(self.key_uris, 0.0)
+
+  def aead_for(self, key_uri):
+    """Return the AEAD of a key, routed if it is one of the router's keys.
+
+    Data keys wrapped by a key outside the router, e.g. by a key objects
+    were written with elsewhere, can only be unwrapped by that key. It gets
+    its own shared AEAD and doesn't count towards routing.
+
+    Args:
+      key_uri: resource identifier of the key
+
+    Returns:
+      Aead: the key's AEAD, timed for routing if the router has the key
+    """
+    if key_uri not in self._aeads:
+      return get_aead(key_uri, self.creds)
+    return _RoutedAead(self, key_uri)
+
+  def wrap(self, data_key):
+    """Wrap a data key with the fastest healthy key, failing over on errors.
+
+    Args:
+      data_key: bytes of the data key
+
+    Returns:
+      (key_uri, wrapped_key): the key used and the wrapped data key
+    """
+    last_error = None
+    for key_uri in self.ranked():
+      try:
+        return key_uri, self.call(key_uri, 'encrypt', data_key, b'')
+      except TinkError as kms_error:
+        last_error = kms_error
+    raise last_error
+
+  def ranked(self):
+    """Order the keys for wrapping.
+
+    Healthy keys come first: any never measured, then by latency, with an
+    occasional random one first so every latency stays current. Keys that
+    recently failed come last, in case all of them are failing.
+
+    Returns:
+      key_uris: every key, best first
+    """
+    now = time.monotonic()
+    with self._lock:
+      healthy = [key_uri for key_uri in self.key_uris
+                 if self._unhealthy_until[key_uri] <= now]
+      unhealthy = [key_uri for key_uri in self.key_uris
+                   if key_uri not in healthy]
+      healthy.sort(key=lambda key_uri: (self._latency[key_uri] is not None,
+                                        self._latency[key_uri] or 0.0))
+    if len(healthy) > 1 and random.random() < _EXPLORE_RATE:
+      healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+    return healthy + unhealthy
+
+  def latencies(self):
+    """Return the moving average latency of every key, in seconds."""
+    with self._lock:
+      return dict(self._latency)
+
+  def call(self, key_uri, method, data, associated_data):
+    """Call one key's AEAD, recording its latency and health.
+
+    Args:
+      key_uri: resource identifier of the key
+      method: 'encrypt' or 'decrypt'
+      data: bytes to pass to the method
+      associated_data: associated data to pass to the method
+
+    Returns:
+      result: bytes returned by the method
+    """
+    start = time.monotonic()
+    try:
+      result = getattr(self._aeads[key_uri], method)(data, associated_data)
+    except TinkError as kms_error:
+      # a ciphertext that fails to unwrap says nothing about the key's health
+      if method == 'encrypt' or is_retryable(kms_error):
+        with self._lock:
+          self._unhealthy_until[key_uri] = (
+              time.monotonic() + _UNHEALTHY_SECONDS)
+      raise
+    elapsed = time.monotonic() - start
+    with self._lock:
+      average = self._latency[key_uri]
+      self._latency[key_uri] = elapsed if average is None else (
+          _LATENCY_WEIGHT * elapsed + (1 - _LATENCY_WEIGHT) * average)
+      self._unhealthy_until[key_uri] = 0.0
+    return result
+
+
+class _RoutedAead(aead.Aead):
+  """AEAD of one key of a KeyRouter, timed for the router."""
+
+  def __init__(self, router, key_uri):
+    self.router = router
+    self.key_uri = key_uri
+
+  def encrypt(self, plaintext, associated_data):
+    return self.router.call(self.key_uri, 'encrypt', plaintext,
+                            associated_data)
+
+  def decrypt(self, ciphertext, associated_data):
+    return self.router.call(self.key_uri, 'decrypt', ciphertext,
+                            associated_data)
+
+
+_ROUTERS = {}
+_ROUTERS_LOCK = threading.Lock()
+
+
+def get_router(key_uris, creds):
+  """Return the shared KeyRouter for a set of keys, creating it on first use.
+
+  Args:
+    key_uris: resource identifiers of the equivalent KMS keys, the preferred
+      one first
+    creds: path to the creds.json file with the service account key for KMS
+
+  Returns:
+    KeyRouter: router shared by every caller using these keys and creds
+  """
+  with _ROUTERS_LOCK:
+    router = _ROUTERS.get((tuple(key_uris), creds))
+    if router is None:
+      router = KeyRouter(key_uris, creds)
+      _ROUTERS[(tuple(key_uris), creds)] = router
+    return router
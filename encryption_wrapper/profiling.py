@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Profiling mode for the wrappers, turned on with GSUTIL_PROFILE.
+
+Set GSUTIL_PROFILE to a file path and the gsutil wrapper, or the first
+wrapped Client a process creates, starts cProfile and tracemalloc. When the
+process exits, a report is written to that path with:
+
+  the wall time of the run, and of every phase: the wrapped gsutil command,
+  the Blob methods, encryption, decryption and KMS calls
+  each child gsutil command with its wall time, and the CPU time and peak
+  memory of all the children together
+  the peak memory traced by tracemalloc, the peak RSS of the process, and
+  the lines holding the most memory when the report is written
+  the functions with the most cumulative time
+
+The raw cProfile data goes next to it, in PATH.prof, for pstats or
+snakeviz. Phases and child commands are timed in every thread; cProfile
+only sees the thread that turned profiling on. Nothing is measured, and
+every hook returns at once, when GSUTIL_PROFILE is unset.
+"""
+
+import atexit
+import contextlib
+import cProfile
+import functools
+import io
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+
+
+# path of the profiling report; profiling is off if unset
+_PROFILE_LOCATION = os.getenv('GSUTIL_PROFILE')
+# rows of each table in the report
+_TOP_FUNCTIONS = 25
+_TOP_ALLOCATIONS = 10
+# frames kept per allocation; one is enough to name the line
+_TRACEMALLOC_FRAMES = 1
+
+_LOCK = threading.Lock()
+_PROFILER = None
+_STARTED = None
+# name -> [count, total seconds, longest seconds]
+_PHASES = {}
+_CHILDREN = {}
+
+
+def start(path=_PROFILE_LOCATION):
+  """Turn profiling on and write the report when the process exits.
+
+  Does nothing when path is empty or profiling is already on.
+
+  Args:
+    path: file to write the report to
+
+  Returns:
+    None
+  """
+  global _PROFILER, _STARTED
+  if not path:
+    return
+  with _LOCK:
+    if _PROFILER is not None:
+      return
+    _STARTED = time.perf_counter()
+    tracemalloc.start(_TRACEMALLOC_FRAMES)
+    _PROFILER = cProfile.Profile()
+    _PROFILER.enable()
+  atexit.register(write_report, path)
+
+
+@contextlib.contextmanager
+def phase(name, table=_PHASES):
+  """Time a block as one occurrence of a phase.
+
+  Args:
+    name: name of the phase in the report
+    table: where the timing is recorded
+
+  Yields:
+    None
+  """
+  if _PROFILER is None:
+    yield
+    return
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - started
+    with _LOCK:
+      timing = table.setdefault(name, [0, 0.0, 0.0])
+      timing[0] += 1
+      timing[1] += elapsed
+      timing[2] = max(timing[2], elapsed)
+
+
+def child(description):
+  """Time a child process, e.g. the real gsutil, as a block.
+
+  Args:
+    description: what the child does, e.g. 'wrapped gsutil command'
+
+  Returns:
+    context manager timing the block
+  """
+  return phase(description, _CHILDREN)
+
+
+def timed(name):
+  """Decorate a function so each call is timed as a phase.
+
+  Args:
+    name: name of the phase in the report
+
+  Returns:
+    decorator
+  """
+
+  def decorator(function):
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if _PROFILER is None:
+        return function(*args, **kwargs)
+      with phase(name):
+        return function(*args, **kwargs)
+
+    return wrapper
+
+  return decorator
+
+
+def report():
+  """Build the profiling report.
+
+  Returns:
+    report: the report as text
+  """
+  lines = ['wall time: {:.3f}s'.format(time.perf_counter() - _STARTED), '']
+  with _LOCK:
+    phases = sorted(_PHASES.items(), key=lambda item: -item[1][1])
+    children = sorted(_CHILDREN.items(), key=lambda item: -item[1][1])
+  lines.append('{:<40} {:>7} {:>11} {:>11}'.format('phase', 'calls',
+                                                   'total (s)', 'max (s)'))
+  lines.extend('{:<40} {:>7} {:>11.3f} {:>11.3f}'.format(name, *timing)
+               for name, timing in phases)
+  lines.append('')
+  lines.append('{:<40} {:>7} {:>11} {:>11}'.format('child process', 'runs',
+                                                   'total (s)', 'max (s)'))
+  lines.extend('{:<40} {:>7} {:>11.3f} {:>11.3f}'.format(name, *timing)
+               for name, timing in children)
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  lines.append('children CPU: {:.3f}s user, {:.3f}s system, peak RSS {} KiB'
+               .format(usage.ru_utime, usage.ru_stime, usage.ru_maxrss))
+  lines.append('')
+  _, peak = tracemalloc.get_traced_memory()
+  lines.append('peak traced memory: {} KiB, peak RSS: {} KiB'.format(
+      peak // 1024,
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+  statistics = tracemalloc.take_snapshot().filter_traces(
+      [tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('lineno')
+  lines.append('still allocated, by line:')
+  lines.extend(str(statistic) for statistic in statistics[:_TOP_ALLOCATIONS])
+  lines.append('')
+  functions = io.StringIO()
+  stats = pstats.Stats(_PROFILER, stream=functions)
+  stats.sort_stats('cumulative').print_stats(_TOP_FUNCTIONS)
+  lines.append(functions.getvalue().strip())
+  return '\n'.join(lines) + '\n'
+
+
+def write_report(path):
+  """Stop profiling and write the report, and the raw profile beside it.
+
+  Args:
+    path: file to write the report to
+
+  Returns:
+    None
+  """
+  if _PROFILER is None:
+    return
+  _PROFILER.disable()
+  text = report()
+  tracemalloc.stop()
+  _PROFILER.dump_stats(path + '.prof')
+  with open(path, 'w') as report_file:
+    report_file.write(text)
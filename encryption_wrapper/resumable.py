@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checkpointed resumable uploads of locally encrypted files.
+
+The ciphertext is written segment by segment next to a JSON checkpoint that
+records the wrapped data key, the segment size, how many segments have been
+encrypted, the resumable session URI and how many bytes GCS has committed. If
+the process dies, calling upload again for the same file and object picks up
+from the last encrypted segment and the last committed byte instead of
+re-encrypting under a new data key and uploading from zero.
+
+StreamingUpload sends a stream of unknown length through the same protocol,
+keeping only the bytes GCS hasn't committed yet in memory, for writers that
+encrypt as they go.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import random
+import time
+from urllib.parse import quote
+
+from encryption_wrapper import encryption
+from encryption_wrapper import streaming
+
+from google.api_core import exceptions
+from google.cloud.storage import blob as storage_blob
+import google_crc32c
+import requests
+
+
+_UPLOAD_URL = ('https://storage.googleapis.com/upload/storage/v1/b/{bucket}/o'
+               '?uploadType=resumable')
+# GCS needs every chunk but the last to be a multiple of 256 KiB
+_CHUNK_SIZE = 64 * 256 * 1024
+# persist encryption progress every this many segments
+_CHECKPOINT_SEGMENTS = 16
+_RETRIES = 5
+_RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+
+class ResumableUpload(object):
+  """Encrypt a file and upload it to one object, surviving restarts."""
+
+  def __init__(self, blob, filename, encrypter, checkpoint_location, client):
+    """Init class for ResumableUpload.
+
+    Args:
+      blob: the Blob to upload to
+      filename: path to the plaintext file
+      encrypter: EncryptWithTink instance for the blob's key
+      checkpoint_location: directory for checkpoints and ciphertext
+      client: storage Client whose authorized session is used for the upload
+
+    Returns:
+      None
+    """
+    self.blob = blob
+    self.filename = filename
+    self.encrypter = encrypter
+    self.session = client._http  # pylint: disable=protected-access
+    source_stat = os.stat(filename)
+    self.source = {
+        'path': os.path.abspath(filename),
+        'size': source_stat.st_size,
+        'mtime_ns': source_stat.st_mtime_ns
+    }
+    tracker = hashlib.sha256('{}\n{}\n{}'.format(
+        blob.bucket.name, blob.name,
+        self.source['path']).encode('utf-8')).hexdigest()
+    if not os.path.isdir(checkpoint_location):
+      os.makedirs(checkpoint_location, mode=0o700, exist_ok=True)
+    self.checkpoint_path = os.path.join(checkpoint_location, tracker + '.json')
+    self.ciphertext_path = os.path.join(checkpoint_location, tracker + '.enc')
+
+  def upload(self,
+             content_type=None,
+             predefined_acl=None,
+             if_generation_match=None,
+             if_generation_not_match=None,
+             if_metageneration_match=None,
+             if_metageneration_not_match=None,
+             timeout=60):
+    """Encrypt and upload the file, resuming from a checkpoint if one exists.
+
+    Args:
+      content_type: same as real content_type
+      predefined_acl: same as real predefined_acl
+      if_generation_match: same as real if_generation_match
+      if_generation_not_match: same as real if_generation_not_match
+      if_metageneration_match: same as real if_metageneration_match
+      if_metageneration_not_match: same as real if_metageneration_not_match
+      timeout: same as real timeout
+
+    Returns:
+      resource: the uploaded object's resource, as returned by GCS
+    """
+    state, cipher = self._load()
+    if state is None:
+      state, cipher = self._start()
+    self._encrypt(state, cipher)
+
+    total = cipher.header.ciphertext_size(self.source['size'])
+    params = _upload_params(self.blob, predefined_acl, if_generation_match,
+                            if_generation_not_match, if_metageneration_match,
+                            if_metageneration_not_match)
+    try:
+      return self._send(state, params, content_type, total, timeout)
+    except exceptions.GoogleAPICallError as upload_error:
+      # a failed precondition or a denied request fails the same way next
+      # time, so don't keep a ciphertext the size of the file around for it
+      if upload_error.code not in _RETRYABLE_STATUS:
+        self.discard()
+      raise
+
+  def discard(self):
+    """Remove the checkpoint and its ciphertext."""
+    for path in (self.checkpoint_path, self.ciphertext_path):
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+
+  def _send(self, state, params, content_type, total, timeout):
+    """Upload the ciphertext, in a new session or resuming the last one.
+
+    Args:
+      state: the checkpoint
+      params: query parameters of the upload
+      content_type: same as real content_type
+      total: length of the ciphertext
+      timeout: same as real timeout
+
+    Returns:
+      resource: the uploaded object's resource, as returned by GCS
+    """
+    response = None
+    if state['session_uri'] is None:
+      self._new_session(state, params, content_type, total, timeout)
+    else:
+      response = self._query(state, total, timeout)
+    attempt = 0
+    chunk_size = self.blob.chunk_size or _CHUNK_SIZE
+    with open(self.ciphertext_path, 'rb') as ciphertext:
+      while True:
+        if response is None:
+          ciphertext.seek(state['committed'])
+          chunk = ciphertext.read(chunk_size)
+          content_range = 'bytes {}-{}/{}'.format(
+              state['committed'], state['committed'] + len(chunk) - 1, total)
+          response = self._request(state['session_uri'], chunk,
+                                   content_range, timeout)
+        status = response.status_code if response is not None else None
+        if status in (200, 201):
+          self.discard()
+          return response.json()
+        elif status == 308:
+          state['committed'] = _committed_bytes(response)
+          self._save(state)
+          attempt = 0
+          response = None
+        elif status in (404, 410):
+          # the session expired, but the ciphertext is still good
+          self._new_session(state, params, content_type, total, timeout)
+          response = None
+        elif (status is None or status in _RETRYABLE_STATUS) and \
+            attempt < _RETRIES:
+          time.sleep(random.uniform(0, 2 ** attempt))
+          attempt += 1
+          response = self._query(state, total, timeout)
+        elif status is None:
+          raise exceptions.ServiceUnavailable('resumable upload failed')
+        else:
+          raise exceptions.from_http_response(response)
+
+  def _start(self):
+    """Create a new data key and an empty ciphertext and checkpoint them."""
+    cipher = self.encrypter.new_cipher()
+    header = cipher.header.to_bytes()
+    with open(self.ciphertext_path, 'wb') as ciphertext:
+      ciphertext.write(header)
+      ciphertext.flush()
+      os.fsync(ciphertext.fileno())
+    state = {
+        'source': self.source,
+        'segment_size': cipher.header.segment_size,
+        'key_uri': cipher.header.key_uri,
+        'wrapped_key': base64.b64encode(
+            cipher.header.wrapped_key).decode('ascii'),
+        'segments': 0,
+        # CRC32C of the ciphertext so far, sent to GCS to verify the upload
+        'crc32c': google_crc32c.value(header),
+        'session_uri': None,
+        'committed': 0
+    }
+    self._save(state)
+    return state, cipher
+
+  def _load(self):
+    """Load the checkpoint if it is for this version of the source file."""
+    try:
+      with open(self.checkpoint_path) as checkpoint:
+        state = json.load(checkpoint)
+    except (OSError, ValueError):
+      return None, None
+    if state.get('source') != self.source or 'crc32c' not in state or \
+        not os.path.isfile(self.ciphertext_path):
+      # the file changed since the checkpoint was written, start over
+      self.discard()
+      return None, None
+    return state, self.encrypter.cipher_for(self._header(state))
+
+  def _header(self, state):
+    """Rebuild the ciphertext header from the checkpoint."""
+    return streaming.Header(state['segment_size'], state['key_uri'],
+                            base64.b64decode(state['wrapped_key']))
+
+  def _save(self, state):
+    """Atomically replace the checkpoint."""
+    partial_path = self.checkpoint_path + '.partial'
+    descriptor = os.open(partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+    with os.fdopen(descriptor, 'w') as checkpoint:
+      json.dump(state, checkpoint)
+      checkpoint.flush()
+      os.fsync(checkpoint.fileno())
+    os.replace(partial_path, self.checkpoint_path)
+
+  def _encrypt(self, state, cipher):
+    """Encrypt the segments that are not in the ciphertext file yet."""
+    header = cipher.header
+    count = header.segment_count(self.source['size'])
+    if state['segments'] >= count:
+      return
+    with open(self.filename, 'rb') as plaintext, \
+        open(self.ciphertext_path, 'r+b') as ciphertext:
+      # drop any partial segment written after the last checkpoint
+      ciphertext.truncate(header.segment_offset(state['segments']))
+      ciphertext.seek(header.segment_offset(state['segments']))
+      plaintext.seek(state['segments'] * header.segment_size)
+      checksummed = streaming.Crc32cWriter(ciphertext, state['crc32c'])
+      segments = ((index, plaintext.read(header.segment_size),
+                   index == count - 1)
+                  for index in range(state['segments'], count))
+      for index, encrypted in enumerate(
+          cipher.encrypt_segments(segments, self.encrypter.workers),
+          state['segments']):
+        last = index == count - 1
+        checksummed.write(encrypted)
+        if last or (index + 1) % _CHECKPOINT_SEGMENTS == 0:
+          ciphertext.flush()
+          os.fsync(ciphertext.fileno())
+          state['segments'] = index + 1
+          state['crc32c'] = checksummed.crc32c
+          self._save(state)
+
+  def _new_session(self, state, params, content_type, total, timeout):
+    """Start a resumable session and checkpoint its URI."""
+    metadata = {'client-side-encrypted': 'true'}
+    metadata.update(encryption.key_metadata(self._header(state)))
+    body = _object_resource(self.blob, metadata, content_type)
+    # GCS rejects the upload if the ciphertext doesn't match this checksum
+    body['crc32c'] = streaming.crc32c_base64(state['crc32c'])
+    headers = _encryption_headers(self.blob)
+    headers.update({
+        'X-Upload-Content-Type': body.get('contentType',
+                                          'application/octet-stream'),
+        'X-Upload-Content-Length': str(total)
+    })
+    response = self.session.post(
+        _UPLOAD_URL.format(bucket=quote(self.blob.bucket.name, safe='')),
+        params=params,
+        json=body,
+        headers=headers,
+        timeout=timeout)
+    if response.status_code != 200:
+      raise exceptions.from_http_response(response)
+    state['session_uri'] = response.headers['Location']
+    state['committed'] = 0
+    self._save(state)
+
+  def _query(self, state, total, timeout):
+    """Ask GCS how much of the upload it has committed."""
+    return self._request(state['session_uri'], b'', 'bytes */{}'.format(total),
+                         timeout)
+
+  def _request(self, session_uri, data, content_range, timeout):
+    """PUT to the session, returning None if the connection failed."""
+    headers = _encryption_headers(self.blob)
+    headers['Content-Range'] = content_range
+    try:
+      return self.session.put(
+          session_uri, data=data, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException:
+      return None
+
+
+class StreamingUpload(object):
+  """Upload a stream of unknown length to one object, chunk by chunk."""
+
+  def __init__(self,
+               blob,
+               client,
+               metadata,
+               content_type=None,
+               predefined_acl=None,
+               if_generation_match=None,
+               if_generation_not_match=None,
+               if_metageneration_match=None,
+               if_metageneration_not_match=None,
+               timeout=60):
+    """Start the resumable session for StreamingUpload.
+
+    Args:
+      blob: the Blob to upload to
+      client: storage Client whose authorized session is used for the upload
+      metadata: custom metadata for the object
+      content_type: same as real content_type
+      predefined_acl: same as real predefined_acl
+      if_generation_match: same as real if_generation_match
+      if_generation_not_match: same as real if_generation_not_match
+      if_metageneration_match: same as real if_metageneration_match
+      if_metageneration_not_match: same as real if_metageneration_not_match
+      timeout: same as real timeout
+
+    Returns:
+      None
+    """
+    self.session = client._http  # pylint: disable=protected-access
+    self.timeout = timeout
+    self.chunk_size = blob.chunk_size or _CHUNK_SIZE
+    self.headers = _encryption_headers(blob)
+    # bytes GCS has committed, and the bytes after them not committed yet
+    self.committed = 0
+    self.pending = bytearray()
+    body = _object_resource(blob, metadata, content_type)
+    headers = dict(self.headers)
+    headers['X-Upload-Content-Type'] = body.get('contentType',
+                                                'application/octet-stream')
+    response = self.session.post(
+        _UPLOAD_URL.format(bucket=quote(blob.bucket.name, safe='')),
+        params=_upload_params(blob, predefined_acl, if_generation_match,
+                              if_generation_not_match, if_metageneration_match,
+                              if_metageneration_not_match),
+        json=body,
+        headers=headers,
+        timeout=timeout)
+    if response.status_code != 200:
+      raise exceptions.from_http_response(response)
+    self.session_uri = response.headers['Location']
+
+  def write(self, data):
+    """Queue data, sending every full chunk that has accumulated.
+
+    Args:
+      data: next bytes of the object
+    """
+    self.pending += data
+    while len(self.pending) >= self.chunk_size:
+      self._send(self.chunk_size, None)
+
+  def finish(self):
+    """Send the rest of the stream and finalize the object.
+
+    Returns:
+      resource: the uploaded object's resource, as returned by GCS
+    """
+    total = self.committed + len(self.pending)
+    while True:
+      resource = self._send(len(self.pending), total)
+      if resource is not None:
+        return resource
+
+  def cancel(self):
+    """Cancel the session, so GCS drops what it has and no object is made."""
+    self.pending = bytearray()
+    try:
+      self.session.delete(self.session_uri, headers=self.headers,
+                          timeout=self.timeout)
+    except requests.exceptions.RequestException:
+      # an abandoned session expires after a week anyway
+      pass
+
+  def _send(self, size, total):
+    """PUT the first size pending bytes, retrying transient failures.
+
+    Args:
+      size: number of pending bytes to send
+      total: length of the whole object if this is the last chunk, or None
+
+    Returns:
+      resource: the object's resource once GCS has all of it, else None
+    """
+    attempt = 0
+    response = self._put(self.pending[:size], total)
+    while True:
+      status = response.status_code if response is not None else None
+      if status in (200, 201):
+        self.pending = bytearray()
+        return response.json()
+      elif status == 308:
+        committed = _committed_bytes(response)
+        del self.pending[:committed - self.committed]
+        self.committed = committed
+        return None
+      elif (status is None or status in _RETRYABLE_STATUS) and \
+          attempt < _RETRIES:
+        time.sleep(random.uniform(0, 2 ** attempt))
+        attempt += 1
+        response = self._put(b'', total)
+        if response is not None and response.status_code == 308:
+          # resend whatever the failed request didn't get committed
+          committed = _committed_bytes(response)
+          del self.pending[:committed - self.committed]
+          size -= committed - self.committed
+          self.committed = committed
+          response = self._put(self.pending[:size], total)
+      elif status is None:
+        raise exceptions.ServiceUnavailable('resumable upload failed')
+      else:
+        raise exceptions.from_http_response(response)
+
+  def _put(self, chunk, total):
+    """PUT a chunk following the committed bytes, or query if it's empty."""
+    total = '*' if total is None else total
+    if not chunk:
+      content_range = 'bytes */{}'.format(total)
+    else:
+      content_range = 'bytes {}-{}/{}'.format(
+          self.committed, self.committed + len(chunk) - 1, total)
+    headers = dict(self.headers)
+    headers['Content-Range'] = content_range
+    try:
+      return self.session.put(
+          self.session_uri,
+          data=bytes(chunk),
+          headers=headers,
+          timeout=self.timeout)
+    except requests.exceptions.RequestException:
+      return None
+
+
+def _object_resource(blob, metadata, content_type):
+  """Body of the request starting a session, as the real library builds it.
+
+  Args:
+    blob: the Blob to upload to, with any properties set on it
+    metadata: custom metadata to add to the blob's own
+    content_type: content type to use instead of the blob's
+
+  Returns:
+    resource: the blob's writable properties with the metadata merged in
+  """
+  resource = blob._get_writable_metadata()  # pylint: disable=protected-access
+  resource['metadata'] = dict(resource.get('metadata') or {}, **metadata)
+  # checksums set on the blob would be of the plaintext
+  resource.pop('crc32c', None)
+  resource.pop('md5Hash', None)
+  if content_type:
+    resource['contentType'] = content_type
+  return resource
+
+
+def _upload_params(blob, predefined_acl, if_generation_match,
+                   if_generation_not_match, if_metageneration_match,
+                   if_metageneration_not_match):
+  """Query parameters of the request starting a session."""
+  params = {
+      'predefinedAcl': predefined_acl,
+      'ifGenerationMatch': if_generation_match,
+      'ifGenerationNotMatch': if_generation_not_match,
+      'ifMetagenerationMatch': if_metageneration_match,
+      'ifMetagenerationNotMatch': if_metageneration_not_match,
+      'userProject': blob.user_project
+  }
+  # like the real library, only a key without a version is passed on
+  if blob.kms_key_name is not None and \
+      'cryptoKeyVersions' not in blob.kms_key_name:
+    params['kmsKeyName'] = blob.kms_key_name
+  return {k: v for k, v in params.items() if v is not None}
+
+
+def _encryption_headers(blob):
+  """Headers every request of the session needs for a customer-supplied key."""
+  return storage_blob._get_encryption_headers(blob._encryption_key)  # pylint: disable=protected-access
+
+
+def _committed_bytes(response):
+  """Parse the committed length out of a 308 response's Range header."""
+  committed = response.headers.get('Range')
+  if not committed:
+    return 0
+  return int(committed.split('-')[-1]) + 1
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Rotate the KMS key of client-side encrypted objects without rewriting them.
+
+Each object's data key is unwrapped with the old KMS key, wrapped with the new
+one and written to the object's custom metadata, which decryption prefers over
+the copy in the ciphertext header. Only metadata is patched, so the cost is
+two KMS calls and one metadata request per object whatever its size.
+
+Usage:
+  python3 -m encryption_wrapper.rotation --bucket BUCKET --old_key_uri OLD \\
+      --new_key_uri NEW --creds creds.json [--prefix PREFIX] [--workers N] \\
+      [--checkpoint PATH] [--index PATH]
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import json
+import os
+import struct
+import sys
+
+from encryption_wrapper import encryption
+from encryption_wrapper import errors
+from encryption_wrapper import index
+from encryption_wrapper import kms
+from encryption_wrapper import streaming
+
+from google.api_core import exceptions
+from google.cloud import storage
+from tink.core import TinkError
+
+
+_WORKERS = 16
+
+
+class KeyRotation(object):
+  """Rewrap the data keys of every encrypted object in a bucket."""
+
+  def __init__(self,
+               bucket_name,
+               old_key_uri,
+               new_key_uri,
+               creds,
+               checkpoint=None,
+               workers=_WORKERS,
+               client=None,
+               object_index=None):
+    """Init class for KeyRotation.
+
+    Args:
+      bucket_name: name of the bucket to rotate
+      old_key_uri: resource identifier of the KMS key being retired
+      new_key_uri: resource identifier of the KMS key to wrap with instead
+      creds: path to the creds.json file with the service account key for KMS
+      checkpoint: path to a file recording progress, so an interrupted
+        rotation can continue where it stopped
+      workers: number of objects rotated concurrently
+      client: google-cloud-storage Client to use, defaults to a new one
+      object_index: ObjectIndex to record the new key of every rotated
+        object in, or None
+
+    Returns:
+      None
+    """
+    self.bucket_name = bucket_name
+    self.old_key_uri = old_key_uri
+    self.new_key_uri = new_key_uri
+    self.old_aead = kms.get_aead(old_key_uri, creds)
+    self.new_aead = kms.get_aead(new_key_uri, creds)
+    self.checkpoint = checkpoint
+    self.workers = workers
+    self.client = client or storage.Client()
+    self.object_index = object_index
+
+  def run(self, prefix=None, report=None):
+    """Rotate every object under a prefix.
+
+    Listing pages are processed one at a time, each page's objects
+    concurrently, and the last name of every finished page is checkpointed.
+    The checkpoint never moves past an object that failed, so a restart
+    retries it, and it is kept at the end of a run with failures. Objects
+    already wrapped by the new key are skipped, so repeating part of a page
+    after a restart is harmless.
+
+    Args:
+      prefix: only rotate objects whose names start with this
+      report: function called with the gs:// URL and the error of every
+        object that failed
+
+    Returns:
+      counts: dict with the number of objects per outcome
+    """
+    counts = {'rotated': 0, 'current': 0, 'unencrypted': 0, 'legacy': 0,
+              'other_key': 0, 'failed': 0}
+    start_offset = self._load_checkpoint(prefix)
+    blobs = self.client.list_blobs(
+        self.bucket_name,
+        prefix=prefix,
+        start_offset=start_offset,
+        page_size=streaming.LIST_PAGE_SIZE)
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+      for page in blobs.pages:
+        page_blobs = list(page)
+        for blob, (outcome, rotation_error) in zip(
+            page_blobs, executor.map(self._rotate_one, page_blobs)):
+          counts[outcome] += 1
+          if rotation_error is None:
+            continue
+          if not failed:
+            # listing restarts at, and includes, the first failed object
+            self._save_checkpoint(prefix, blob.name)
+            failed = True
+          if report is not None:
+            report('gs://{}/{}'.format(self.bucket_name, blob.name),
+                   rotation_error)
+        if page_blobs and not failed:
+          self._save_checkpoint(prefix, page_blobs[-1].name)
+    if not failed and self.checkpoint and os.path.exists(self.checkpoint):
+      os.unlink(self.checkpoint)
+    return counts
+
+  def _rotate_one(self, blob):
+    """Rewrap one object's data key and patch it into the metadata.
+
+    Args:
+      blob: Blob from the bucket listing, with its metadata
+
+    Returns:
+      (outcome, error): key of the counts dict this object falls under, and
+        the error if it failed
+    """
+    metadata = blob.metadata or {}
+    if metadata.get('client-side-encrypted') != 'true':
+      return 'unencrypted', None
+    if metadata.get(encryption.KEY_URI_METADATA) == self.new_key_uri:
+      return 'current', None
+    try:
+      if encryption.KEY_URI_METADATA in metadata and \
+          encryption.WRAPPED_KEY_METADATA in metadata:
+        # the listing already has the current wrapped key, so the object
+        # isn't read at all
+        key_uri = metadata[encryption.KEY_URI_METADATA]
+        wrapped_key = base64.b64decode(
+            metadata[encryption.WRAPPED_KEY_METADATA])
+      else:
+        header, _ = streaming.read_header(blob)
+        if header is None:
+          # single envelope objects have to be rewritten to change their key
+          return 'legacy', None
+        header = encryption.rotated_header(header, metadata)
+        key_uri, wrapped_key = header.key_uri, header.wrapped_key
+      if key_uri != self.old_key_uri:
+        return 'other_key', None
+      data_key = self.old_aead.decrypt(wrapped_key, b'')
+      wrapped_key = self.new_aead.encrypt(data_key, b'')
+      blob.metadata = {
+          encryption.KEY_URI_METADATA: self.new_key_uri,
+          encryption.WRAPPED_KEY_METADATA:
+              base64.b64encode(wrapped_key).decode('ascii')
+      }
+      # fail instead of overwriting metadata someone changed in the meantime
+      blob.patch(if_metageneration_match=blob.metageneration)
+      if self.object_index is not None:
+        self.object_index.record_rewrap(self.bucket_name, blob.name,
+                                        blob.generation, self.new_key_uri)
+    except (errors.IntegrityError, TinkError, KeyError, ValueError,
+            struct.error, exceptions.GoogleAPICallError) as rotation_error:
+      # malformed key metadata raises KeyError or binascii.Error
+      return 'failed', rotation_error
+    return 'rotated', None
+
+  def _load_checkpoint(self, prefix):
+    """Return the name to restart listing from, if a checkpoint exists."""
+    if not self.checkpoint or not os.path.exists(self.checkpoint):
+      return None
+    with open(self.checkpoint) as checkpoint:
+      state = json.load(checkpoint)
+    if state.get('run') != self._run_id(prefix):
+      return None
+    return state['last_name']
+
+  def _save_checkpoint(self, prefix, last_name):
+    """Record that every object before last_name is done."""
+    if not self.checkpoint:
+      return
+    partial_path = self.checkpoint + '.partial'
+    with open(partial_path, 'w') as checkpoint:
+      json.dump({'run': self._run_id(prefix), 'last_name': last_name},
+                checkpoint)
+    os.replace(partial_path, self.checkpoint)
+
+  def _run_id(self, prefix):
+    """Identify the rotation a checkpoint belongs to."""
+    return [self.bucket_name, prefix, self.old_key_uri, self.new_key_uri]
+
+
+def _print_failure(url, rotation_error):
+  print('failed to rotate {}: {}'.format(url, rotation_error), file=sys.stderr)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Rewrap client-side encryption data keys with a new KMS key.')
+  parser.add_argument('--bucket', required=True)
+  parser.add_argument('--old_key_uri', required=True)
+  parser.add_argument('--new_key_uri', required=True)
+  parser.add_argument('--creds', required=True)
+  parser.add_argument('--prefix', default=None)
+  parser.add_argument('--workers', type=int, default=_WORKERS)
+  parser.add_argument('--checkpoint', default=None)
+  parser.add_argument('--index', default=None)
+  args = parser.parse_args()
+
+  object_index = index.ObjectIndex(args.index) if args.index else None
+  rotation = KeyRotation(args.bucket, args.old_key_uri, args.new_key_uri,
+                         args.creds, args.checkpoint, args.workers,
+                         object_index=object_index)
+  counts = rotation.run(args.prefix, _print_failure)
+  for outcome, count in sorted(counts.items()):
+    print('{}: {}'.format(outcome, count))
+
+
+if __name__ == '__main__':
+  main()
@@ -17,42 +17,259 @@
 For use with the google-cloud-storage Python module.
 """
 
+import collections
+import concurrent.futures
+import io
 import os
 import random
-import shutil
+import socket
 import string
+import tempfile
 
+from encryption_wrapper import blobio
+from encryption_wrapper import cache
 from encryption_wrapper import encryption
-
+from encryption_wrapper import errors
+from encryption_wrapper import index
+from encryption_wrapper import profiling
+from encryption_wrapper import resumable
+from encryption_wrapper import streaming
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+import requests
+from urllib3.connection import HTTPConnection
 
 
 # Global variables
 _GSUTIL = os.getenv('GSUTIL_ACTUAL', '/snap/bin/gsutil')
 _TMP_LOCATION = os.getenv('GSUTIL_TMP_LOCATION',
                           os.path.expanduser('~') + '/.gsutil-wrapper/')
+# checkpoints have to outlive the process, so they don't go in the tmp dir
+_CHECKPOINT_LOCATION = os.getenv(
+    'GSUTIL_CHECKPOINT_LOCATION',
+    os.path.expanduser('~') + '/.gsutil-wrapper-checkpoints/')
+# files at least this big are uploaded with checkpointed resumable uploads;
+# same default as gsutil's resumable_threshold
+_RESUMABLE_THRESHOLD = int(
+    os.getenv('GSUTIL_RESUMABLE_THRESHOLD', str(8 * 1024 * 1024)))
+# connections kept open to GCS by each Client's session; size it to the number
+# of threads sharing the Client so none of them waits for a connection
+_HTTP_POOL_SIZE = int(os.getenv('GSUTIL_HTTP_POOL_SIZE', '32'))
+# directory for the cache of decrypted objects; the cache is off if unset
+_CACHE_LOCATION = os.getenv('GSUTIL_CACHE_LOCATION')
+# bytes of plaintext the cache keeps
+_CACHE_SIZE = int(os.getenv('GSUTIL_CACHE_SIZE', str(1024 * 1024 * 1024)))
+# SQLite file indexing the encrypted objects uploaded; no index if unset
+_INDEX_LOCATION = os.getenv('GSUTIL_INDEX_LOCATION')
+# objects iter_decrypted downloads and decrypts ahead of the consumer
+_PREFETCH = 4
+# plaintext iter_decrypted keeps in memory per object before spilling to disk
+_SPOOL_SIZE = 8 * 1024 * 1024
+# buffer size of the file objects returned by Blob.open
+_OPEN_BUFFER_SIZE = 1024 * 1024
+# seconds an idle pooled connection waits before TCP keep-alive probes start
+_HTTP_KEEPALIVE = 60
+
+
+class _PoolAdapter(requests.adapters.HTTPAdapter):
+  """HTTPAdapter whose pooled connections send TCP keep-alives.
+
+  Without keep-alives, load balancers between here and GCS silently drop
+  idle connections and the next request on them pays for a reset, a new
+  TCP connection and a new TLS handshake.
+  """
+
+  def init_poolmanager(self, *args, **kwargs):
+    socket_options = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    ]
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+      socket_options += [
+          (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, _HTTP_KEEPALIVE),
+          (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, _HTTP_KEEPALIVE // 4),
+          (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+      ]
+    kwargs['socket_options'] = socket_options
+    super().init_poolmanager(*args, **kwargs)
+
+
+def pooled_session(pool_size=_HTTP_POOL_SIZE, credentials=None):
+  """Create an authorized session with a connection pool of a given size.
+
+  The session is safe to share between threads and between Clients; every
+  request made through it reuses a warm connection and the same access token
+  when one is available.
+
+  Args:
+    pool_size: maximum number of connections kept open per host
+    credentials: google.auth credentials, defaults to the application
+      default credentials
+
+  Returns:
+    AuthorizedSession: session to pass to Client as http
+  """
+  if credentials is None:
+    credentials, _ = google.auth.default(scopes=storage.Client.SCOPE)
+  session = AuthorizedSession(credentials)
+  adapter = _PoolAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+  session.mount('https://', adapter)
+  return session
+
+
+def _file_size(filename):
+  """Size of a local file, raising LocalFileError if it can't be read."""
+  try:
+    return os.path.getsize(filename)
+  except OSError as os_error:
+    raise errors.LocalFileError(str(os_error)) from os_error
 
 
 class Client(storage.Client):
-  """Wrap the google-cloud-storage Client class."""
+  """Wrap the google-cloud-storage Client class.
+
+  One Client can be used from many threads at once. Every upload and
+  download gets scratch space of its own under tmp_location and only ever
+  removes that, so concurrent operations never see each other's files, even
+  for files with the same name. As with the real library, use a separate
+  Blob per thread.
 
-  def __init__(self, key_uri, creds, tmp_location=_TMP_LOCATION):
+  All GCS requests made through a Client, including resumable uploads, share
+  one pooled authorized session, which can also be shared between Clients by
+  passing the same http to each. KMS calls for a key share one channel per
+  process whatever the number of Clients.
+  """
+
+  def __init__(self,
+               key_uri,
+               creds,
+               tmp_location=_TMP_LOCATION,
+               checkpoint_location=_CHECKPOINT_LOCATION,
+               pool_size=_HTTP_POOL_SIZE,
+               http=None,
+               cache_location=_CACHE_LOCATION,
+               cache_size=_CACHE_SIZE,
+               index_location=_INDEX_LOCATION):
     """Init class for our Client wrapper.
 
     Args:
-      key_uri: string with the resource identifier for the KMS symmetric key
+      key_uri: string with the resource identifier for the KMS symmetric key,
+        or a list of equivalent keys in different regions, preferred first
       creds: path to the creds.json file with the service account key for KMS
       tmp_location: path to swap location for local encryption and decryption
+      checkpoint_location: path to keep resumable upload checkpoints in
+      pool_size: connections kept open to GCS, ignored if http is given
+      http: authorized session to share, e.g. from pooled_session or another
+        Client's _http; defaults to a new pooled session
+      cache_location: directory to cache decrypted objects in, or None to
+        download every time
+      cache_size: bytes of plaintext the cache keeps
+      index_location: SQLite file to record encrypted uploads in, or None
 
     Returns:
       None
     """
     self.key_uri = key_uri
     self.creds = creds
+    self.checkpoint_location = checkpoint_location
+    self.cache = None
+    if cache_location:
+      self.cache = cache.DecryptedCache(cache_location, cache_size)
+    self.index = None
+    if index_location:
+      self.index = index.ObjectIndex(index_location)
+    # a no-op unless GSUTIL_PROFILE is set
+    profiling.start()
     random_str = ''.join(
         (random.choice(string.ascii_letters + string.digits) for i in range(8)))
     self.tmp_location = tmp_location + random_str + '/'
-    super().__init__()
+    super().__init__(_http=http or pooled_session(pool_size))
+
+  def pool_stats(self):
+    """Report the state of the connection pools behind this Client.
+
+    Returns:
+      stats: list with a dict per host, giving the pool's maxsize, the
+        connections idle in it, and the connections and requests made so far
+    """
+    stats = []
+    for prefix, adapter in self._http.adapters.items():
+      if not prefix.startswith('https://'):
+        continue
+      for key in adapter.poolmanager.pools.keys():
+        pool = adapter.poolmanager.pools.get(key)
+        if pool is None or pool.pool is None:
+          continue
+        # the queue is padded with None for connections not opened yet
+        idle = [conn for conn in list(pool.pool.queue) if conn is not None]
+        stats.append({
+            'host': pool.host,
+            'port': pool.port,
+            'maxsize': pool.pool.maxsize,
+            'idle': len(idle),
+            'connections': pool.num_connections,
+            'requests': pool.num_requests
+        })
+    return stats
+
+  @profiling.timed('Client.upload_to_buckets')
+  def upload_to_buckets(self,
+                        filename,
+                        blob_name,
+                        bucket_names,
+                        content_type=None,
+                        predefined_acl=None,
+                        timeout=60):
+    """Encrypt a file once and upload it to the same name in several buckets.
+
+    The file is encrypted into scratch space a single time, and the same
+    ciphertext, with the same wrapped data key, is uploaded to every bucket
+    concurrently. Encryption cost doesn't grow with the number of copies,
+    and each copy decrypts on its own like any other object.
+
+    Args:
+      filename: path to the file to upload
+      blob_name: name of the object in every bucket
+      bucket_names: names of the buckets to upload to
+      content_type: same as real content_type
+      predefined_acl: same as real predefined_acl
+      timeout: same as real timeout
+
+    Returns:
+      blobs: wrapped Blob for each bucket, in the order given
+    """
+    blobs = [self.bucket(name).blob(blob_name) for name in bucket_names]
+    if not blobs:
+      return blobs
+    plaintext_size = _file_size(filename)
+    encrypter = blobs[0].e
+    with encrypter.scratch_path(os.path.basename(filename)) as ciphertext_path:
+      crc32c = streaming.crc32c_base64(
+          encrypter.encrypt_file(filename, ciphertext_path))
+      metadata = {'client-side-encrypted': 'true'}
+      with open(ciphertext_path, 'rb') as ciphertext:
+        metadata.update(
+            encryption.key_metadata(streaming.Header.read(ciphertext)))
+
+      def upload(blob):
+        blob.crc32c = crc32c
+        blob.metadata = dict(blob.metadata or {}, **metadata)
+        # the ciphertext is ready, so skip the wrapper's encryption
+        storage.Blob.upload_from_filename(
+            blob,
+            ciphertext_path,
+            content_type,
+            client=self,
+            predefined_acl=predefined_acl,
+            timeout=timeout)
+
+      with concurrent.futures.ThreadPoolExecutor(len(blobs)) as executor:
+        list(executor.map(upload, blobs))
+    if self.index is not None:
+      for blob in blobs:
+        self.index.record(blob, plaintext_size)
+    return blobs
 
   def bucket(self, bucket_name, user_project=None):
     """Wrapper for the bucket function.
@@ -71,27 +288,49 @@ class Client(storage.Client):
         name=bucket_name,
         user_project=user_project,
         key_uri=self.key_uri,
-        creds=self.creds)
+        creds=self.creds,
+        tmp_location=self.tmp_location,
+        checkpoint_location=self.checkpoint_location,
+        cache=self.cache,
+        index=self.index)
 
 
 class Bucket(storage.Bucket):
   """Wrap the google-cloud-storage Bucket class."""
 
-  def __init__(self, client, name, user_project, key_uri, creds):
+  def __init__(self,
+               client,
+               name,
+               user_project,
+               key_uri,
+               creds,
+               tmp_location=_TMP_LOCATION,
+               checkpoint_location=_CHECKPOINT_LOCATION,
+               cache=None,
+               index=None):
     """Init class for our Bucket wrapper.
 
     Args:
       client: wrapped Client class
       name: same as real bucket name
       user_project: same as real user_project
-      key_uri: string with the resource identifier for the KMS symmetric key
+      key_uri: string with the resource identifier for the KMS symmetric key,
+        or a list of equivalent keys in different regions, preferred first
       creds: path to the creds.json file with the service account key for KMS
+      tmp_location: path to swap location for local encryption and decryption
+      checkpoint_location: path to keep resumable upload checkpoints in
+      cache: DecryptedCache to serve downloads from, or None
+      index: ObjectIndex to record encrypted uploads in, or None
 
     Returns:
       None
     """
     self.key_uri = key_uri
     self.creds = creds
+    self.tmp_location = tmp_location
+    self.checkpoint_location = checkpoint_location
+    self.cache = cache
+    self.index = index
     super().__init__(client, name, user_project)
 
   def blob(self,
@@ -122,7 +361,74 @@ class Bucket(storage.Bucket):
         kms_key_name=kms_key_name,
         generation=generation,
         key_uri=self.key_uri,
-        creds=self.creds)
+        creds=self.creds,
+        tmp_location=self.tmp_location,
+        checkpoint_location=self.checkpoint_location,
+        cache=self.cache,
+        index=self.index)
+
+  def iter_decrypted(self, prefix=None, prefetch=_PREFETCH, client=None):
+    """Decrypt every object under a prefix, downloading ahead of the caller.
+
+    The listing is fetched a page at a time as it is consumed, and the next
+    prefetch objects are downloaded and decrypted in background threads while
+    the caller works on the current one. Objects are yielded in listing
+    order. Each plaintext is kept in memory up to 8 MiB and spilled to
+    tmp_location beyond that, so at most prefetch + 1 objects are held at
+    once whatever their size.
+
+    Each stream is closed when the next object is requested, or when the
+    generator is closed, so read it, or copy it somewhere, before moving on.
+
+    Args:
+      prefix: only decrypt objects whose names start with this
+      prefetch: number of objects to download ahead of the caller
+      client: wrapped Client class
+
+    Yields:
+      (name, stream): the object's name and a binary file object positioned
+        at the start of its plaintext
+    """
+
+    def fetch(listed):
+      blob = self.blob(listed.name, generation=listed.generation)
+      # the listing already has the CRC32C and metadata, so skip the reload
+      blob._set_properties(listed._properties)  # pylint: disable=protected-access
+      plaintext = tempfile.SpooledTemporaryFile(_SPOOL_SIZE,
+                                                dir=self.tmp_location)
+      try:
+        if not blob._decrypt_to(plaintext, client):  # pylint: disable=protected-access
+          raise errors.IntegrityError(
+              'CRC32C of gs://{}/{} does not match'.format(
+                  self.name, blob.name),
+              retryable=True)
+      except BaseException:
+        plaintext.close()
+        raise
+      plaintext.seek(0)
+      return blob.name, plaintext
+
+    pending = collections.deque()
+    current = None
+    with concurrent.futures.ThreadPoolExecutor(max(prefetch, 1)) as executor:
+      try:
+        for listed in self.list_blobs(prefix=prefix, client=client):
+          pending.append(executor.submit(fetch, listed))
+          if len(pending) > prefetch:
+            current = pending.popleft().result()
+            yield current
+            current[1].close()
+        while pending:
+          current = pending.popleft().result()
+          yield current
+          current[1].close()
+      finally:
+        if current is not None:
+          current[1].close()
+        # drop what was fetched ahead for a caller that stopped early
+        for future in pending:
+          if not future.cancel() and not future.exception():
+            future.result()[1].close()
 
 
 class Blob(storage.Blob):
@@ -136,7 +442,11 @@ class Blob(storage.Blob):
                kms_key_name=None,
                generation=None,
                key_uri=None,
-               creds=None):
+               creds=None,
+               tmp_location=_TMP_LOCATION,
+               checkpoint_location=_CHECKPOINT_LOCATION,
+               cache=None,
+               index=None):
     """Init class for our Bucket wrapper.
 
     Args:
@@ -147,18 +457,57 @@ class Blob(storage.Blob):
       kms_key_name: same as real kms_key_name (note this is for server-side
         encryption, not client-side, so don't use this for ITAR use cases)
       generation: same as real generation
-      key_uri: string with the resource identifier for the KMS symmetric key
+      key_uri: string with the resource identifier for the KMS symmetric key,
+        or a list of equivalent keys in different regions, preferred first
       creds: path to the creds.json file with the service account key for KMS
+      tmp_location: path to swap location for local encryption and decryption
+      checkpoint_location: path to keep resumable upload checkpoints in
+      cache: DecryptedCache to serve downloads from, or None
+      index: ObjectIndex to record encrypted uploads in, or None
 
     Returns:
       None
     """
     self.key_uri = key_uri
     self.creds = creds
-    self.e = encryption.EncryptWithTink(self.key_uri, self.creds)
+    self.checkpoint_location = checkpoint_location
+    self.cache = cache
+    self.index = index
+    self.e = encryption.EncryptWithTink(self.key_uri, self.creds,
+                                        tmp_location)
     super().__init__(blob_name, bucket, chunk_size, encryption_key,
                      kms_key_name, generation)
 
+  @profiling.timed('Blob.open')
+  def open(self, mode='rb', client=None, content_type=None, **kwargs):
+    """Open the object as a binary file object.
+
+    Reading decrypts only the segments holding the bytes asked for, fetched
+    with ranged GETs, so seek() and tell() are cheap. Writing encrypts
+    segment by segment and streams the ciphertext to a new version of the
+    object, which is created when the file is closed.
+
+    Args:
+      mode: 'rb' to read or 'wb' to write
+      client: wrapped Client class
+      content_type: content type of a written object
+      **kwargs: for 'wb', predefined_acl, the if_generation_* and
+        if_metageneration_* preconditions and timeout of the upload
+
+    Returns:
+      file: io.BufferedReader, or for 'wb' an io.BufferedWriter that
+        aborts the upload when a with block exits with an exception
+    """
+    if mode == 'rb':
+      return io.BufferedReader(blobio.EncryptedReader(self, client),
+                               _OPEN_BUFFER_SIZE)
+    elif mode == 'wb':
+      return blobio.EncryptedBufferedWriter(
+          blobio.EncryptedWriter(self, client, content_type, **kwargs),
+          _OPEN_BUFFER_SIZE)
+    raise ValueError('mode must be rb or wb, not ' + repr(mode))
+
+  @profiling.timed('Blob.upload_from_filename')
   def upload_from_filename(self,
                            file_obj,
                            rewind=False,
@@ -177,7 +526,9 @@ class Blob(storage.Blob):
 
     This will encrypt locally using
        Tink before handing the encrypted file path to the real
-       upload_from_filename.
+       upload_from_filename. Files of at least GSUTIL_RESUMABLE_THRESHOLD
+       bytes are instead encrypted and uploaded with checkpoints, so calling
+       this again after an interruption resumes where it left off.
 
     Args:
       file_obj: same as real file_obj
@@ -198,35 +549,52 @@ class Blob(storage.Blob):
       None
     """
 
-    # Encrypt the file
-    encrypted_file_obj = self.e.encrypt(file_obj)
-
-    # Hand off to real upload_from_filename, but with the encrypted filename
-    # instead of the cleartext one
-    super().upload_from_filename(
-        encrypted_file_obj,
-        content_type,
-        client,
-        predefined_acl,
-        if_generation_match,
-        if_generation_not_match,
-        if_metageneration_match,
-        if_metageneration_not_match,
-        timeout=60,
-        checksum='md5')
-
-    # Apply custom metadata. We instanciate a new GCS Client here so we don't
-    # default to any from outer scopes
-    metadata_client = storage.Client()
-    metadata_bucket = metadata_client.get_bucket(self.bucket.name)
-    metadata_blob = metadata_bucket.get_blob(self.name)
-    metadata = {'client-side-encrypted': 'true'}
-    metadata_blob.metadata = metadata
-    metadata_blob.patch(client=metadata_client)
-
-    # Clean up
-    shutil.rmtree(_TMP_LOCATION)
-
+    plaintext_size = _file_size(file_obj)
+    if plaintext_size >= _RESUMABLE_THRESHOLD:
+      upload = resumable.ResumableUpload(self, file_obj, self.e,
+                                         self.checkpoint_location,
+                                         self._require_client(client))
+      # the client-side-encrypted metadata is set when the session starts
+      resource = upload.upload(content_type, predefined_acl,
+                               if_generation_match, if_generation_not_match,
+                               if_metageneration_match,
+                               if_metageneration_not_match, timeout)
+      self._set_properties(resource)
+      if self.index is not None:
+        self.index.record(self, plaintext_size)
+      return
+
+    # Encrypt the file into scratch space of our own, computing the
+    # ciphertext's CRC32C on the same pass
+    with self.e.scratch_path(os.path.basename(file_obj)) as encrypted_file_obj:
+      crc32c = self.e.encrypt_file(file_obj, encrypted_file_obj)
+
+      # Hand off to real upload_from_filename, but with the encrypted filename
+      # instead of the cleartext one. GCS verifies the upload against the
+      # checksum we already have, so the library doesn't need to hash the
+      # ciphertext again. The custom metadata goes in the same request
+      self.crc32c = streaming.crc32c_base64(crc32c)
+      metadata = dict(self.metadata or {})
+      metadata['client-side-encrypted'] = 'true'
+      with open(encrypted_file_obj, 'rb') as ciphertext:
+        metadata.update(
+            encryption.key_metadata(streaming.Header.read(ciphertext)))
+      self.metadata = metadata
+      super().upload_from_filename(
+          encrypted_file_obj,
+          content_type,
+          client,
+          predefined_acl,
+          if_generation_match,
+          if_generation_not_match,
+          if_metageneration_match,
+          if_metageneration_not_match,
+          timeout=60,
+          checksum=None)
+    if self.index is not None:
+      self.index.record(self, plaintext_size)
+
+  @profiling.timed('Blob.download_to_filename')
   def download_to_filename(self,
                            filename,
                            client=None,
@@ -239,11 +607,15 @@ class Blob(storage.Blob):
                            if_metageneration_not_match=None,
                            timeout=60,
                            checksum='md5'):
-    """Wrapped upload_from_filname function.
+    """Wrapped download_to_filename function.
 
-    This will encrypt locally using
-           Tink before handing the encrypted file path to the real
-           upload_from_filename.
+    This will decrypt locally using Tink as the ciphertext is downloaded, so
+    it is never written to disk, and verify the CRC32C of the ciphertext on
+    the same pass.
+
+    With a cache, whole-object downloads without preconditions first look
+    up the object's current generation, a metadata request, and copy the
+    plaintext from the cache when that generation is in it.
 
     Args:
       filename: same as real filename
@@ -256,25 +628,113 @@ class Blob(storage.Blob):
       if_metageneration_match: same as real if_metageneration_match
       if_metageneration_not_match: same as real if_metageneration_not_match
       timeout: same as real timeout
-      checksum: same as real checksum
+      checksum: None to skip verifying the ciphertext, anything else checks
+        its CRC32C
 
     Returns:
       None
     """
 
-    # Download first
-    super().download_to_filename(filename, client, start, end, raw_download,
-                                 if_generation_match, if_generation_not_match,
-                                 if_metageneration_match,
-                                 if_metageneration_not_match, timeout, checksum)
-
-    # Then decrypt
-    self.e.decrypt(filename)
-
-    # Clean up
-    shutil.rmtree(_TMP_LOCATION)
+    cacheable = self.cache is not None and start is None and end is None \
+        and not raw_download and if_generation_match is None and \
+        if_generation_not_match is None and if_metageneration_match is None \
+        and if_metageneration_not_match is None
+    if cacheable:
+      # the generation tells whether the cached plaintext is current
+      self.reload(client=client)
+      if self.cache.get(self.bucket.name, self.name, self.generation,
+                        filename):
+        self._set_mtime(filename)
+        return
+
+    try:
+      plaintext = open(filename, 'wb')
+    except OSError as os_error:
+      raise errors.LocalFileError(str(os_error)) from os_error
+    try:
+      with plaintext:
+        matches = self._decrypt_to(plaintext, client, start, end,
+                                   raw_download, if_generation_match,
+                                   if_generation_not_match,
+                                   if_metageneration_match,
+                                   if_metageneration_not_match, timeout,
+                                   checksum)
+    except BaseException:
+      # never leave partly decrypted, unauthenticated plaintext behind
+      os.unlink(filename)
+      raise
+    if not matches:
+      os.unlink(filename)
+      raise errors.IntegrityError(
+          'CRC32C of gs://{}/{} does not match'.format(
+              self.bucket.name, self.name),
+          retryable=True)
+
+    if cacheable:
+      self.cache.put(self.bucket.name, self.name, self.generation, filename)
+    self._set_mtime(filename)
+
+  def _set_mtime(self, filename):
+    """Like the real download_to_filename, give the file the object's mtime.
 
+    Args:
+      filename: path to the downloaded file
 
+    Returns:
+      None
+    """
+    if self.updated is not None:
+      updated = self.updated.timestamp()
+      os.utime(filename, (updated, updated))
+
+  def _decrypt_to(self,
+                  file_obj,
+                  client=None,
+                  start=None,
+                  end=None,
+                  raw_download=False,
+                  if_generation_match=None,
+                  if_generation_not_match=None,
+                  if_metageneration_match=None,
+                  if_metageneration_not_match=None,
+                  timeout=60,
+                  checksum='md5'):
+    """Download the object, decrypting it into a file object as it arrives.
 
+    Args:
+      file_obj: binary file object the plaintext is written to
+      client: wrapped Client class
+      start: same as real start
+      end: same as real end
+      raw_download: same as real raw_download
+      if_generation_match: same as real if_generation_match
+      if_generation_not_match: same as real if_generation_not_match
+      if_metageneration_match: same as real if_metageneration_match
+      if_metageneration_not_match: same as real if_metageneration_not_match
+      timeout: same as real timeout
+      checksum: None to skip verifying the ciphertext, anything else checks
+        its CRC32C
 
+    Returns:
+      matches: False if the ciphertext's CRC32C was checked and is wrong
+    """
 
+    # Look the object up first, unless it came from a listing, so the
+    # download is pinned to one generation whose CRC32C and metadata we know
+    if self.crc32c is None or self.generation is None:
+      self.reload(client=client)
+
+    def download(writer):
+      storage.Blob.download_to_file(self, writer, client, start, end,
+                                    raw_download, if_generation_match,
+                                    if_generation_not_match,
+                                    if_metageneration_match,
+                                    if_metageneration_not_match, timeout,
+                                    checksum=None)
+
+    # Decrypt as we download. The wrapped data key is looked up in the object
+    # metadata if the key was rotated since the object was written
+    crc32c = self.e.decrypt_from(download, file_obj, lambda: self.metadata)
+
+    return checksum is None or start is not None or end is not None or \
+        streaming.crc32c_base64(crc32c) == self.crc32c
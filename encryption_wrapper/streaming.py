@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Segmented envelope format used for streaming encryption and decryption.
+
+An encrypted file is a header followed by segments:
+
+  magic              4 bytes, b'CSE1'
+  segment size       4 bytes, big endian, plaintext bytes per segment
+  key URI length     2 bytes, big endian
+  key URI            the KMS key that wrapped the data key
+  wrapped key length 4 bytes, big endian
+  wrapped key        the data key, wrapped by KMS
+  segments           segment size bytes of plaintext each (the last one may be
+                     shorter), encrypted with AES-GCM under the data key
+
+Every segment's associated data binds the header's magic and segment size,
+the segment index and whether it is the last segment, so segments can't be
+reordered, dropped or truncated without failing decryption. Because segments
+are fixed size, the offset of any segment can be computed from the header.
+
+Files encrypted before this format are a single Tink KmsEnvelopeAead
+ciphertext. Those start with the big endian length of the wrapped key, so
+their first byte is always zero and never matches the magic.
+"""
+
+import base64
+import collections
+import concurrent.futures
+import io
+import struct
+
+from encryption_wrapper import errors
+
+import google_crc32c
+from tink.core import TinkError
+
+
+MAGIC = b'CSE1'
+SEGMENT_SIZE = 1024 * 1024
+# AES-GCM's 12 byte IV and 16 byte tag
+SEGMENT_OVERHEAD = 28
+# first ranged read of an object's header; it covers the usual key URIs and
+# wrapped keys, and longer headers are completed with a second read
+HEADER_READ_SIZE = 8192
+# objects per page when listing a bucket to read headers
+LIST_PAGE_SIZE = 1000
+_PREFIX = struct.Struct('>4sIH')
+_WRAPPED_KEY_LENGTH = struct.Struct('>I')
+_SEGMENT_POSITION = struct.Struct('>QB')
+
+
+def is_segmented(prefix):
+  """Check whether ciphertext uses the segmented format.
+
+  Args:
+    prefix: at least the first four bytes of the ciphertext
+
+  Returns:
+    segmented: True for the segmented format, False for legacy ciphertext
+  """
+  return prefix[:len(MAGIC)] == MAGIC
+
+
+class Header(object):
+  """Header of a segmented ciphertext."""
+
+  def __init__(self, segment_size, key_uri, wrapped_key):
+    """Init class for Header.
+
+    Args:
+      segment_size: plaintext bytes per segment
+      key_uri: string with the resource identifier for the KMS symmetric key
+      wrapped_key: the data key, wrapped by KMS
+
+    Returns:
+      None
+    """
+    self.segment_size = segment_size
+    self.key_uri = key_uri
+    self.wrapped_key = wrapped_key
+
+  def to_bytes(self):
+    """Serialize the header.
+
+    Returns:
+      header: the header bytes that start the ciphertext
+    """
+    key_uri = self.key_uri.encode('utf-8')
+    return (_PREFIX.pack(MAGIC, self.segment_size, len(key_uri)) + key_uri +
+            _WRAPPED_KEY_LENGTH.pack(len(self.wrapped_key)) + self.wrapped_key)
+
+  @property
+  def size(self):
+    """Length of the serialized header in bytes."""
+    return (_PREFIX.size + len(self.key_uri.encode('utf-8')) +
+            _WRAPPED_KEY_LENGTH.size + len(self.wrapped_key))
+
+  @classmethod
+  def read(cls, stream):
+    """Read a header from the start of a ciphertext stream.
+
+    Args:
+      stream: binary file object positioned at the start of the ciphertext
+
+    Returns:
+      Header: the parsed header, with the stream positioned at segment 0
+    """
+    prefix = _read_exactly(stream, _PREFIX.size)
+    magic, segment_size, key_uri_length = _PREFIX.unpack(prefix)
+    if magic != MAGIC or segment_size == 0:
+      raise TinkError('not a segmented ciphertext')
+    key_uri = _read_exactly(stream, key_uri_length).decode('utf-8')
+    wrapped_key_length = _WRAPPED_KEY_LENGTH.unpack(
+        _read_exactly(stream, _WRAPPED_KEY_LENGTH.size))[0]
+    wrapped_key = _read_exactly(stream, wrapped_key_length)
+    return cls(segment_size, key_uri, wrapped_key)
+
+  @classmethod
+  def parse(cls, data):
+    """Parse a header from the start of a buffer that may be incomplete.
+
+    Args:
+      data: bytes from the start of the ciphertext
+
+    Returns:
+      Header: the parsed header, or None if data doesn't hold all of it yet
+    """
+    if len(data) < _PREFIX.size:
+      return None
+    magic, segment_size, key_uri_length = _PREFIX.unpack_from(data)
+    if magic != MAGIC or segment_size == 0:
+      raise TinkError('not a segmented ciphertext')
+    wrapped_key_start = (_PREFIX.size + key_uri_length +
+                         _WRAPPED_KEY_LENGTH.size)
+    if len(data) < wrapped_key_start:
+      return None
+    wrapped_key_length = _WRAPPED_KEY_LENGTH.unpack_from(
+        data, wrapped_key_start - _WRAPPED_KEY_LENGTH.size)[0]
+    if len(data) < wrapped_key_start + wrapped_key_length:
+      return None
+    key_uri = bytes(data[_PREFIX.size:_PREFIX.size + key_uri_length])
+    wrapped_key = bytes(
+        data[wrapped_key_start:wrapped_key_start + wrapped_key_length])
+    return cls(segment_size, key_uri.decode('utf-8'), wrapped_key)
+
+  @staticmethod
+  def bytes_needed(data):
+    """Bytes from the start of the ciphertext needed to parse more of it.
+
+    Args:
+      data: bytes from the start of the ciphertext
+
+    Returns:
+      size: length of the whole header once data holds the length fields,
+        otherwise the length that reaches the next one
+    """
+    if len(data) < _PREFIX.size:
+      return _PREFIX.size
+    key_uri_length = _PREFIX.unpack_from(data)[2]
+    wrapped_key_start = (_PREFIX.size + key_uri_length +
+                         _WRAPPED_KEY_LENGTH.size)
+    if len(data) < wrapped_key_start:
+      return wrapped_key_start
+    return wrapped_key_start + _WRAPPED_KEY_LENGTH.unpack_from(
+        data, wrapped_key_start - _WRAPPED_KEY_LENGTH.size)[0]
+
+  @property
+  def ciphertext_segment_size(self):
+    """Length in bytes of every encrypted segment but the last."""
+    return self.segment_size + SEGMENT_OVERHEAD
+
+  def segment_count(self, plaintext_size):
+    """Number of segments needed for a plaintext; empty files get one.
+
+    Args:
+      plaintext_size: length of the plaintext in bytes
+
+    Returns:
+      count: number of segments
+    """
+    return max(1, -(-plaintext_size // self.segment_size))
+
+  def ciphertext_size(self, plaintext_size):
+    """Length of the whole ciphertext for a plaintext, header included.
+
+    Args:
+      plaintext_size: length of the plaintext in bytes
+
+    Returns:
+      size: length of the ciphertext in bytes
+    """
+    return (self.size + plaintext_size +
+            self.segment_count(plaintext_size) * SEGMENT_OVERHEAD)
+
+  def plaintext_size(self, ciphertext_size):
+    """Length of the plaintext held in a ciphertext of a given length.
+
+    Args:
+      ciphertext_size: length of the whole ciphertext in bytes
+
+    Returns:
+      size: length of the plaintext in bytes
+    """
+    body = ciphertext_size - self.size
+    full, last = divmod(body, self.ciphertext_segment_size)
+    if last == 0:
+      if full == 0:
+        raise TinkError('ciphertext has no segments')
+      return full * self.segment_size
+    if last < SEGMENT_OVERHEAD:
+      raise TinkError('ciphertext is truncated')
+    return full * self.segment_size + last - SEGMENT_OVERHEAD
+
+  def segment_offset(self, index):
+    """Offset of an encrypted segment from the start of the ciphertext.
+
+    Args:
+      index: zero based segment number
+
+    Returns:
+      offset: byte offset of the segment
+    """
+    return self.size + index * self.ciphertext_segment_size
+
+  def associated_data(self, index, last):
+    """Associated data that binds a segment to its position.
+
+    Args:
+      index: zero based segment number
+      last: True if this is the final segment
+
+    Returns:
+      associated_data: bytes to authenticate along with the segment
+    """
+    return (MAGIC + struct.pack('>I', self.segment_size) +
+            _SEGMENT_POSITION.pack(index, int(last)))
+
+
+class SegmentCipher(object):
+  """Encrypt and decrypt the segments of one ciphertext."""
+
+  def __init__(self, header, data_aead):
+    """Init class for SegmentCipher.
+
+    Args:
+      header: Header of the ciphertext
+      data_aead: Tink AEAD for the unwrapped data key
+
+    Returns:
+      None
+    """
+    self.header = header
+    self.data_aead = data_aead
+
+  def encrypt_segment(self, index, plaintext, last):
+    """Encrypt one segment.
+
+    Args:
+      index: zero based segment number
+      plaintext: at most segment_size bytes
+      last: True if this is the final segment
+
+    Returns:
+      ciphertext: the encrypted segment
+    """
+    return self.data_aead.encrypt(plaintext,
+                                  self.header.associated_data(index, last))
+
+  def decrypt_segment(self, index, ciphertext, last):
+    """Decrypt one segment.
+
+    Args:
+      index: zero based segment number
+      ciphertext: the encrypted segment
+      last: True if this is the final segment
+
+    Returns:
+      plaintext: the decrypted segment
+    """
+    return self.data_aead.decrypt(ciphertext,
+                                  self.header.associated_data(index, last))
+
+  def encrypt_segments(self, segments, workers=1):
+    """Encrypt a sequence of segments, on several threads if asked to.
+
+    Each segment's position is bound by its associated data, not by the
+    order it is encrypted in, so segments can be encrypted in any order.
+    The ciphertexts are still yielded in the order the segments are given,
+    and with several workers at most twice as many segments as workers are
+    held in memory.
+
+    Args:
+      segments: iterable of (index, plaintext, last) tuples
+      workers: number of threads to encrypt on
+
+    Yields:
+      ciphertext: each encrypted segment, in order
+    """
+    if workers <= 1:
+      for index, plaintext, last in segments:
+        yield self.encrypt_segment(index, plaintext, last)
+      return
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+      pending = collections.deque()
+      for index, plaintext, last in segments:
+        pending.append(
+            executor.submit(self.encrypt_segment, index, plaintext, last))
+        if len(pending) >= 2 * workers:
+          yield pending.popleft().result()
+      while pending:
+        yield pending.popleft().result()
+
+  def encrypt_stream(self, source, destination, first_segment=0, workers=1):
+    """Encrypt a plaintext stream segment by segment.
+
+    With one worker only two segments are held in memory at a time,
+    whatever the size of the stream; with more, about twice as many as
+    workers. The header is written only when starting from segment 0.
+
+    Args:
+      source: binary file object positioned at first_segment's plaintext
+      destination: binary file object positioned where first_segment goes
+      first_segment: segment number to start from, used to resume
+      workers: number of threads to encrypt on
+
+    Returns:
+      segments: index one past the last segment written
+    """
+    if first_segment == 0:
+      destination.write(self.header.to_bytes())
+    index = first_segment
+    for ciphertext in self.encrypt_segments(
+        self._read_segments(source, first_segment), workers):
+      destination.write(ciphertext)
+      index += 1
+    return index
+
+  def _read_segments(self, source, index):
+    """Yield (index, plaintext, last) for each segment of a stream."""
+    segment = _read_up_to(source, self.header.segment_size)
+    while True:
+      # read ahead one segment so we know which segment is the last one
+      following = _read_up_to(source, self.header.segment_size)
+      last = not following
+      yield index, segment, last
+      if last:
+        return
+      index += 1
+      segment = following
+
+
+class Crc32cWriter(object):
+  """File object wrapper computing the CRC32C of everything written."""
+
+  def __init__(self, destination, crc32c=0):
+    """Init class for Crc32cWriter.
+
+    Args:
+      destination: binary file object to write to
+      crc32c: CRC32C of data already in the destination, to carry on from
+
+    Returns:
+      None
+    """
+    self.destination = destination
+    self.crc32c = crc32c
+
+  def write(self, data):
+    self.crc32c = google_crc32c.extend(self.crc32c, bytes(data))
+    return self.destination.write(data)
+
+
+class DecryptingWriter(io.RawIOBase):
+  """Writable file object that decrypts ciphertext as it is written.
+
+  Plaintext is written to the destination a segment at a time, and the CRC32C
+  of the ciphertext is computed on the way through, so ciphertext can be
+  decrypted and checked as it is downloaded without being stored first.
+  Legacy single envelope ciphertext is buffered and decrypted on close.
+  """
+
+  def __init__(self, destination, cipher_for, legacy_decrypt):
+    """Init class for DecryptingWriter.
+
+    Args:
+      destination: binary file object the plaintext is written to
+      cipher_for: function returning the SegmentCipher for a Header
+      legacy_decrypt: function decrypting a whole legacy ciphertext
+
+    Returns:
+      None
+    """
+    super().__init__()
+    self.destination = destination
+    self.crc32c = 0
+    self._cipher_for = cipher_for
+    self._legacy_decrypt = legacy_decrypt
+    self._buffer = bytearray()
+    self._cipher = None
+    self._index = 0
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    self.crc32c = google_crc32c.extend(self.crc32c, bytes(data))
+    self._buffer += data
+    if self._cipher is None and is_segmented(self._buffer):
+      header = Header.parse(self._buffer)
+      if header is not None:
+        self._cipher = self._cipher_for(header)
+        del self._buffer[:header.size]
+    if self._cipher is not None:
+      size = self._cipher.header.ciphertext_segment_size
+      # keep at least one byte back, the final segment is decrypted on close
+      while len(self._buffer) > size:
+        self.destination.write(self._cipher.decrypt_segment(
+            self._index, bytes(self._buffer[:size]), False))
+        del self._buffer[:size]
+        self._index += 1
+    return len(data)
+
+  def close(self):
+    """Decrypt the final segment, failing if the ciphertext is truncated."""
+    if self.closed:
+      return
+    try:
+      if self._cipher is not None:
+        self.destination.write(self._cipher.decrypt_segment(
+            self._index, bytes(self._buffer), True))
+      elif is_segmented(self._buffer):
+        raise TinkError('ciphertext is truncated')
+      else:
+        self.destination.write(self._legacy_decrypt(bytes(self._buffer)))
+      self._buffer = bytearray()
+    finally:
+      super().close()
+
+
+def read_header(blob, client=None):
+  """Fetch and parse an object's header with ranged reads, and no KMS call.
+
+  Args:
+    blob: Blob with its size, e.g. from a listing
+    client: Client to read with
+
+  Returns:
+    (header, prefix): the Header, or None for legacy ciphertext, and the
+      bytes read from the start of the object, the whole header and up to
+      HEADER_READ_SIZE bytes after it
+  """
+  if not blob.size:
+    raise errors.IntegrityError('object is empty, so not a ciphertext')
+  prefix = _download(blob, client, 0, min(blob.size, HEADER_READ_SIZE))
+  if not is_segmented(prefix):
+    return None, prefix
+  try:
+    header = Header.parse(prefix)
+    while header is None:
+      needed = Header.bytes_needed(prefix)
+      if needed > blob.size:
+        raise TinkError('ciphertext header is truncated')
+      prefix += _download(blob, client, len(prefix),
+                          min(blob.size, needed + HEADER_READ_SIZE))
+      header = Header.parse(prefix)
+  except (TinkError, UnicodeDecodeError) as header_error:
+    raise errors.IntegrityError(str(header_error)) from header_error
+  return header, prefix
+
+
+def crc32c_base64(crc32c):
+  """Format a CRC32C the way GCS reports it in object metadata.
+
+  Args:
+    crc32c: the checksum as an integer
+
+  Returns:
+    crc32c: base64 of the big endian checksum
+  """
+  return base64.b64encode(struct.pack('>I', crc32c)).decode('ascii')
+
+
+def _download(blob, client, start, stop):
+  """Download the ciphertext bytes from start up to but excluding stop."""
+  data = io.BytesIO()
+  blob.download_to_file(data, client, start=start, end=stop - 1,
+                        raw_download=True)
+  return data.getvalue()
+
+
+def _read_up_to(stream, size):
+  """Read size bytes, or fewer only at the end of the stream."""
+  chunks = []
+  while size:
+    chunk = stream.read(size)
+    if not chunk:
+      break
+    chunks.append(chunk)
+    size -= len(chunk)
+  return b''.join(chunks)
+
+
+def _read_exactly(stream, size):
+  """Read exactly size bytes or fail on a truncated stream."""
+  data = _read_up_to(stream, size)
+  if len(data) != size:
+    raise TinkError('ciphertext is truncated')
+  return data
@@ -14,11 +14,9 @@
 # limitations under the License.
 """Test cases for Organizational Policies."""
 
-import os
 import unittest
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+import inventory
 
 # Set dunder unittest in the global scope for pretty unit test results
 __unittest = True
@@ -28,19 +26,13 @@ class TestConfidentialVM(unittest.TestCase):
   Assured Workload project. Note that this test requires the PROJECT_ID 
   and REGION environment variables to be set."""
 
-  all_instances = None
-
   def setUp(self) -> None:
-    """Call super class setup and define some variables."""
+    """Call super class setup and read the instances from the inventory."""
     super().setUp()
-    self.project_id = os.getenv('PROJECT_ID', 'my-project')
-    self.region = os.getenv('REGION', 'us-central1')
-    # Get application-default credentials and initialize API client
-    credentials = GoogleCredentials.get_application_default()
-    self.project = self.project_id
-    self.service = discovery.build('compute', 'v1', credentials=credentials)
-    # Create cache of GCE Instances
-    self.get_instances()
+    self.all_instances = [
+        instance for instances in inventory.get().instances().values()
+        for instance in instances
+    ]
 
   def test_confidential_vm(self):
     """Verify that Confidential VM Config is Enabled for each Instance."""
@@ -55,30 +47,3 @@ class TestConfidentialVM(unittest.TestCase):
         instance['confidentialInstanceConfig']['enableConfidentialCompute'],
         'Confidential Computing not enabled in instance {instance_name}.'
       .format(instance_name=instance_name))
-
-  def get_instances(self):
-    if (self.all_instances is None):
-      self.retrieve_all_instances()
-
-  def retrieve_all_instances(self):
-    """Fetch all instances from configured project and region."""
-    zones = []
-    instances = []
-    # Retrieve all Zones, given Project ID
-    try:
-      request = self.service.zones().list(project=self.project)
-      response = request.execute()
-      for zone in response.get('items', []):
-        zones.append(zone['name'])
-    except Exception as e:
-      raise e
-    # Retrieve all Instances in each Zone
-    try:
-      for zone in zones:
-        request = self.service.instances().list(project=self.project, zone=zone)
-        response = request.execute()
-        for instance in response.get('items', []):
-          instances.append(instance)
-      self.__class__.all_instances = instances
-    except Exception as e:
-      raise e
\ No newline at end of file
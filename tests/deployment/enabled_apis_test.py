@@ -14,11 +14,9 @@
 # limitations under the License.
 """Test cases for enabled APIs."""
 
-import os
 import unittest
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+import inventory
 
 # Set dunder unittest in the global scope for pretty unit test results
 __unittest = True
@@ -30,7 +28,6 @@ class TestEnabledAPIs(unittest.TestCase):
   def setUp(self) -> None:
     """Call super class' setup and define some variables."""
     super().setUp()
-    self.project_id = os.getenv('PROJECT_ID', 'my-project')
     self.enabled_apis = {'assuredworkloads.googleapis.com',
                          'cloudkms.googleapis.com',
                          'compute.googleapis.com',
@@ -42,36 +39,9 @@ class TestEnabledAPIs(unittest.TestCase):
 
   def test_enabled_apis(self):
     """Testing to see if any APIs need to be flipped."""
-    # Get application-default credentials and initialize API client
-    credentials = GoogleCredentials.get_application_default()
-    project = 'projects/' + self.project_id
-    service = discovery.build('serviceusage', 'v1', credentials=credentials)
-    try:
-      apis = {'ENABLED': [], 'DISABLED': []}
-      # Set the next page token to 'first' just so we know not to include that
-      # argument in the first services().list() call
-      next_page = 'first'
-      # Iterate over pages of API responses
-      while next_page:
-        if next_page == 'first':
-          request = service.services().list(parent=project)
-        else:
-          request = service.services().list(parent=project, pageToken=next_page)
-        response = request.execute()
-        if 'nextPageToken' in response:
-          next_page = response['nextPageToken']
-        else:
-          next_page = False
-        # Now read the enabled and disabled APIs and put them in the appropriate
-        # list
-        services = response.get('services')
-        for index in range(len(services)):
-          item = services[index]
-          if item.get('config').get('name'):
-            apis[item['state']].append(item['config']['name'])
-        # Assert that the expected enabled APIs are equal to the actual enabled
-        # APIs
-      self.assertSetEqual(self.enabled_apis, set(apis['ENABLED']),
-                          'APIs that need to be enabled or disabled')
-    except Exception as e:
-      raise e
+    for project_id, enabled in inventory.get().enabled_services().items():
+      # Assert that the expected enabled APIs are equal to the actual enabled
+      # APIs
+      with self.subTest(project=project_id):
+        self.assertSetEqual(self.enabled_apis, set(enabled),
+                            'APIs that need to be enabled or disabled')
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Snapshot of the deployment state checked by the compliance tests.
+
+Every test reads the same snapshot, so each piece of state (enabled
+services, KMS keys, IAM policies, service accounts, instances) is fetched
+from the APIs once per run, the first time a test asks for it. Set
+DEPLOYMENT_SNAPSHOT to a file path to save the snapshot as JSON; if the file
+already exists it is loaded instead, so a saved snapshot can be replayed
+offline without credentials. Delete the file to take a fresh snapshot.
+
+Set PROJECT_IDS to a comma separated list to check many projects in one run.
+Projects, key rings and zones are fetched concurrently, at most
+DEPLOYMENT_WORKERS requests at a time, and instances come from one
+aggregated list per project rather than one list per zone.
+"""
+
+import concurrent.futures
+import json
+import os
+import threading
+
+from googleapiclient import discovery
+import httplib2
+from oauth2client.client import GoogleCredentials
+
+
+_SNAPSHOT = os.getenv('DEPLOYMENT_SNAPSHOT')
+_WORKERS = int(os.getenv('DEPLOYMENT_WORKERS', '16'))
+
+
+class Inventory(object):
+  """Deployment state, fetched section by section on first use."""
+
+  def __init__(self, snapshot_path=None):
+    """Init class for Inventory.
+
+    Args:
+      snapshot_path: JSON file to load the snapshot from if it exists, and
+        to save it to as sections are fetched
+
+    Returns:
+      None
+    """
+    self.project_id = os.getenv('PROJECT_ID', 'my-project')
+    self.project_ids = os.getenv('PROJECT_IDS', self.project_id).split(',')
+    self.cmek_project_id = os.getenv('CMEK_PROJECT_ID', 'my-cmek-project')
+    self.region = os.getenv('REGION', 'us-central1')
+    self.snapshot_path = snapshot_path
+    # reentrant, since fetching one section may need another
+    self.lock = threading.RLock()
+    self.services = {}
+    self.services_lock = threading.RLock()
+    # httplib2 connections can't be shared between threads
+    self.local = threading.local()
+    self.sections = {}
+    if snapshot_path and os.path.exists(snapshot_path):
+      with open(snapshot_path) as snapshot:
+        self.sections = json.load(snapshot)
+
+  def enabled_services(self):
+    """Names of the services enabled in each project, by project."""
+    return self._section(
+        'enabled_services',
+        lambda: self._per_project(self.project_ids,
+                                  self._fetch_enabled_services))
+
+  def key_rings(self):
+    """Names of the key rings in the CMEK project's region."""
+    return self._section('key_rings', self._fetch_key_rings)
+
+  def crypto_keys(self):
+    """CryptoKey resources of every key ring."""
+    return self._section('crypto_keys', self._fetch_crypto_keys)
+
+  def iam_policies(self):
+    """IAM policy of every project and of the CMEK project, by project."""
+    return self._section(
+        'iam_policies',
+        lambda: self._per_project(self.project_ids + [self.cmek_project_id],
+                                  self._fetch_iam_policy))
+
+  def service_accounts(self):
+    """Service account resources of each project, by project."""
+    return self._section(
+        'service_accounts',
+        lambda: self._per_project(self.project_ids,
+                                  self._fetch_service_accounts))
+
+  def instances(self):
+    """Instance resources in every zone of each project, by project."""
+    return self._section(
+        'instances',
+        lambda: self._per_project(self.project_ids, self._fetch_instances))
+
+  def to_json(self):
+    """Serialize every section fetched so far."""
+    with self.lock:
+      return json.dumps(self.sections, indent=2, sort_keys=True)
+
+  def _section(self, name, fetch):
+    """Return a section, fetching and saving it the first time."""
+    with self.lock:
+      if name not in self.sections:
+        self.sections[name] = fetch()
+        self._save()
+      return self.sections[name]
+
+  def _save(self):
+    """Atomically write the snapshot, if it has a path."""
+    if not self.snapshot_path:
+      return
+    partial_path = self.snapshot_path + '.partial'
+    with open(partial_path, 'w') as snapshot:
+      json.dump(self.sections, snapshot, indent=2, sort_keys=True)
+    os.replace(partial_path, self.snapshot_path)
+
+  def _service(self, name, version):
+    """Build an API client once per run."""
+    with self.services_lock:
+      if (name, version) not in self.services:
+        self.services[(name, version)] = discovery.build(
+            name, version, credentials=self._credentials(),
+            cache_discovery=False)
+      return self.services[(name, version)]
+
+  def _credentials(self):
+    """Application default credentials, looked up once per run."""
+    with self.services_lock:
+      if not hasattr(self, 'credentials'):
+        self.credentials = GoogleCredentials.get_application_default()
+      return self.credentials
+
+  def _http(self):
+    """Authorized connection for the current thread."""
+    http = getattr(self.local, 'http', None)
+    if http is None:
+      http = self._credentials().authorize(httplib2.Http())
+      self.local.http = http
+    return http
+
+  def _map(self, fetch, items):
+    """Call fetch on every item concurrently, keeping their order."""
+    if not items:
+      return []
+    workers = min(_WORKERS, len(items))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+      return list(executor.map(fetch, items))
+
+  def _per_project(self, project_ids, fetch):
+    """Fetch something for many projects concurrently."""
+    return dict(zip(project_ids, self._map(fetch, project_ids)))
+
+  def _fetch_enabled_services(self, project_id):
+    service = self._service('serviceusage', 'v1')
+    services = self._list_all(service.services(), 'services',
+                              parent='projects/' + project_id,
+                              filter='state:ENABLED')
+    return [item['config']['name'] for item in services
+            if item.get('config', {}).get('name')]
+
+  def _fetch_key_rings(self):
+    key_rings = self._service('cloudkms', 'v1').projects().locations(
+        ).keyRings()
+    parent = 'projects/{}/locations/{}'.format(self.cmek_project_id,
+                                               self.region)
+    return [item['name']
+            for item in self._list_all(key_rings, 'keyRings', parent=parent)
+            if item['name']]
+
+  def _fetch_crypto_keys(self):
+    crypto_keys = self._service('cloudkms', 'v1').projects().locations(
+        ).keyRings().cryptoKeys()
+    per_key_ring = self._map(
+        lambda key_ring: self._list_all(crypto_keys, 'cryptoKeys',
+                                        parent=key_ring), self.key_rings())
+    return [crypto_key for keys in per_key_ring for crypto_key in keys]
+
+  def _fetch_iam_policy(self, project_id):
+    service = self._service('cloudresourcemanager', 'v1beta1')
+    return service.projects().getIamPolicy(
+        resource=project_id, body={}).execute(http=self._http())
+
+  def _fetch_service_accounts(self, project_id):
+    service = self._service('iam', 'v1')
+    return self._list_all(service.projects().serviceAccounts(), 'accounts',
+                          name='projects/' + project_id)
+
+  def _fetch_instances(self, project_id):
+    # one aggregated list covers every zone; its items are keyed by zone
+    compute = self._service('compute', 'v1')
+    scopes = self._list_all(compute.instances(), 'items', 'aggregatedList',
+                            project=project_id)
+    return [instance for scope in scopes
+            for instance in scope.get('instances', [])]
+
+  def _list_all(self, collection, field, method='list', **kwargs):
+    """Call a collection's list method and follow every page.
+
+    Args:
+      collection: discovery collection with the method and its _next method
+      field: response field holding the items
+      method: name of the list method
+      **kwargs: arguments of the list call
+
+    Returns:
+      items: items of every page; for aggregated lists, the scoped lists
+    """
+    items = []
+    request = getattr(collection, method)(**kwargs)
+    while request is not None:
+      response = request.execute(http=self._http())
+      page = response.get(field, [])
+      items.extend(page.values() if isinstance(page, dict) else page)
+      request = getattr(collection, method + '_next')(request, response)
+    return items
+
+
+_INVENTORY = None
+_INVENTORY_LOCK = threading.Lock()
+
+
+def get():
+  """Return the inventory shared by every test in the run."""
+  global _INVENTORY
+  with _INVENTORY_LOCK:
+    if _INVENTORY is None:
+      _INVENTORY = Inventory(_SNAPSHOT)
+    return _INVENTORY
@@ -14,11 +14,9 @@
 # limitations under the License.
 """Test cases for KMS keys."""
 
-import os
 import unittest
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+import inventory
 
 # Set dunder unittest in the global scope for pretty unit test results
 __unittest = True
@@ -28,18 +26,10 @@ class TestKSM(unittest.TestCase):
   requires the CMEK_PROJECT_ID and REGION environment variables to be set."""
 
   def setUp(self) -> None:
-    """Call super class setup and define some variables."""
+    """Call super class setup and read the keys from the inventory."""
     super().setUp()
-    self.cmek_project_id = os.getenv('CMEK_PROJECT_ID', 'my-cmek-project')
-    self.region = os.getenv('REGION', 'us-central1')
-    self.all_key_rings = []
-    self.all_crypto_keys = []
-    # Get application-default credentials and initialize API client
-    credentials = GoogleCredentials.get_application_default()
-    self.project = 'projects/' + self.cmek_project_id + '/locations/' + self.region
-    self.service = discovery.build('cloudkms', 'v1', credentials=credentials)
-    # Create cache of all KMS Keys
-    self.get_crypto_keys()
+    self.all_key_rings = inventory.get().key_rings()
+    self.all_crypto_keys = inventory.get().crypto_keys()
 
   def test_keyring_exists(self):
     """Verify that at least one keyring exists."""
@@ -83,62 +73,3 @@ class TestKSM(unittest.TestCase):
             '{crypto_key} purpose is not ENCRYPT_DECRYPT'.format(
               crypto_key=crypto_key['name']
       ))
-
-  def get_crypto_keys(self):
-    if (len(self.all_crypto_keys) == 0):
-      self.retrieve_all_keys()
-
-  def retrieve_all_keys(self):
-    """Fetch all keys from configured project and region."""
-    if (len(self.all_key_rings) == 0):
-      self.retrieve_all_key_rings()
-    # for each keyring, get CryptoKeys
-    for key_ring in self.all_key_rings:
-      try:
-        # Set the next page token to 'first' just so we know not to include that
-        # argument in the first list_crypto_keys() call
-        next_page = 'first'
-        # Iterate over pages of API responses
-        while next_page:
-            if next_page == 'first':
-              request = self.service.projects().locations().keyRings().cryptoKeys().list(parent=key_ring)
-            else:
-              request = self.service.projects().locations().keyRings().cryptoKeys().list(parent=key_ring, pageToken=next_page)
-            response = request.execute()
-            if 'nextPageToken' in response:
-              next_page = response['nextPageToken']
-            else:
-              next_page = False
-            # Now read the crypto_keys and verify protection level
-            crypto_keys = response.get('cryptoKeys')
-            for crypto_key in crypto_keys:
-              self.all_crypto_keys.append(crypto_key)
-      except Exception as e:
-        raise e
-
-  def retrieve_all_key_rings(self):
-    """Fetch all key_rings from configured project and region."""
-    # get list of keyrings, given PROJECT_ID and REGION
-    try:      
-      # Set the next page token to 'first' just so we know not to include that
-      # argument in the first list_crypto_keys() call
-      next_page = 'first'
-      # Iterate over pages of API responses
-      while next_page:
-        if next_page == 'first':
-          request = self.service.projects().locations().keyRings().list(parent=self.project)
-        else:
-          request = self.service.projects().locations().keyRings().list(parent=self.project, pageToken=next_page)
-        response = request.execute()
-        if 'nextPageToken' in response:
-          next_page = response['nextPageToken']
-        else:
-          next_page = False
-        # Now read the enabled and disabled APIs and put them in the appropriate
-        # list
-        key_rings = response.get('keyRings')
-        for item in key_rings:
-          if item['name']:
-            self.all_key_rings.append(item['name'])
-    except Exception as e:
-      raise e
\ No newline at end of file
@@ -17,8 +17,7 @@
 import os
 import unittest
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+import inventory
 
 # Set dunder unittest in the global scope for pretty unit test results
 __unittest = True
@@ -30,107 +29,65 @@ class TestServiceAccounts(unittest.TestCase):
   def setUp(self) -> None:
     """Call super class' setup and define some variables."""
     super().setUp()
-    self.project_id = os.getenv('PROJECT_ID', 'my-project')
-    self.cmek_project_id = os.getenv('CMEK_PROJECT_ID', 'cmek-my-project')
+    self.project_ids = inventory.get().project_ids
+    self.cmek_project_id = inventory.get().cmek_project_id
     self.org_id = os.getenv('ORG_ID', 'my-org')
-    self.region = os.getenv('REGION', 'us-central1')
+    self.region = inventory.get().region
     self.serviceaccount = 'itar-compute-sa'
 
   def test_verify_service_account_exists(self):
     """Test that required service account exists."""
-    # Get application-default credentials and initialize API client
-    credentials = GoogleCredentials.get_application_default()
-    service = discovery.build('iam',
-                              'v1',
-                              credentials=credentials)
-
-    try:
-      # Retrieve a list of all service accounts in the project
-      request = service.projects().serviceAccounts().list(
-          name='projects/{project}'.format(
-              project=self.project_id
-          )
-      )
-      service_accounts = request.execute()
+    # Retrieve a list of all service accounts in each project
+    for project_id, service_accounts in \
+        inventory.get().service_accounts().items():
       # Determine if self.serviceaccount is in the list of SAs
       itar_sa = None
-      for sa in service_accounts['accounts']:
+      for sa in service_accounts:
         sa_name = sa['name'].split('/')[-1].\
-          replace('@{}.iam.gserviceaccount.com'.format(self.project_id), '')
+          replace('@{}.iam.gserviceaccount.com'.format(project_id), '')
         if sa_name == self.serviceaccount:
           itar_sa = sa_name
-      self.assertTrue(itar_sa, 'missing {name} SA in {project}'.format(
-          name=self.serviceaccount,
-          project=self.project_id
-      ))
-    except Exception as e: # pylint: disable=broad-except
-      raise e
+      with self.subTest(project=project_id):
+        self.assertTrue(itar_sa, 'missing {name} SA in {project}'.format(
+            name=self.serviceaccount,
+            project=project_id
+        ))
 
   def test_verify_aw_policy_bindings(self):
     """Test that correct policy bindings are in place for the AW project."""
-    # Get application-default credentials and initialize API client
-    credentials = GoogleCredentials.get_application_default()
-    service = discovery.build('cloudresourcemanager',
-                              'v1beta1',
-                              credentials=credentials)
-    # Dict of roles we want to check for SA membership
-    roles = {'roles/cloudkms.cryptoKeyEncrypterDecrypter': False,
-             'roles/iam.serviceAccountKeyAdmin': False,
-             'roles/storage.admin': False,
-             'roles/compute.viewer': False,
-             'roles/browser': False}
-    try:
-      request = service.projects().getIamPolicy(
-          resource=self.project_id,
-          body={}
-      )
-      policy = request.execute()
-      # Build the resource string
-      resource = 'serviceAccount:{sa}@{proj}.iam.gserviceaccount.com'.format(
-          sa=self.serviceaccount,
-          proj=self.project_id
-      )
-      # Iterate over the policy bindings and flip role membership booleans
-      for binding in policy['bindings']:
-        if resource in binding['members']:
-          roles[binding['role']] = True
-      for role in roles.keys():
-        self.assertTrue(roles[role], '{resource} missing role {role}'.format(
-            resource=resource,
-            role=role
-        ))
-    except Exception as e:  # pylint: disable=broad-except
-      raise e
+    for project_id in self.project_ids:
+      # Dict of roles we want to check for SA membership
+      roles = {'roles/cloudkms.cryptoKeyEncrypterDecrypter': False,
+               'roles/iam.serviceAccountKeyAdmin': False,
+               'roles/storage.admin': False,
+               'roles/compute.viewer': False,
+               'roles/browser': False}
+      with self.subTest(project=project_id):
+        self.assert_roles(project_id, project_id, roles)
 
   def test_verify_cmek_policy_bindings(self):
     """Test that correct policy bindings are in place for the CMEK project."""
-    # Get application-default credentials and initialize API client
-    credentials = GoogleCredentials.get_application_default()
-    service = discovery.build('cloudresourcemanager',
-                              'v1beta1',
-                              credentials=credentials)
-    # Dict of roles we want to check for SA membership
-    roles = {'roles/cloudkms.cryptoKeyEncrypterDecrypter': False,
-             'roles/browser': False}
-    try:
-      request = service.projects().getIamPolicy(
-          resource=self.cmek_project_id,
-          body={}
-      )
-      policy = request.execute()
-      # Build the resource string
-      resource = 'serviceAccount:{sa}@{proj}.iam.gserviceaccount.com'.format(
-          sa=self.serviceaccount,
-          proj=self.project_id
-      )
-      # Iterate over the policy bindings and flip role membership booleans
-      for binding in policy['bindings']:
-        if resource in binding['members']:
-          roles[binding['role']] = True
-      for role in roles.keys():
-        self.assertTrue(roles[role], '{resource} missing role {role}'.format(
-            resource=resource,
-            role=role
-        ))
-    except Exception as e:  # pylint: disable=broad-except
-      raise e
+    for project_id in self.project_ids:
+      # Dict of roles we want to check for SA membership
+      roles = {'roles/cloudkms.cryptoKeyEncrypterDecrypter': False,
+               'roles/browser': False}
+      with self.subTest(project=project_id):
+        self.assert_roles(self.cmek_project_id, project_id, roles)
+
+  def assert_roles(self, policy_project_id, sa_project_id, roles):
+    """Check that a project's SA has roles in a project's IAM policy."""
+    policy = inventory.get().iam_policies()[policy_project_id]
+    # Build the resource string
+    resource = 'serviceAccount:{sa}@{proj}.iam.gserviceaccount.com'.format(
+        sa=self.serviceaccount,
+        proj=sa_project_id
+    )
+    # Iterate over the policy bindings and flip role membership booleans
+    for binding in policy['bindings']:
+      if resource in binding['members']:
+        roles[binding['role']] = True
+    for role in roles.keys():
+      self.assertTrue(roles[role], '{resource} missing role {role}'.format(
+          resource=resource,
+          role=role
+      ))
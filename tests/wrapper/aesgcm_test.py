@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unittests for the cryptography AES-GCM backend against Tink's primitive."""
+
+import unittest
+
+from encryption_wrapper import aesgcm
+
+from tink import aead
+from tink import core
+from tink.core import TinkError
+
+
+class TestAesGcm(unittest.TestCase):
+  """Test cases for AesGcm's compatibility with Tink's raw AES256_GCM."""
+
+  def setUp(self) -> None:
+    """Call super class' setup and create one data key for both backends."""
+    super().setUp()
+    aead.register()
+    key_data = core.Registry.new_key_data(aead.aead_key_templates.AES256_GCM)
+    self.tink_aead = core.Registry.primitive(key_data, aead.Aead)
+    self.aesgcm = aesgcm.AesGcm(key_data)
+    self.plaintext = b'segment of plaintext' * 100
+    self.associated_data = b'CSE1\x00\x10\x00\x00position'
+
+  def test_tink_decrypts_aesgcm(self):
+    """Test that Tink decrypts what AesGcm encrypts."""
+    ciphertext = self.aesgcm.encrypt(self.plaintext, self.associated_data)
+    self.assertEqual(
+        self.tink_aead.decrypt(ciphertext, self.associated_data),
+        self.plaintext)
+
+  def test_aesgcm_decrypts_tink(self):
+    """Test that AesGcm decrypts what Tink encrypts."""
+    ciphertext = self.tink_aead.encrypt(self.plaintext, self.associated_data)
+    self.assertEqual(self.aesgcm.decrypt(ciphertext, self.associated_data),
+                     self.plaintext)
+
+  def test_empty_plaintext(self):
+    """Test that an empty plaintext round trips both ways."""
+    self.assertEqual(
+        self.tink_aead.decrypt(self.aesgcm.encrypt(b'', b''), b''), b'')
+    self.assertEqual(
+        self.aesgcm.decrypt(self.tink_aead.encrypt(b'', b''), b''), b'')
+
+  def test_ciphertext_size(self):
+    """Test that both add the same 12 byte IV and 16 byte tag."""
+    self.assertEqual(
+        len(self.aesgcm.encrypt(self.plaintext, b'')),
+        len(self.tink_aead.encrypt(self.plaintext, b'')))
+    self.assertEqual(len(self.aesgcm.encrypt(self.plaintext, b'')),
+                     len(self.plaintext) + 28)
+
+  def test_rejects_wrong_associated_data(self):
+    """Test that associated data other than the one encrypted with fails."""
+    ciphertext = self.tink_aead.encrypt(self.plaintext, self.associated_data)
+    with self.assertRaises(TinkError):
+      self.aesgcm.decrypt(ciphertext, self.associated_data + b'!')
+
+  def test_rejects_tampering(self):
+    """Test that flipping any byte of IV, ciphertext or tag fails."""
+    ciphertext = self.tink_aead.encrypt(self.plaintext, self.associated_data)
+    for position in (0, 11, 12, len(ciphertext) // 2, len(ciphertext) - 1):
+      tampered = bytearray(ciphertext)
+      tampered[position] ^= 1
+      with self.assertRaises(TinkError):
+        self.aesgcm.decrypt(bytes(tampered), self.associated_data)
+
+  def test_rejects_truncation(self):
+    """Test that ciphertext shorter than an IV and a tag fails."""
+    with self.assertRaises(TinkError):
+      self.aesgcm.decrypt(b'\x00' * 27, b'')
+    ciphertext = self.aesgcm.encrypt(self.plaintext, b'')
+    with self.assertRaises(TinkError):
+      self.aesgcm.decrypt(ciphertext[:-1], b'')
+
+
+if __name__ == '__main__':
+  unittest.main()
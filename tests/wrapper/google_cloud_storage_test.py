@@ -17,6 +17,9 @@
 import os
 import unittest
 
+from encryption_wrapper import archive
+from encryption_wrapper import filesystem
+from encryption_wrapper import index
 from encryption_wrapper import storage
 
 from google.cloud.exceptions import NotFound
@@ -87,3 +90,72 @@ class TestGCSWrapper(unittest.TestCase):
     with open(self.plaintext_path, 'r') as f:
       plaintext = f.read()
     self.assertEqual(plaintext, self.plaintext)
+
+  def test_iter_decrypted(self):
+    """Test decrypting every object under a prefix."""
+    self.blob.upload_from_filename(self.plaintext_path)
+    decrypted = {name: stream.read()
+                 for name, stream in self.bucket.iter_decrypted(
+                     prefix=self.blob_name, prefetch=2)}
+    self.assertEqual(decrypted[self.blob_name], self.plaintext.encode())
+
+  def test_open(self):
+    """Test writing and reading an object as a file object."""
+    with self.blob.open('wb') as f:
+      f.write(self.plaintext.encode())
+    with self.blob.open('rb') as f:
+      f.seek(5)
+      self.assertEqual(f.read(), self.plaintext[5:].encode())
+      self.assertEqual(f.tell(), len(self.plaintext))
+
+  def test_archive(self):
+    """Test packing files into an archive and reading members back."""
+    with archive.ArchiveWriter(self.blob) as packed:
+      packed.add('first', self.plaintext_path)
+      packed.add_bytes('second', b'more plaintext')
+    members = archive.ArchiveReader(self.bucket.blob(self.blob_name))
+    self.assertEqual(members.names(), ['first', 'second'])
+    self.assertEqual(members.read('second'), b'more plaintext')
+    members.extract('first', self.plaintext_path)
+    with open(self.plaintext_path, 'r') as f:
+      self.assertEqual(f.read(), self.plaintext)
+
+  def test_upload_to_buckets(self):
+    """Test uploading one encryption of a file to several buckets."""
+    blobs = self.client.upload_to_buckets(self.plaintext_path, self.blob_name,
+                                          [self.bucket_name])
+    self.assertEqual(len(blobs), 1)
+    blobs[0].download_to_filename(self.plaintext_path)
+    with open(self.plaintext_path, 'r') as f:
+      self.assertEqual(f.read(), self.plaintext)
+
+  def test_filesystem(self):
+    """Test writing, listing and reading through the fsspec filesystem."""
+    fs = filesystem.EncryptedGCSFileSystem(client=self.client)
+    path = '{}/{}'.format(self.bucket_name, self.blob_name)
+    with fs.open(path, 'wb') as f:
+      f.write(self.plaintext.encode())
+    self.assertEqual(fs.info(path)['size'], len(self.plaintext))
+    self.assertIn(path, fs.ls(self.bucket_name, detail=False))
+    with fs.open('gcs-cse://' + path, 'rb') as f:
+      f.seek(5)
+      self.assertEqual(f.read(), self.plaintext[5:].encode())
+
+  def test_index(self):
+    """Test recording uploads in the index and rebuilding it."""
+    index_path = '/tmp/testindex.db'
+    if os.path.exists(index_path):
+      os.unlink(index_path)
+    client = storage.Client(self.key_uri, self.creds,
+                            index_location=index_path)
+    blob = client.bucket(self.bucket_name).blob(self.blob_name)
+    blob.upload_from_filename(self.plaintext_path)
+    entry = client.index.get(self.bucket_name, self.blob_name)
+    self.assertEqual(entry['plaintext_size'], len(self.plaintext))
+    self.assertEqual(entry['key_uri'], self.key_uri)
+    self.assertTrue(
+        client.index.is_current(self.bucket_name, self.blob_name,
+                                blob.generation))
+    rebuilt = index.ObjectIndex('/tmp/testindex-rebuilt.db')
+    rebuilt.rebuild(client, self.bucket_name, prefix=self.blob_name)
+    self.assertEqual(rebuilt.get(self.bucket_name, self.blob_name), entry)
@@ -17,15 +17,12 @@
 import os
 import unittest
 
-from encryption_wrapper.common import run_command
-
-import pandas as pd
+from encryption_wrapper.audit import byte_entropy
+from encryption_wrapper.common import capture_command, run_command
 
 from google.cloud import storage
 from google.cloud.exceptions import NotFound
 
-from scipy.stats import entropy
-
 
 class TestGsutilWrapper(unittest.TestCase):
   """Test cases for the gsutil wrapper."""
@@ -128,13 +125,71 @@ class TestGsutilWrapper(unittest.TestCase):
                    gcs_path=self.gcs_path)
     run_command(command, 'test upload')
     # calculate the Shannon entropy of the plaintext
-    plaintext_series = pd.Series(list(self.plaintext))
-    plaintext_entropy = entropy(plaintext_series.value_counts())
+    plaintext_entropy = byte_entropy(self.plaintext.encode())
     # now copy down the encrypted object using the unwrapped GCS client library
     self.blob.download_to_filename(self.plaintext_path)
     with open(self.plaintext_path, 'rb') as f:
       ciphertext_bitearray = f.read()
-    ciphertext_series = pd.Series(list(ciphertext_bitearray))
-    ciphertext_entropy = entropy(ciphertext_series.value_counts())
+    ciphertext_entropy = byte_entropy(ciphertext_bitearray)
     # verify that the entropy of the ciphertext is higher
     self.assertGreater(ciphertext_entropy, plaintext_entropy)
+
+  def test_copy_in_cloud(self):
+    """Verify that gs-to-gs copies keep objects encrypted and decryptable."""
+    copy_name = self.blob_name + '-copy'
+    copy_path = 'gs://{}/{}'.format(self.bucket_name, copy_name)
+    # copy up an encrypted file, then copy it to another object in the cloud
+    command = ('./gsutil cp --client_side_encryption={key_uri},{creds} '
+               '{plaintext_path} {gcs_path}').format(
+                   key_uri=self.key_uri,
+                   creds=self.creds,
+                   plaintext_path=self.plaintext_path,
+                   gcs_path=self.gcs_path)
+    run_command(command, 'test upload')
+    command = ('./gsutil cp --client_side_encryption={key_uri},{creds} '
+               '{gcs_path} {copy_path}').format(
+                   key_uri=self.key_uri,
+                   creds=self.creds,
+                   gcs_path=self.gcs_path,
+                   copy_path=copy_path)
+    returncode = run_command(command, 'test cloud copy')
+    self.assertEqual(0, returncode)
+    # the copy keeps the custom metadata
+    copy_blob = self.bucket.get_blob(copy_name)
+    self.assertEqual('true', copy_blob.metadata['client-side-encrypted'])
+    # and decrypts to the original plaintext
+    command = ('./gsutil cp --client_side_encryption={key_uri},{creds} '
+               '{copy_path} {plaintext_path}').format(
+                   key_uri=self.key_uri,
+                   creds=self.creds,
+                   plaintext_path=self.plaintext_path,
+                   copy_path=copy_path)
+    returncode = run_command(command, 'test download of copy')
+    self.assertEqual(0, returncode)
+    with open(self.plaintext_path, 'r') as f:
+      plaintext = f.read()
+    self.assertEqual(plaintext, self.plaintext)
+
+  def test_streaming(self):
+    """Verify that stdin can be uploaded and objects decrypted to stdout."""
+    command = ('./gsutil cp --client_side_encryption={key_uri},{creds} '
+               '- {gcs_path} < {plaintext_path}').format(
+                   key_uri=self.key_uri,
+                   creds=self.creds,
+                   plaintext_path=self.plaintext_path,
+                   gcs_path=self.gcs_path)
+    returncode = run_command(command, 'test upload from stdin')
+    self.assertEqual(0, returncode)
+    self.assertEqual('true',
+                     self.bucket.get_blob(self.blob_name).metadata[
+                         'client-side-encrypted'])
+    option = '--client_side_encryption={},{}'.format(self.key_uri,
+                                                     self.creds)
+    # the option last, after the URLs, used to leave the ciphertext as is
+    for command in ('cat {path} {option}', 'cp {path} - {option}',
+                    'cp {option} {path} -'):
+      command = './gsutil ' + command.format(path=self.gcs_path,
+                                             option=option)
+      returncode, output = capture_command(command, 'test decrypt to stdout')
+      self.assertEqual(0, returncode)
+      self.assertEqual(self.plaintext, output)
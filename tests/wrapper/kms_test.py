@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unittests for the KMS machinery, run against a stub instead of Cloud KMS."""
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+from encryption_wrapper import kms
+
+from tink import aead
+from tink.core import TinkError
+
+
+class StubRemote(aead.Aead):
+  """Remote AEAD stand-in whose answers are scripted per call."""
+
+  def __init__(self, outcomes=None, delays=None):
+    """Init class for StubRemote.
+
+    Args:
+      outcomes: exceptions to raise, or None to succeed, one per call; calls
+        past the end succeed
+      delays: seconds each call sleeps, one per call; calls past the end
+        don't sleep
+
+    Returns:
+      None
+    """
+    self.outcomes = list(outcomes or [])
+    self.delays = list(delays or [])
+    self.calls = 0
+
+  def encrypt(self, plaintext, associated_data):
+    call = self.calls
+    self.calls += 1
+    if call < len(self.delays):
+      time.sleep(self.delays[call])
+    if call < len(self.outcomes) and self.outcomes[call] is not None:
+      raise self.outcomes[call]
+    return b'wrapped:' + plaintext
+
+  def decrypt(self, ciphertext, associated_data):
+    return self.encrypt(ciphertext, associated_data)
+
+
+def new_aead(remote, breaker=None, retries=0, deadline=5.0,
+             hedge_percentile=0, bucket=None, max_in_flight=10):
+  """KmsAead over a stub, by default with a bucket that never limits it."""
+  return kms.KmsAead(remote, bucket or kms.TokenBucket(1e6, 1000000),
+                     max_in_flight=max_in_flight, retries=retries,
+                     deadline=deadline, hedge_percentile=hedge_percentile,
+                     breaker=breaker)
+
+
+def run_concurrently(function, count):
+  """Call a function on several threads at once; return results or errors."""
+  outcomes = [None] * count
+
+  def run(position):
+    try:
+      outcomes[position] = function()
+    except Exception as error:  # pylint: disable=broad-except
+      outcomes[position] = error
+
+  threads = [threading.Thread(target=run, args=(position,))
+             for position in range(count)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return outcomes
+
+
+class TestTokenBucket(unittest.TestCase):
+  """Test cases for the rate limit of KMS requests."""
+
+  def test_burst_is_immediate(self):
+    """Test that a full bucket hands out its burst without waiting."""
+    bucket = kms.TokenBucket(rate=1, burst=5)
+    start = time.monotonic()
+    for _ in range(5):
+      bucket.acquire()
+    self.assertLess(time.monotonic() - start, 0.1)
+
+  def test_rate_after_burst(self):
+    """Test that once the burst is spent tokens come at the given rate."""
+    bucket = kms.TokenBucket(rate=50, burst=2)
+    start = time.monotonic()
+    for _ in range(2 + 10):
+      bucket.acquire()
+    self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+  def test_shared_between_threads(self):
+    """Test that threads sharing a bucket share its rate."""
+    bucket = kms.TokenBucket(rate=100, burst=1)
+    start = time.monotonic()
+    run_concurrently(lambda: [bucket.acquire() for _ in range(5)], 4)
+    self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+  """Test cases for the circuit breaker's states."""
+
+  def test_opens_after_consecutive_failures(self):
+    """Test that the circuit opens once enough failures in a row are seen."""
+    breaker = kms.CircuitBreaker(failures=3, reset_seconds=60)
+    for _ in range(2):
+      breaker.check()
+      breaker.failure()
+    breaker.check()
+    breaker.success()
+    for _ in range(3):
+      breaker.check()
+      breaker.failure()
+    with self.assertRaises(kms.CircuitOpenError):
+      breaker.check()
+
+  def test_half_open_lets_one_probe_through(self):
+    """Test that after the cool-down exactly one call probes KMS."""
+    breaker = kms.CircuitBreaker(failures=1, reset_seconds=0.05)
+    breaker.failure()
+    with self.assertRaises(kms.CircuitOpenError):
+      breaker.check()
+    time.sleep(0.06)
+    breaker.check()
+    with self.assertRaises(kms.CircuitOpenError):
+      breaker.check()
+
+  def test_probe_success_closes(self):
+    """Test that a successful probe closes the circuit."""
+    breaker = kms.CircuitBreaker(failures=1, reset_seconds=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.check()
+    breaker.success()
+    breaker.check()
+    breaker.check()
+
+  def test_probe_failure_reopens(self):
+    """Test that a failed probe opens the circuit for another cool-down."""
+    breaker = kms.CircuitBreaker(failures=5, reset_seconds=0.05)
+    for _ in range(5):
+      breaker.failure()
+    time.sleep(0.06)
+    breaker.check()
+    breaker.failure()
+    with self.assertRaises(kms.CircuitOpenError):
+      breaker.check()
+    time.sleep(0.06)
+    breaker.check()
+
+
+class TestKmsAead(unittest.TestCase):
+  """Test cases for retries, deadlines, hedging and the breaker in KmsAead."""
+
+  def test_retries_transient_failures(self):
+    """Test that transient failures are retried until KMS answers."""
+    remote = StubRemote([TinkError('UNAVAILABLE'), TinkError('503')])
+    self.assertEqual(new_aead(remote, retries=2).encrypt(b'key', b''),
+                     b'wrapped:key')
+    self.assertEqual(remote.calls, 3)
+
+  def test_does_not_retry_permanent_failures(self):
+    """Test that a failure that isn't transient is raised at once."""
+    remote = StubRemote([TinkError('PERMISSION_DENIED')])
+    with self.assertRaises(TinkError):
+      new_aead(remote, retries=5).encrypt(b'key', b'')
+    self.assertEqual(remote.calls, 1)
+
+  def test_breaker_fails_fast_while_open(self):
+    """Test that calls don't reach KMS while the circuit is open."""
+    remote = StubRemote([TinkError('UNAVAILABLE')] * 2)
+    kms_aead = new_aead(remote, kms.CircuitBreaker(2, 60))
+    for _ in range(2):
+      with self.assertRaises(TinkError):
+        kms_aead.encrypt(b'key', b'')
+    with self.assertRaises(kms.CircuitOpenError):
+      kms_aead.encrypt(b'key', b'')
+    self.assertEqual(remote.calls, 2)
+
+  def test_permanent_failure_releases_probe(self):
+    """Test that a probe failing with a permanent error closes the circuit.
+
+    Otherwise the probe is never released and the circuit stays open for
+    good, even once KMS is healthy again.
+    """
+    remote = StubRemote([TinkError('UNAVAILABLE'),
+                         TinkError('PERMISSION_DENIED')])
+    kms_aead = new_aead(remote, kms.CircuitBreaker(1, 0.05))
+    with self.assertRaises(TinkError):
+      kms_aead.encrypt(b'key', b'')
+    time.sleep(0.06)
+    with self.assertRaises(TinkError) as probe:
+      kms_aead.encrypt(b'key', b'')
+    self.assertNotIsInstance(probe.exception, kms.CircuitOpenError)
+    self.assertEqual(kms_aead.encrypt(b'key', b''), b'wrapped:key')
+
+  def test_unexpected_error_releases_probe(self):
+    """Test that a probe raising something other than TinkError is released."""
+    remote = StubRemote([TinkError('UNAVAILABLE'), ValueError('bad')])
+    kms_aead = new_aead(remote, kms.CircuitBreaker(1, 0.05))
+    with self.assertRaises(TinkError):
+      kms_aead.encrypt(b'key', b'')
+    time.sleep(0.06)
+    with self.assertRaises(ValueError):
+      kms_aead.encrypt(b'key', b'')
+    self.assertEqual(kms_aead.encrypt(b'key', b''), b'wrapped:key')
+
+  def test_deadline(self):
+    """Test that a request slower than the deadline fails as transient."""
+    remote = StubRemote(delays=[0.5])
+    start = time.monotonic()
+    with self.assertRaises(TinkError) as deadline:
+      new_aead(remote, deadline=0.1).encrypt(b'key', b'')
+    self.assertLess(time.monotonic() - start, 0.4)
+    self.assertTrue(kms.is_retryable(deadline.exception))
+
+  def test_deadline_is_retried(self):
+    """Test that a request abandoned at the deadline is sent again."""
+    remote = StubRemote(delays=[0.5])
+    self.assertEqual(
+        new_aead(remote, retries=1, deadline=0.1).encrypt(b'key', b''),
+        b'wrapped:key')
+    self.assertEqual(remote.calls, 2)
+
+  def test_hedging(self):
+    """Test that a slow request is duplicated and the first answer wins."""
+    remote = StubRemote(delays=[1.0])
+    kms_aead = new_aead(remote, hedge_percentile=50)
+    kms_aead._latencies.extend([0.01] * kms._MIN_LATENCY_SAMPLES)  # pylint: disable=protected-access
+    start = time.monotonic()
+    self.assertEqual(kms_aead.encrypt(b'key', b''), b'wrapped:key')
+    self.assertLess(time.monotonic() - start, 0.5)
+    self.assertEqual(remote.calls, 2)
+
+  def test_throttling_is_not_a_deadline(self):
+    """Test that waiting for a token doesn't count against the deadline."""
+    remote = StubRemote()
+    breaker = kms.CircuitBreaker(1, 60)
+    kms_aead = new_aead(remote, breaker, deadline=0.1,
+                        bucket=kms.TokenBucket(rate=4, burst=1))
+    for _ in range(3):
+      self.assertEqual(kms_aead.encrypt(b'key', b''), b'wrapped:key')
+    self.assertEqual(remote.calls, 3)
+    breaker.check()
+
+  def test_waiting_for_a_slot_is_not_a_deadline(self):
+    """Test that waiting for an in-flight slot doesn't count either."""
+    remote = StubRemote(delays=[0.15] * 3)
+    kms_aead = new_aead(remote, deadline=0.3, max_in_flight=1)
+    outcomes = run_concurrently(lambda: kms_aead.encrypt(b'key', b''), 3)
+    self.assertEqual(outcomes, [b'wrapped:key'] * 3)
+
+  def test_abandoned_requests_are_dropped(self):
+    """Test that a hedge still queued at the deadline never reaches KMS."""
+    remote = StubRemote(delays=[0.4])
+    kms_aead = new_aead(remote, deadline=0.1, hedge_percentile=50,
+                        max_in_flight=1)
+    kms_aead._latencies.extend([0.01] * kms._MIN_LATENCY_SAMPLES)  # pylint: disable=protected-access
+    with self.assertRaises(TinkError):
+      kms_aead.encrypt(b'key', b'')
+    time.sleep(0.5)
+    self.assertEqual(remote.calls, 1)
+
+  def test_no_hedging_without_latencies(self):
+    """Test that nothing is duplicated until enough latencies are known."""
+    remote = StubRemote(delays=[0.2])
+    kms_aead = new_aead(remote, hedge_percentile=50)
+    self.assertEqual(kms_aead.encrypt(b'key', b''), b'wrapped:key')
+    self.assertEqual(remote.calls, 1)
+
+
+class TestCoalescing(unittest.TestCase):
+  """Test cases for sharing identical unwraps that are in flight."""
+
+  def test_identical_unwraps_share_one_call(self):
+    """Test that concurrent unwraps of one wrapped key make one KMS call."""
+    remote = StubRemote(delays=[0.3])
+    kms_aead = new_aead(remote)
+    outcomes = run_concurrently(lambda: kms_aead.decrypt(b'key', b''), 5)
+    self.assertEqual(outcomes, [b'wrapped:key'] * 5)
+    self.assertEqual(remote.calls, 1)
+
+  def test_error_is_shared(self):
+    """Test that every waiting thread gets the error of the shared call."""
+    remote = StubRemote([TinkError('PERMISSION_DENIED')], delays=[0.3])
+    kms_aead = new_aead(remote)
+    outcomes = run_concurrently(lambda: kms_aead.decrypt(b'key', b''), 5)
+    for outcome in outcomes:
+      self.assertIsInstance(outcome, TinkError)
+    self.assertEqual(remote.calls, 1)
+
+  def test_different_unwraps_are_separate(self):
+    """Test that unwraps of different keys aren't merged."""
+    remote = StubRemote(delays=[0.1, 0.1])
+    kms_aead = new_aead(remote)
+    results = run_concurrently(
+        lambda: kms_aead.decrypt(threading.current_thread().name.encode(),
+                                 b''), 2)
+    self.assertEqual(len(set(results)), 2)
+    self.assertEqual(remote.calls, 2)
+
+  def test_finished_unwraps_are_not_cached(self):
+    """Test that an unwrap after the shared call finished asks KMS again."""
+    remote = StubRemote()
+    kms_aead = new_aead(remote)
+    kms_aead.decrypt(b'key', b'')
+    kms_aead.decrypt(b'key', b'')
+    self.assertEqual(remote.calls, 2)
+
+  def test_wraps_are_not_coalesced(self):
+    """Test that wraps always make their own call."""
+    remote = StubRemote(delays=[0.2, 0.2])
+    kms_aead = new_aead(remote)
+    run_concurrently(lambda: kms_aead.encrypt(b'key', b''), 2)
+    self.assertEqual(remote.calls, 2)
+
+
+class TestKeyRouter(unittest.TestCase):
+  """Test cases for ranking and failing over between equivalent keys."""
+
+  def setUp(self) -> None:
+    """Call super class' setup and route over stubs of two keys."""
+    super().setUp()
+    self.remotes = {'gcp-kms://a': StubRemote(), 'gcp-kms://b': StubRemote()}
+    patcher = mock.patch.object(
+        kms, 'get_aead',
+        lambda key_uri, creds: new_aead(self.remotes[key_uri]))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    explore = mock.patch.object(kms, '_EXPLORE_RATE', 0)
+    explore.start()
+    self.addCleanup(explore.stop)
+    self.router = kms.KeyRouter(['gcp-kms://a', 'gcp-kms://b'], 'creds')
+
+  def test_unmeasured_keys_first(self):
+    """Test that keys without a latency are tried before measured ones."""
+    self.router.wrap(b'key')
+    self.assertEqual(self.router.ranked(), ['gcp-kms://b', 'gcp-kms://a'])
+
+  def test_ranked_by_latency(self):
+    """Test that the key answering fastest is preferred."""
+    self.remotes['gcp-kms://a'].delays = [0.1] * 5
+    for key_uri in ('gcp-kms://a', 'gcp-kms://b'):
+      self.router.call(key_uri, 'encrypt', b'key', b'')
+    self.assertEqual(self.router.ranked(), ['gcp-kms://b', 'gcp-kms://a'])
+    self.assertEqual(self.router.wrap(b'key')[0], 'gcp-kms://b')
+
+  def test_failover(self):
+    """Test that a wrap fails over and the failing key is ranked last."""
+    self.remotes['gcp-kms://a'].outcomes = [TinkError('UNAVAILABLE')]
+    key_uri, wrapped_key = self.router.wrap(b'key')
+    self.assertEqual((key_uri, wrapped_key), ('gcp-kms://b', b'wrapped:key'))
+    self.assertEqual(self.router.ranked(), ['gcp-kms://b', 'gcp-kms://a'])
+    self.assertIsNone(self.router.latencies()['gcp-kms://a'])
+
+  def test_all_keys_failing(self):
+    """Test that the last error is raised when every key fails."""
+    for remote in self.remotes.values():
+      remote.outcomes = [TinkError('UNAVAILABLE')]
+    with self.assertRaises(TinkError):
+      self.router.wrap(b'key')
+    self.assertEqual(sorted(self.router.ranked()),
+                     ['gcp-kms://a', 'gcp-kms://b'])
+
+  def test_bad_ciphertext_keeps_key_healthy(self):
+    """Test that an unwrap rejected by KMS doesn't demote the key."""
+    self.remotes['gcp-kms://a'].outcomes = [TinkError('INVALID_ARGUMENT')]
+    with self.assertRaises(TinkError):
+      self.router.aead_for('gcp-kms://a').decrypt(b'key', b'')
+    self.assertEqual(self.router.ranked()[0], 'gcp-kms://a')
+
+  def test_unknown_key_gets_its_own_aead(self):
+    """Test that unwrapping for a key outside the router uses that key."""
+    self.remotes['gcp-kms://other'] = StubRemote()
+    self.router.aead_for('gcp-kms://other').decrypt(b'key', b'')
+    self.assertEqual(self.remotes['gcp-kms://other'].calls, 1)
+    self.assertEqual(self.remotes['gcp-kms://a'].calls, 0)
+    self.assertEqual(self.router.latencies(),
+                     {'gcp-kms://a': None, 'gcp-kms://b': None})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unittests for the segmented ciphertext format, run without KMS or GCS."""
+
+import io
+import os
+import unittest
+
+from encryption_wrapper import errors
+from encryption_wrapper import streaming
+
+import google_crc32c
+from tink import aead
+from tink import core
+from tink.core import TinkError
+
+# small segments so boundaries are cheap to test
+_SEGMENT_SIZE = 64
+
+
+def new_cipher(segment_size=_SEGMENT_SIZE, key_uri='gcp-kms://test-key'):
+  """SegmentCipher with a fresh local data key and a made up wrapped key."""
+  aead.register()
+  key_data = core.Registry.new_key_data(aead.aead_key_templates.AES256_GCM)
+  header = streaming.Header(segment_size, key_uri, os.urandom(73))
+  return streaming.SegmentCipher(header,
+                                 core.Registry.primitive(key_data, aead.Aead))
+
+
+def encrypt(cipher, plaintext):
+  """Encrypt a plaintext into a whole ciphertext, header included."""
+  ciphertext = io.BytesIO()
+  cipher.encrypt_stream(io.BytesIO(plaintext), ciphertext)
+  return ciphertext.getvalue()
+
+
+def decrypt(cipher, ciphertext, chunk_size=7, legacy_decrypt=None):
+  """Decrypt a ciphertext written to a DecryptingWriter in small chunks."""
+  plaintext = io.BytesIO()
+  writer = streaming.DecryptingWriter(plaintext, lambda header: cipher,
+                                      legacy_decrypt)
+  for start in range(0, len(ciphertext), chunk_size):
+    writer.write(ciphertext[start:start + chunk_size])
+  writer.close()
+  return plaintext.getvalue(), writer.crc32c
+
+
+class FakeBlob(object):
+  """Stand-in for a Blob that serves ranged reads from memory."""
+
+  class bucket(object):  # pylint: disable=invalid-name
+    name = 'bucket'
+
+  name = 'object'
+
+  def __init__(self, data):
+    self.data = data
+    self.size = len(data)
+    self.reads = []
+
+  def download_to_file(self, file_obj, client=None, start=None, end=None,
+                       raw_download=False):
+    self.reads.append((start, end))
+    file_obj.write(self.data[start:end + 1])
+
+
+class TestHeader(unittest.TestCase):
+  """Test cases for serializing and parsing the header."""
+
+  def test_round_trip(self):
+    """Test that read and parse return what to_bytes wrote."""
+    header = streaming.Header(_SEGMENT_SIZE, 'gcp-kms://key/é', b'wrapped')
+    data = header.to_bytes()
+    self.assertEqual(len(data), header.size)
+    for parsed in (streaming.Header.read(io.BytesIO(data + b'segments')),
+                   streaming.Header.parse(data + b'segments')):
+      self.assertEqual(parsed.segment_size, header.segment_size)
+      self.assertEqual(parsed.key_uri, header.key_uri)
+      self.assertEqual(parsed.wrapped_key, header.wrapped_key)
+
+  def test_parse_incomplete(self):
+    """Test that every prefix shorter than the header parses to None."""
+    data = streaming.Header(_SEGMENT_SIZE, 'key', b'wrapped').to_bytes()
+    for length in range(len(data)):
+      self.assertIsNone(streaming.Header.parse(data[:length]))
+      self.assertGreater(streaming.Header.bytes_needed(data[:length]), length)
+    self.assertEqual(streaming.Header.bytes_needed(data), len(data))
+
+  def test_read_truncated(self):
+    """Test that reading a truncated header from a stream fails."""
+    data = streaming.Header(_SEGMENT_SIZE, 'key', b'wrapped').to_bytes()
+    with self.assertRaises(TinkError):
+      streaming.Header.read(io.BytesIO(data[:-1]))
+
+  def test_rejects_zero_segment_size(self):
+    """Test that a header with segments of zero bytes is rejected."""
+    data = streaming.Header(0, 'key', b'wrapped').to_bytes()
+    with self.assertRaises(TinkError):
+      streaming.Header.parse(data)
+
+  def test_sizes(self):
+    """Test plaintext and ciphertext sizes at and around segment boundaries."""
+    header = streaming.Header(_SEGMENT_SIZE, 'key', b'wrapped')
+    for plaintext_size in (0, 1, _SEGMENT_SIZE - 1, _SEGMENT_SIZE,
+                           _SEGMENT_SIZE + 1, 3 * _SEGMENT_SIZE):
+      ciphertext_size = header.ciphertext_size(plaintext_size)
+      self.assertEqual(header.plaintext_size(ciphertext_size), plaintext_size)
+    with self.assertRaises(TinkError):
+      header.plaintext_size(header.size)
+    with self.assertRaises(TinkError):
+      header.plaintext_size(header.size + streaming.SEGMENT_OVERHEAD - 1)
+
+
+class TestSegments(unittest.TestCase):
+  """Test cases for encrypting and decrypting segmented ciphertext."""
+
+  def test_round_trip_at_boundaries(self):
+    """Test plaintexts that end exactly on and just around segment ends."""
+    cipher = new_cipher()
+    for size in (0, 1, _SEGMENT_SIZE - 1, _SEGMENT_SIZE, _SEGMENT_SIZE + 1,
+                 2 * _SEGMENT_SIZE, 5 * _SEGMENT_SIZE + 3):
+      plaintext = os.urandom(size)
+      ciphertext = encrypt(cipher, plaintext)
+      self.assertEqual(len(ciphertext), cipher.header.ciphertext_size(size))
+      self.assertEqual(decrypt(cipher, ciphertext)[0], plaintext)
+
+  def test_empty_plaintext_has_one_segment(self):
+    """Test that an empty plaintext still gets an authenticated segment."""
+    cipher = new_cipher()
+    ciphertext = encrypt(cipher, b'')
+    self.assertEqual(len(ciphertext),
+                     cipher.header.size + streaming.SEGMENT_OVERHEAD)
+    self.assertEqual(decrypt(cipher, ciphertext)[0], b'')
+    with self.assertRaises(TinkError):
+      decrypt(cipher, ciphertext[:cipher.header.size])
+
+  def test_parallel_encryption_matches_order(self):
+    """Test that segments encrypted on several threads decrypt in order."""
+    cipher = new_cipher()
+    plaintext = os.urandom(20 * _SEGMENT_SIZE + 5)
+    ciphertext = io.BytesIO()
+    cipher.encrypt_stream(io.BytesIO(plaintext), ciphertext, workers=4)
+    self.assertEqual(decrypt(cipher, ciphertext.getvalue())[0], plaintext)
+
+  def test_truncation(self):
+    """Test that dropping the last segment, or part of it, fails."""
+    cipher = new_cipher()
+    ciphertext = encrypt(cipher, os.urandom(3 * _SEGMENT_SIZE + 10))
+    last = cipher.header.segment_offset(3)
+    for end in (last, last + 5, len(ciphertext) - 1):
+      with self.assertRaises(TinkError):
+        decrypt(cipher, ciphertext[:end])
+
+  def test_truncation_at_segment_boundary(self):
+    """Test that dropping whole segments after a full one fails."""
+    cipher = new_cipher()
+    ciphertext = encrypt(cipher, os.urandom(3 * _SEGMENT_SIZE))
+    with self.assertRaises(TinkError):
+      decrypt(cipher, ciphertext[:cipher.header.segment_offset(2)])
+
+  def test_reordering(self):
+    """Test that swapping two segments fails."""
+    cipher = new_cipher()
+    ciphertext = encrypt(cipher, os.urandom(3 * _SEGMENT_SIZE + 10))
+    first = cipher.header.segment_offset(0)
+    second = cipher.header.segment_offset(1)
+    third = cipher.header.segment_offset(2)
+    swapped = (ciphertext[:first] + ciphertext[second:third] +
+               ciphertext[first:second] + ciphertext[third:])
+    with self.assertRaises(TinkError):
+      decrypt(cipher, swapped)
+
+  def test_last_flag(self):
+    """Test that a segment only decrypts with the last flag it was given."""
+    cipher = new_cipher()
+    segment = cipher.encrypt_segment(0, b'plaintext', False)
+    self.assertEqual(cipher.decrypt_segment(0, segment, False), b'plaintext')
+    with self.assertRaises(TinkError):
+      cipher.decrypt_segment(0, segment, True)
+    last = cipher.encrypt_segment(1, b'plaintext', True)
+    with self.assertRaises(TinkError):
+      cipher.decrypt_segment(1, last, False)
+
+  def test_segment_size_is_bound(self):
+    """Test that segments don't decrypt under another segment size."""
+    cipher = new_cipher()
+    ciphertext = encrypt(cipher, os.urandom(10))
+    other = streaming.SegmentCipher(
+        streaming.Header(_SEGMENT_SIZE * 2, cipher.header.key_uri,
+                         cipher.header.wrapped_key), cipher.data_aead)
+    with self.assertRaises(TinkError):
+      other.decrypt_segment(0, ciphertext[cipher.header.size:], True)
+
+
+class TestCrc32c(unittest.TestCase):
+  """Test cases for the CRC32C computed while writing."""
+
+  def test_crc32c_writer(self):
+    """Test that Crc32cWriter matches google_crc32c over many writes."""
+    data = os.urandom(10000)
+    destination = io.BytesIO()
+    writer = streaming.Crc32cWriter(destination)
+    for start in range(0, len(data), 333):
+      writer.write(data[start:start + 333])
+    self.assertEqual(destination.getvalue(), data)
+    self.assertEqual(writer.crc32c, google_crc32c.value(data))
+
+  def test_crc32c_writer_carries_on(self):
+    """Test that a writer resumed with an earlier CRC32C continues it."""
+    data = os.urandom(1000)
+    writer = streaming.Crc32cWriter(io.BytesIO(),
+                                    google_crc32c.value(data[:400]))
+    writer.write(data[400:])
+    self.assertEqual(writer.crc32c, google_crc32c.value(data))
+
+  def test_decrypting_writer_crc32c(self):
+    """Test that DecryptingWriter's CRC32C is that of the ciphertext."""
+    cipher = new_cipher()
+    ciphertext = encrypt(cipher, os.urandom(4 * _SEGMENT_SIZE + 1))
+    self.assertEqual(decrypt(cipher, ciphertext)[1],
+                     google_crc32c.value(ciphertext))
+
+  def test_base64(self):
+    """Test the format GCS reports CRC32Cs in."""
+    self.assertEqual(
+        streaming.crc32c_base64(google_crc32c.value(b'hello world')),
+        'yZRlqg==')
+
+
+class TestLegacy(unittest.TestCase):
+  """Test cases for the fallback to single envelope ciphertext."""
+
+  def setUp(self) -> None:
+    """Call super class' setup and make a local envelope AEAD."""
+    super().setUp()
+    aead.register()
+    remote = core.Registry.primitive(
+        core.Registry.new_key_data(aead.aead_key_templates.AES256_GCM),
+        aead.Aead)
+    self.envelope = aead.KmsEnvelopeAead(aead.aead_key_templates.AES128_EAX,
+                                         remote)
+
+  def test_is_not_segmented(self):
+    """Test that legacy ciphertext never looks segmented."""
+    ciphertext = self.envelope.encrypt(b'plaintext', b'')
+    self.assertFalse(streaming.is_segmented(ciphertext))
+    self.assertEqual(ciphertext[0], 0)
+
+  def test_decrypting_writer_falls_back(self):
+    """Test that legacy ciphertext is buffered and decrypted on close."""
+    plaintext = os.urandom(1000)
+    ciphertext = self.envelope.encrypt(plaintext, b'')
+    decrypted, crc32c = decrypt(
+        None, ciphertext,
+        legacy_decrypt=lambda data: self.envelope.decrypt(data, b''))
+    self.assertEqual(decrypted, plaintext)
+    self.assertEqual(crc32c, google_crc32c.value(ciphertext))
+
+  def test_tampered_legacy_fails(self):
+    """Test that tampered legacy ciphertext fails on close."""
+    ciphertext = bytearray(self.envelope.encrypt(b'plaintext', b''))
+    ciphertext[-1] ^= 1
+    with self.assertRaises(TinkError):
+      decrypt(None, bytes(ciphertext),
+              legacy_decrypt=lambda data: self.envelope.decrypt(data, b''))
+
+
+class TestReadHeader(unittest.TestCase):
+  """Test cases for reading headers with ranged reads."""
+
+  def test_one_read(self):
+    """Test that a usual header takes a single ranged read."""
+    cipher = new_cipher()
+    blob = FakeBlob(encrypt(cipher, os.urandom(100)))
+    header, prefix = streaming.read_header(blob)
+    self.assertEqual(header.wrapped_key, cipher.header.wrapped_key)
+    self.assertEqual(prefix, blob.data)
+    self.assertEqual(blob.reads, [(0, blob.size - 1)])
+
+  def test_long_header(self):
+    """Test that a header longer than the first read is fetched in full."""
+    cipher = new_cipher(key_uri='k' * (2 * streaming.HEADER_READ_SIZE))
+    blob = FakeBlob(encrypt(cipher, os.urandom(100)))
+    header, prefix = streaming.read_header(blob)
+    self.assertEqual(header.key_uri, cipher.header.key_uri)
+    self.assertTrue(blob.data.startswith(prefix))
+    self.assertGreater(len(prefix), header.size)
+    self.assertGreater(len(blob.reads), 1)
+
+  def test_legacy(self):
+    """Test that legacy ciphertext has no header."""
+    header, prefix = streaming.read_header(FakeBlob(b'\x00\x00\x00\x04key!'))
+    self.assertIsNone(header)
+    self.assertEqual(prefix, b'\x00\x00\x00\x04key!')
+
+  def test_empty_and_truncated(self):
+    """Test that empty objects and truncated headers are integrity errors."""
+    data = new_cipher().header.to_bytes()
+    for ciphertext in (b'', data[:-1], data[:6]):
+      with self.assertRaises(errors.IntegrityError):
+        streaming.read_header(FakeBlob(ciphertext))
+
+
+if __name__ == '__main__':
+  unittest.main()